@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+#
+# Compares the time taken by the hg commands post-review runs when they're
+# run through a Mercurial command server and when hg is started for each
+# one. This must be run from inside a Mercurial clone.
+#
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+from rbtools.clients.mercurial import MercurialCommandServer
+from rbtools.utils.process import execute
+
+
+HG_ENV = {
+    'HGRCPATH': os.devnull,
+    'HGPLAIN': '1',
+}
+
+COMMANDS = [
+    ['root'],
+    ['branch'],
+    ['log', '-r', '.', '--template', '{rev}\\0{parents}\\0{desc}\\0'],
+    ['log', '-r', '.', '--template', '{desc|firstline}'],
+    ['diff', '-r', '.'],
+]
+
+
+def run_commands(run, iterations):
+    start_time = time.time()
+
+    for i in range(iterations):
+        for command in COMMANDS:
+            run(command)
+
+    return time.time() - start_time
+
+
+def main():
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+    else:
+        iterations = 10
+
+    num_commands = iterations * len(COMMANDS)
+
+    def run_hg(command):
+        execute(['hg'] + command, env=HG_ENV.copy())
+
+    cmdserver = MercurialCommandServer(HG_ENV.copy())
+
+    # Start the command server before timing, so both are timed the same
+    # way. The startup happens once per post-review run either way.
+    start_time = time.time()
+    cmdserver.execute(['root'])
+    startup = time.time() - start_time
+
+    for name, run in [('hg', run_hg),
+                      ('command server', cmdserver.execute)]:
+        elapsed = run_commands(run, iterations)
+        print '%-16s %d commands in %.2fs (%.1fms per command)' % (
+            name, num_commands, elapsed, elapsed * 1000 / num_commands)
+
+    print 'Command server startup took %.1fms' % (startup * 1000)
+
+    if not cmdserver._available:
+        print 'The command server was unavailable, so hg was used instead.'
+
+    cmdserver.close()
+
+
+if __name__ == "__main__":
+    main()
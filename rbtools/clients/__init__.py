@@ -25,6 +25,13 @@ class SCMClient(object):
     def check_options(self):
         pass
 
+    def close(self):
+        """
+        Stops any processes the client has left running for later
+        commands. This is called once the client is no longer needed.
+        """
+        pass
+
     def scan_for_server(self, repository_info):
         """
         Scans the current directory on up to find a .reviewboard file
@@ -51,7 +58,8 @@ class SCMClient(object):
         Returns the generated diff and optional parent diff for this
         repository.
 
-        The returned tuple is (diff_string, parent_diff_string)
+        The returned tuple is (diff, parent_diff), where each is a
+        rbtools.utils.diffs.DiffBuffer, or None if there's no parent diff.
         """
         return (None, None)
 
@@ -61,6 +69,17 @@ class SCMClient(object):
         """
         return (None, None)
 
+    def diff_series(self, revision_range=None, parent_diffs=True):
+        """
+        Returns an iterator over (commit, diff, parent_diff) tuples, one for
+        each commit in the range, for repositories that support posting
+        diff series. The diffs are DiffBuffers, as returned by diff().
+
+        If parent_diffs is False, the parent diffs aren't needed, and are
+        always None.
+        """
+        return iter([])
+
     def _get_server_from_config(self, config, repository_info):
         if 'REVIEWBOARD_URL' in config:
             return config['REVIEWBOARD_URL']
@@ -92,12 +111,14 @@ class RepositoryInfo(object):
     A representation of a source code repository.
     """
     def __init__(self, path=None, base_path=None, supports_changesets=False,
-                 supports_parent_diffs=False, supports_updating_commits=False):
+                 supports_parent_diffs=False, supports_updating_commits=False,
+                 supports_diff_series=False):
         self.path = path
         self.base_path = base_path
         self.supports_changesets = supports_changesets
         self.supports_parent_diffs = supports_parent_diffs
         self.supports_updating_commits = supports_updating_commits
+        self.supports_diff_series = supports_diff_series
         logging.debug("repository info: %s" % self)
 
     def __str__(self):
@@ -158,6 +179,8 @@ def scan_usable_client(options):
         if repository_info:
             break
 
+        tool.close()
+
     if not repository_info:
         if options.repository_url:
             print "No supported repository could be accessed at the supplied "\
@@ -178,6 +201,11 @@ def scan_usable_client(options):
                          "current SCM client.\n")
         sys.exit(1)
 
+    if options.diff_series and not repository_info.supports_diff_series:
+        sys.stderr.write("The --diff-series option is not valid for the "
+                         "current SCM client.\n")
+        sys.exit(1)
+
     if ((options.p4_client or options.p4_port) and
         not isinstance(tool, PerforceClient)):
         sys.stderr.write("The --p4-client and --p4-port options are not valid "
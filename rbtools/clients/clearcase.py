@@ -1,12 +1,17 @@
 import logging
 import os
+import re
 import sys
+import tempfile
+import threading
 
 from rbtools.api.errors import APIError
 from rbtools.clients import SCMClient, RepositoryInfo
-from rbtools.utils.checks import check_gnu_diff, check_install
+from rbtools.utils.checks import check_gnu_diff
+from rbtools.utils.concurrency import imap_ordered
+from rbtools.utils.diffs import DiffBuffer
 from rbtools.utils.filesystem import make_tempfile
-from rbtools.utils.process import die, execute
+from rbtools.utils.process import die, execute, open_process
 
 # This specific import is necessary to handle the paths for
 # cygwin enabled machines.
@@ -17,6 +22,179 @@ else:
     import posixpath as cpath
 
 
+class ClearToolSession(object):
+    """
+    A cleartool process kept running in interactive mode.
+
+    Starting cleartool is expensive, so rather than starting it for every
+    command, commands are written to the stdin of a single process. It's
+    started with -status, so the output of each command is followed by a
+    "Command N returned status S" line, which marks the end of the output
+    and gives the command's exit status.
+
+    cleartool's errors go to a temporary file rather than being mixed in
+    with the output, and are collected once the status line is read, so
+    they're always reported with the command that caused them.
+
+    If the process dies or stops responding, it's started again and the
+    command is retried once.
+    """
+    STATUS_RE = re.compile(r'^(.*)Command \d+ returned status (\d+)$')
+    PROMPT = 'cleartool> '
+    SAFE_ARG_RE = re.compile(r'^[\w@%:/.,+=~-]+$')
+
+    def __init__(self):
+        self._process = None
+        self._errors_file = None
+        self._lock = threading.Lock()
+
+    def is_installed(self):
+        """Return whether cleartool could be started."""
+        try:
+            self._start()
+        except OSError:
+            return False
+
+        return True
+
+    def execute(self, args, split_lines=False, ignore_errors=False,
+                extra_ignore_errors=(), with_errors=True):
+        """Run a cleartool command and return its output.
+
+        This takes the same options as rbtools.utils.process.execute,
+        with args being the arguments to cleartool. When with_errors
+        is True, cleartool's error and warning messages follow the
+        output.
+        """
+        command_line = ' '.join([self._quote(arg) for arg in args])
+        logging.debug('Running in cleartool session: %s' % command_line)
+
+        self._lock.acquire()
+
+        try:
+            try:
+                rc, lines, errors = self._run(command_line)
+            except IOError, e:
+                logging.debug('Restarting cleartool session: %s' % e)
+
+                try:
+                    rc, lines, errors = self._run(command_line)
+                except IOError, e:
+                    die('Failed to execute command: cleartool %s\n%s'
+                        % (command_line, e))
+        finally:
+            self._lock.release()
+
+        if rc and not ignore_errors and rc not in extra_ignore_errors:
+            die('Failed to execute command: cleartool %s\n%s'
+                % (command_line, ''.join(lines + errors)))
+        elif rc:
+            logging.debug('Command exited with rc %s: cleartool %s\n%s---'
+                          % (rc, command_line, ''.join(lines + errors)))
+
+        if with_errors:
+            lines += errors
+
+        if split_lines:
+            return lines
+
+        return ''.join(lines)
+
+    def close(self):
+        """Stop the cleartool process, if it's running."""
+        if self._process:
+            try:
+                self._process.stdin.close()
+                self._process.wait()
+            except (IOError, OSError):
+                pass
+
+            self._process = None
+
+        if self._errors_file:
+            self._errors_file.close()
+            self._errors_file = None
+
+    def _start(self):
+        if not self._process:
+            # stderr is only read once each command has finished, so it
+            # goes to a file. A pipe could fill up and leave cleartool
+            # blocked.
+            errors_file = tempfile.TemporaryFile()
+
+            try:
+                self._process = open_process(['cleartool', '-status'],
+                                             with_errors=False,
+                                             errors_output=errors_file)
+            except OSError:
+                errors_file.close()
+                raise
+
+            self._errors_file = errors_file
+
+    def _run(self, command_line):
+        """Run a command, returning its exit status, output lines and
+        error lines.
+
+        IOError is raised if the process couldn't be talked to, after
+        it's been closed so that the next command starts a new one.
+        """
+        try:
+            self._start()
+            self._process.stdin.write(command_line + '\n')
+            self._process.stdin.flush()
+
+            lines = []
+
+            while True:
+                line = self._process.stdout.readline()
+
+                if not line:
+                    raise IOError('cleartool exited unexpectedly')
+
+                # The prompt for the next command is printed before its
+                # output.
+                while line.startswith(self.PROMPT):
+                    line = line[len(self.PROMPT):]
+
+                m = self.STATUS_RE.match(line.rstrip('\n'))
+
+                if m:
+                    # Output without a trailing newline runs into the
+                    # status line.
+                    if m.group(1):
+                        lines.append(m.group(1))
+
+                    return int(m.group(2)), lines, self._read_errors()
+
+                lines.append(line)
+        except (IOError, OSError), e:
+            self.close()
+            raise IOError(str(e))
+
+    def _read_errors(self):
+        """Return the error lines written since the last command.
+
+        cleartool shares the file's position with us, so rewinding it
+        also makes cleartool write the next command's errors from the
+        start.
+        """
+        self._errors_file.seek(0)
+        errors = self._errors_file.read()
+        self._errors_file.seek(0)
+        self._errors_file.truncate()
+
+        return errors.splitlines(True)
+
+    def _quote(self, arg):
+        if self.SAFE_ARG_RE.match(arg):
+            return arg
+        elif '"' in arg:
+            return "'%s'" % arg
+        else:
+            return '"%s"' % arg
+
+
 class ClearCaseClient(SCMClient):
     """
     A wrapper around the clearcase tool that fetches repository
@@ -25,8 +203,13 @@ class ClearCaseClient(SCMClient):
     """
     viewtype = None
 
+    # The most paths to pass to a single cleartool command.
+    CLEARTOOL_BATCH_SIZE = 100
+
     def __init__(self, **kwargs):
         super(ClearCaseClient, self).__init__(**kwargs)
+        self.cleartool = ClearToolSession()
+        self._oids = {}
 
     def get_repository_info(self):
         """Returns information on the Clear Case repository.
@@ -35,10 +218,10 @@ class ClearCaseClient(SCMClient):
         installed and in the path, and post-review was run
         from inside of the view.
         """
-        if not check_install('cleartool help'):
+        if not self.cleartool.is_installed():
             return None
 
-        viewname = execute(["cleartool", "pwv", "-short"]).strip()
+        viewname = self.cleartool.execute(["pwv", "-short"]).strip()
         if viewname.startswith('** NONE'):
             return None
 
@@ -46,8 +229,9 @@ class ClearCaseClient(SCMClient):
         # and error out if we don't.
         check_gnu_diff()
 
-        property_lines = execute(["cleartool", "lsview", "-full", "-properties",
-                                  "-cview"], split_lines=True)
+        property_lines = self.cleartool.execute(["lsview", "-full",
+                                                 "-properties", "-cview"],
+                                                split_lines=True)
         for line in property_lines:
             properties = line.split(' ')
             if properties[0] == 'Properties:':
@@ -67,13 +251,13 @@ class ClearCaseClient(SCMClient):
                 break
 
         # Find current VOB's tag
-        vobstag = execute(["cleartool", "describe", "-short", "vob:."],
-                            ignore_errors=True).strip()
+        vobstag = self.cleartool.execute(["describe", "-short", "vob:."],
+                                         ignore_errors=True).strip()
         if "Error: " in vobstag:
             die("To generate diff run post-review inside vob.")
 
-        root_path = execute(["cleartool", "pwv", "-root"],
-                              ignore_errors=True).strip()
+        root_path = self.cleartool.execute(["pwv", "-root"],
+                                           ignore_errors=True).strip()
         if "Error: " in root_path:
             die("To generate diff run post-review inside view.")
 
@@ -88,7 +272,8 @@ class ClearCaseClient(SCMClient):
         return ClearCaseRepositoryInfo(path=base_path,
                               base_path=base_path,
                               vobstag=vobstag,
-                              supports_parent_diffs=False)
+                              supports_parent_diffs=False,
+                              cleartool=self.cleartool)
 
     def check_options(self):
         if ((self.options.revision_range or self.options.tracking)
@@ -96,6 +281,9 @@ class ClearCaseClient(SCMClient):
             die("To generate diff using parent branch or by passing revision "
                 "ranges, you must use a dynamic view.")
 
+    def close(self):
+        self.cleartool.close()
+
     def _determine_version(self, version_path):
         """Determine numeric version of revision.
 
@@ -189,8 +377,7 @@ class ClearCaseClient(SCMClient):
         changeset = []
         # We ignore return code 1 in order to
         # omit files that Clear Case can't read.
-        output = execute([
-            "cleartool",
+        output = self.cleartool.execute([
             "lscheckout",
             "-all",
             "-cview",
@@ -211,32 +398,63 @@ class ClearCaseClient(SCMClient):
         This takes into account the changes on the branch owned by the
         current user in all vobs of the current view.
         """
-        changeset = []
+        versions = self._get_branch_versions(branch)
+        changeset = self._iter_described_versions(versions)
+
+        return self._sanitize_branch_changeset(changeset)
+
+    def _get_branch_versions(self, branch):
+        """Return extended paths of all versions made on a branch."""
 
         # We ignore return code 1 in order to
         # omit files that Clear Case can't read.
-        if sys.platform.startswith('win'):
-            CLEARCASE_XPN = '%CLEARCASE_XPN%'
-        else:
-            CLEARCASE_XPN = '$CLEARCASE_XPN'
-
-        output = execute([
-            "cleartool",
+        lines = self.cleartool.execute([
             "find",
             "-all",
             "-version",
             "brtype(%s)" % branch,
-            "-exec",
-            'cleartool descr -fmt ' \
-            r'"%En\t%PVn\t%Vn\n" ' \
-            + CLEARCASE_XPN],
+            "-print"],
+            split_lines=True,
+            extra_ignore_errors=(1,),
+            with_errors=False)
+
+        return [line.rstrip('\n') for line in lines if line.strip()]
+
+    def _iter_described_versions(self, extended_paths):
+        """Yield path, previous and current version of each version.
+
+        Versions are described in batches of CLEARTOOL_BATCH_SIZE with
+        one cleartool call each, as they're read from extended_paths.
+        """
+        batch = []
+
+        for extended_path in extended_paths:
+            batch.append(extended_path)
+
+            if len(batch) == self.CLEARTOOL_BATCH_SIZE:
+                for info in self._describe_versions(batch):
+                    yield info
+
+                batch = []
+
+        if batch:
+            for info in self._describe_versions(batch):
+                yield info
+
+    def _describe_versions(self, extended_paths):
+        # We ignore return code 1 in order to
+        # omit files that Clear Case can't read.
+        output = self.cleartool.execute([
+            "describe",
+            "-fmt",
+            r"%En\t%PVn\t%Vn\n"] + extended_paths,
             extra_ignore_errors=(1,),
             with_errors=False)
 
         if output:
-            changeset = self._construct_changeset(output)
+            return self._construct_changeset(output)
 
-        return self._sanitize_branch_changeset(changeset)
+        return []
 
     def diff(self, files):
         """Performs a diff of the specified file and its previous version."""
@@ -281,8 +499,8 @@ class ClearCaseClient(SCMClient):
 
         # We need oids of files to translate them to paths on reviewboard
         # repository.
-        old_oid = execute(["cleartool", "describe", "-fmt", "%On", old_file])
-        new_oid = execute(["cleartool", "describe", "-fmt", "%On", new_file])
+        old_oid = self._get_oid(old_file)
+        new_oid = self._get_oid(new_file)
 
         if dl == [] or dl[0].startswith("Binary files "):
             if dl == []:
@@ -318,33 +536,112 @@ class ClearCaseClient(SCMClient):
         if dl:
             dl[0] = dl[0].replace(old_tmp, old_dir)
             dl[1] = dl[1].replace(new_tmp, new_dir)
-            old_oid = execute(["cleartool", "describe", "-fmt", "%On",
-                               old_dir])
-            new_oid = execute(["cleartool", "describe", "-fmt", "%On",
-                               new_dir])
+            old_oid = self._get_oid(old_dir)
+            new_oid = self._get_oid(new_dir)
             dl.insert(2, "==== %s %s ====\n" % (old_oid, new_oid))
 
         return dl
 
+    def _get_oid(self, extended_path):
+        """Return oid of element version, describing it if not loaded."""
+        if extended_path not in self._oids:
+            self._oids[extended_path] = self.cleartool.execute(
+                ["describe", "-fmt", "%On", extended_path])
+
+        return self._oids[extended_path]
+
+    def _load_oids(self, extended_paths):
+        """Describe oids of many element versions at once.
+
+        Paths are described in batches of CLEARTOOL_BATCH_SIZE with
+        one cleartool call each.
+        """
+        extended_paths = [path for path in extended_paths
+                          if path not in self._oids]
+
+        for i in range(0, len(extended_paths), self.CLEARTOOL_BATCH_SIZE):
+            self._describe_oids(
+                extended_paths[i:i + self.CLEARTOOL_BATCH_SIZE])
+
+    def _describe_oids(self, batch):
+        """Describe oids of a batch of element versions with one call.
+
+        If cleartool couldn't describe some path in the batch, the
+        output can't be matched up with the paths, so each half of the
+        batch is described again on its own. A path that can't be
+        described by itself is left for _get_oid to report.
+        """
+        oids = self.cleartool.execute(["describe", "-fmt", r"%On\n"] + batch,
+                                      split_lines=True,
+                                      ignore_errors=True,
+                                      with_errors=False)
+
+        if len(oids) == len(batch):
+            for path, oid in zip(batch, oids):
+                self._oids[path] = oid.rstrip('\n')
+        elif len(batch) > 1:
+            logging.debug('Unable to describe oids of %d versions at '
+                          'once; splitting them up' % len(batch))
+            half = len(batch) // 2
+            self._describe_oids(batch[:half])
+            self._describe_oids(batch[half:])
+        else:
+            logging.debug('Unable to describe oid of %s' % batch[0])
+
     def do_diff(self, changeset):
-        """Generates a unified diff for all files in the changeset."""
-
-        diff = []
-        for old_file, new_file in changeset:
-            dl = []
-            if cpath.isdir(new_file):
-                dl = self.diff_directories(old_file, new_file)
-            elif cpath.exists(new_file):
-                dl = self.diff_files(old_file, new_file)
-            else:
+        """Generates a unified diff for all files in the changeset.
+
+        Accessing versions in MVFS is slow, so elements are checked and
+        diffed by several threads at once, and the diffs are put back in
+        changeset order.
+        """
+        elements = []
+        for old_file, new_file, is_dir in imap_ordered(self._check_element,
+                                                       changeset,
+                                                       self.options.jobs):
+            if is_dir is None:
                 logging.error("File %s does not exist or access is denied."
                               % new_file)
-                continue
+            else:
+                elements.append((old_file, new_file, is_dir))
 
+        # Describe all oids up front, rather than with two cleartool calls
+        # for every element.
+        extended_paths = []
+        for old_file, new_file, is_dir in elements:
+            extended_paths += [old_file, new_file]
+
+        self._load_oids(extended_paths)
+
+        diff = DiffBuffer()
+        for dl in imap_ordered(self._diff_element, elements,
+                               self.options.jobs):
             if dl:
-                diff.append(''.join(dl))
+                diff.writelines(dl)
+
+        return (diff, None)
+
+    def _check_element(self, change):
+        """Return the change with whether it's a directory.
+
+        None means the new version can't be accessed.
+        """
+        old_file, new_file = change
+
+        if cpath.isdir(new_file):
+            return (old_file, new_file, True)
+        elif cpath.exists(new_file):
+            return (old_file, new_file, False)
+        else:
+            return (old_file, new_file, None)
 
-        return (''.join(diff), None)
+    def _diff_element(self, element):
+        old_file, new_file, is_dir = element
+
+        if is_dir:
+            return self.diff_directories(old_file, new_file)
+        else:
+            return self.diff_files(old_file, new_file)
 
 
 class ClearCaseRepositoryInfo(RepositoryInfo):
@@ -353,10 +650,12 @@ class ClearCaseRepositoryInfo(RepositoryInfo):
     how to find a matching repository on the server even if the URLs differ.
     """
 
-    def __init__(self, path, base_path, vobstag, supports_parent_diffs=False):
+    def __init__(self, path, base_path, vobstag, supports_parent_diffs=False,
+                 cleartool=None):
         RepositoryInfo.__init__(self, path, base_path,
                                 supports_parent_diffs=supports_parent_diffs)
         self.vobstag = vobstag
+        self.cleartool = cleartool or ClearToolSession()
 
     def find_server_repository_info(self, server):
         """
@@ -385,7 +684,7 @@ class ClearCaseRepositoryInfo(RepositoryInfo):
             logging.debug('Matching repository uuid:%s with path:%s' % (uuid,
                           info['repopath']))
             return ClearCaseRepositoryInfo(info['repopath'],
-                    info['repopath'], uuid)
+                    info['repopath'], uuid, cleartool=self.cleartool)
 
         # We didn't found uuid but if version is >= 1.5.3
         # we can try to use VOB's name hoping it is better
@@ -400,8 +699,8 @@ class ClearCaseRepositoryInfo(RepositoryInfo):
     def _get_vobs_uuid(self, vobstag):
         """Return family uuid of VOB."""
 
-        property_lines = execute(["cleartool", "lsvob", "-long", vobstag],
-                                 split_lines=True)
+        property_lines = self.cleartool.execute(["lsvob", "-long", vobstag],
+                                                split_lines=True)
         for line  in property_lines:
             if line.startswith('Vob family uuid:'):
                 return  line.split(' ')[-1].rstrip()
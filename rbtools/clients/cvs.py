@@ -1,9 +1,12 @@
 import logging
 import os
-import socket
+import time
 
 from rbtools.clients import SCMClient, RepositoryInfo
+from rbtools.utils import resolver
 from rbtools.utils.checks import check_install
+from rbtools.utils.concurrency import imap_ordered
+from rbtools.utils.diffs import DiffBuffer
 from rbtools.utils.process import execute
 
 
@@ -35,13 +38,9 @@ class CVSClient(SCMClient):
         i = repository_path.rfind(":")
         if i != -1:
             host = repository_path[:i]
-            try:
-                canon = socket.getfqdn(host)
-                repository_path = repository_path.replace('%s:' % host,
-                                                          '%s:' % canon)
-            except socket.error, msg:
-                logging.error("failed to get fqdn for %s, msg=%s"
-                              % (host, msg))
+            canon = resolver.getfqdn(host)
+            repository_path = repository_path.replace('%s:' % host,
+                                                      '%s:' % canon)
 
         return RepositoryInfo(path=repository_path)
 
@@ -70,7 +69,123 @@ class CVSClient(SCMClient):
         """
         Performs the actual diff operation through cvs diff, handling
         fake errors generated by CVS.
+
+        When no files are given, cvs diff would walk the whole tree one
+        directory (and one server round trip) at a time. Instead, the
+        directories that may have changes are found locally, and each is
+        diffed on its own, several at once. The diffs are put together in
+        path order.
+
+        Changes between revisions can be anywhere in the tree, not just
+        where there are local changes, so those are diffed with a single
+        recursive cvs diff.
         """
+        options = []
+        files = []
+        i = 0
+
+        while i < len(params):
+            if params[i] in ('-r', '-D'):
+                options += params[i:i + 2]
+                i += 2
+            else:
+                if params[i].startswith('-'):
+                    options.append(params[i])
+                else:
+                    files.append(params[i])
+
+                i += 1
+
+        diff = DiffBuffer()
+
+        if files or [opt for opt in options if opt[:2] in ('-r', '-D')]:
+            diff.write(self._diff_paths(options, files))
+            return diff
+
+        directories = self._find_changed_directories()
+
+        def diff_directory(directory):
+            # -l keeps cvs from recursing into subdirectories, which are
+            # diffed separately.
+            if directory == '.':
+                return self._diff_paths(['-l'] + options, [])
+            else:
+                return self._diff_paths(['-l'] + options, [directory])
+
+        diff.writelines(imap_ordered(diff_directory, directories,
+                                     self.options.jobs))
+        return diff
+
+    def _diff_paths(self, options, paths):
         # Diff returns "1" if differences were found.
-        return execute(["cvs", "diff", "-uN"] + params,
+        return execute(["cvs", "diff", "-uN"] + options + paths,
                         extra_ignore_errors=(1,))
+
+    def _find_changed_directories(self):
+        """
+        Returns the directories in the checkout with files that look
+        changed locally, in path order.
+        """
+        directories = []
+
+        for dirpath, dirnames, filenames in os.walk('.'):
+            # Only descend into directories that are checked out.
+            dirnames[:] = sorted([
+                name for name in dirnames
+                if name != 'CVS' and
+                   os.path.isdir(os.path.join(dirpath, name, 'CVS'))])
+
+            if self._has_local_changes(dirpath):
+                directory = os.path.normpath(dirpath).replace(os.sep, '/')
+                directories.append(directory)
+
+        logging.debug('Diffing %d CVS directories' % len(directories))
+
+        return directories
+
+    def _has_local_changes(self, directory):
+        """
+        Returns whether any file in the directory looks added, removed or
+        modified, going by CVS/Entries.
+
+        Like cvs itself, a file is considered modified if its modification
+        time doesn't match the timestamp recorded when it was checked out.
+        """
+        cvs_dir = os.path.join(directory, 'CVS')
+
+        if os.path.exists(os.path.join(cvs_dir, 'Entries.Log')):
+            # Entries added or removed since Entries was last written.
+            return True
+
+        try:
+            fp = open(os.path.join(cvs_dir, 'Entries'), 'r')
+
+            try:
+                lines = fp.readlines()
+            finally:
+                fp.close()
+        except IOError:
+            return True
+
+        for line in lines:
+            # Each file is listed as /name/revision/timestamp/options/tag.
+            # Directories start with "D" instead.
+            if not line.startswith('/'):
+                continue
+
+            name, revision, timestamp = line.split('/')[1:4]
+
+            if revision == '0' or revision.startswith('-'):
+                # Added or removed.
+                return True
+
+            try:
+                mtime = os.stat(os.path.join(directory, name)).st_mtime
+            except OSError:
+                # Lost.
+                return True
+
+            if timestamp != time.asctime(time.gmtime(mtime)):
+                return True
+
+        return False
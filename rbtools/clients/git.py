@@ -4,8 +4,11 @@ import sys
 
 from rbtools.clients import SCMClient, RepositoryInfo
 from rbtools.clients.svn import SVNClient, SVNRepositoryInfo
+from rbtools.utils.cache import FileCache
 from rbtools.utils.checks import check_install
-from rbtools.utils.process import die, execute
+from rbtools.utils.diffs import DiffBuffer
+from rbtools.utils.filesystem import get_cache_path, make_tempfile
+from rbtools.utils.process import die, execute, execute_stream
 
 
 class GitClient(SCMClient):
@@ -14,6 +17,14 @@ class GitClient(SCMClient):
     compatible diffs. This will attempt to generate a diff suitable for the
     remote repository, whether git, SVN or Perforce.
     """
+    GIT_DIFF_ARGS = ["--no-color", "--full-index", "--no-ext-diff",
+                     "--ignore-submodules"]
+    SVN_DIFF_ARGS = ["--no-color", "--no-prefix", "--no-ext-diff", "-r", "-u"]
+
+    # The largest diff that's cached. A bigger one would push most of the
+    # other diffs out of the cache.
+    DIFF_CACHE_MAX_SIZE = 64 * 1024 * 1024
+
     def __init__(self, **kwargs):
         super(GitClient, self).__init__(**kwargs)
         # Store the 'correct' way to invoke git, just plain old 'git' by
@@ -22,6 +33,7 @@ class GitClient(SCMClient):
         # This is used to communicate the revisions in the diff to
         # update_commits_with_reviewer_info().
         self.rev_range_for_diff = None
+        self._diff_cache = None
 
     def _strip_heads_prefix(self, ref):
         """ Strips prefix from ref name, if possible """
@@ -281,7 +293,8 @@ class GitClient(SCMClient):
             self.type = "git"
             return RepositoryInfo(path=self._github_paths(url), base_path='',
                                   supports_parent_diffs=True,
-                                  supports_updating_commits=True)
+                                  supports_updating_commits=True,
+                                  supports_diff_series=True)
 
         return None
 
@@ -364,6 +377,9 @@ class GitClient(SCMClient):
     def make_diff(self, ancestor, commit=""):
         """
         Performs a diff on a particular branch range.
+
+        The diff is streamed from git into a DiffBuffer. Diffs between two
+        commits are also streamed into the cache, when they can be.
         """
         if commit:
             rev_range = "%s..%s" % (ancestor, commit)
@@ -371,16 +387,179 @@ class GitClient(SCMClient):
             rev_range = ancestor
 
         if self.type == "svn":
-            diff_lines = execute([self.git, "diff", "--no-color",
-                                  "--no-prefix", "--no-ext-diff", "-r", "-u",
-                                  rev_range],
-                                 split_lines=True)
-            return self.make_svn_diff(ancestor, diff_lines)
+            diff_args = self.SVN_DIFF_ARGS
         elif self.type == "git":
-            return execute([self.git, "diff", "--no-color", "--full-index",
-                            "--no-ext-diff", "--ignore-submodules", rev_range])
+            diff_args = self.GIT_DIFF_ARGS
+        else:
+            return None
 
-        return None
+        # Diffs between two commits never change, so they can be cached.
+        # Diffs against the working tree can't.
+        cache_key = None
+
+        if commit and self.options.diff_cache:
+            cache_key = self._get_diff_cache_key(ancestor, commit, diff_args)
+
+            if cache_key:
+                diff = DiffBuffer()
+
+                if self._get_diff_cache().read_into(cache_key, diff):
+                    return diff
+
+                diff.close()
+
+        diff_lines = execute_stream([self.git, "diff"] + diff_args +
+                                    [rev_range])
+
+        if self.type == "svn":
+            diff = self.make_svn_diff(ancestor, diff_lines)
+        else:
+            diff = DiffBuffer()
+            diff.writelines(diff_lines)
+
+        if (cache_key and diff is not None and
+            len(diff) <= self.DIFF_CACHE_MAX_SIZE):
+            self._get_diff_cache().set_blocks(cache_key, diff.iter_blocks())
+
+        return diff
+
+    def _get_diff_cache_key(self, ancestor, commit, diff_args):
+        """
+        Returns the diff cache key for a range of commits.
+
+        The key is made from the SHA-1s the commits resolve to, so it never
+        matches a stale diff, no matter how branches have moved. Returns
+        None if the commits can't be resolved.
+        """
+        shas = execute([self.git, "rev-parse", "%s^{commit}" % ancestor,
+                        "%s^{commit}" % commit],
+                       ignore_errors=True, none_on_ignored_error=True,
+                       with_errors=False)
+
+        if not shas:
+            return None
+
+        shas = shas.split()
+
+        if len(shas) != 2:
+            return None
+
+        return (self.type, shas[0], shas[1], ' '.join(diff_args))
+
+    def _get_diff_cache(self):
+        if not self._diff_cache:
+            self._diff_cache = FileCache(get_cache_path('git-diffs'))
+
+        return self._diff_cache
+
+    def diff_series(self, revision_range=None, parent_diffs=True):
+        """
+        Generates a separate diff for every commit in a range, so that each
+        commit can be posted as its own review request.
+
+        The range defaults to everything on the branch since the merge base
+        (or --parent), but may be given as "r1:r2" or as a single starting
+        revision. Merge commits are skipped.
+
+        This yields (commit, diff, parent_diff) tuples, oldest commit first.
+        All patches come from a single 'git diff-tree --stdin' process, and
+        each one is yielded as soon as it has been read. The parent diff
+        covers everything between the merge base and the commit's parent,
+        so that every diff in the series applies against the repository.
+
+        Each parent diff is a full diff of its own, so they're only made
+        when parent_diffs is True, and never for commits with empty diffs,
+        which can't be posted.
+        """
+        head_ref = "HEAD"
+        if self.head_ref:
+            head_ref = self.head_ref
+
+        self.merge_base = execute([self.git, "merge-base",
+                                   self.upstream_branch,
+                                   head_ref]).strip()
+
+        if not revision_range:
+            start_rev = self.options.parent_branch or self.merge_base
+            end_rev = head_ref
+        elif ":" in revision_range:
+            start_rev, end_rev = revision_range.split(":")
+        else:
+            start_rev = revision_range
+            end_rev = head_ref
+
+        # Each line is "<commit> <first parent> [<other parents>...]".
+        commits = []
+
+        for line in execute([self.git, "rev-list", "--reverse", "--parents",
+                             "--no-merges", "%s..%s" % (start_rev, end_rev)],
+                            split_lines=True):
+            parts = line.split()
+
+            if len(parts) > 1:
+                commits.append((parts[0], parts[1]))
+
+        if not commits:
+            return
+
+        summary = self.options.summary
+        description = self.options.description
+        commit_list = make_tempfile(''.join(['%s\n' % commit
+                                             for commit, parent in commits]))
+        commit_fp = open(commit_list, 'r')
+
+        try:
+            # --always makes diff-tree print the commit ID even for commits
+            # with an empty diff, so every commit we asked for shows up in
+            # the output, in order, as the header of its patch.
+            lines = execute_stream([self.git, "diff-tree", "--stdin",
+                                    "--always", "--root", "-p"] +
+                                   self.GIT_DIFF_ARGS,
+                                   stdin=commit_fp)
+            i = 0
+            patch = None
+
+            for line in lines:
+                if (i < len(commits) and
+                    line.rstrip('\n') == commits[i][0]):
+                    if patch is not None:
+                        yield self._make_series_entry(commits[i - 1], patch,
+                                                      parent_diffs, summary,
+                                                      description)
+
+                    i += 1
+                    patch = DiffBuffer()
+                elif patch is not None:
+                    patch.write(line)
+
+            if patch is not None:
+                yield self._make_series_entry(commits[i - 1], patch,
+                                              parent_diffs, summary,
+                                              description)
+        finally:
+            commit_fp.close()
+
+    def _make_series_entry(self, commit_info, patch, parent_diffs, summary,
+                           description):
+        """
+        Builds the (commit, diff, parent_diff) tuple for one commit of a
+        diff series, and sets the summary and description for it.
+        """
+        commit, parent = commit_info
+
+        if not parent_diffs or len(patch) == 0 or parent == self.merge_base:
+            parent_diff = None
+        else:
+            parent_diff = self.make_diff(self.merge_base, parent)
+
+        # Each commit in the series gets its own guessed fields, unless they
+        # were explicitly provided.
+        self.options.summary = summary
+        self.options.description = description
+        self.rev_range_for_diff = (parent, commit)
+        self._set_guesses(self.rev_range_for_diff)
+
+        return (commit, patch, parent_diff)
 
     def make_svn_diff(self, parent_branch, diff_lines):
         """
@@ -393,7 +572,7 @@ class GitClient(SCMClient):
         if not rev:
             return None
 
-        diff_data = ""
+        diff_data = DiffBuffer()
         filename = ""
         newfile = False
 
@@ -404,9 +583,9 @@ class GitClient(SCMClient):
                 #
                 # diff --git a/path/to/file b/path/to/file
                 info = line.split(" ")
-                diff_data += "Index: %s\n" % info[2]
-                diff_data += "=" * 67
-                diff_data += "\n"
+                diff_data.write("Index: %s\n" % info[2])
+                diff_data.write("=" * 67)
+                diff_data.write("\n")
             elif line.startswith("index "):
                 # Filter this out.
                 pass
@@ -415,26 +594,28 @@ class GitClient(SCMClient):
                 newfile = True
             elif line.startswith("--- "):
                 newfile = False
-                diff_data += "--- %s\t(revision %s)\n" % \
-                             (line[4:].strip(), rev)
+                diff_data.write("--- %s\t(revision %s)\n" %
+                                (line[4:].strip(), rev))
             elif line.startswith("+++ "):
                 filename = line[4:].strip()
                 if newfile:
-                    diff_data += "--- %s\t(revision 0)\n" % filename
-                    diff_data += "+++ %s\t(revision 0)\n" % filename
+                    diff_data.write("--- %s\t(revision 0)\n" % filename)
+                    diff_data.write("+++ %s\t(revision 0)\n" % filename)
                 else:
                     # We already printed the "--- " line.
-                    diff_data += "+++ %s\t(working copy)\n" % filename
+                    diff_data.write("+++ %s\t(working copy)\n" % filename)
             elif line.startswith("new file mode"):
                 # Filter this out.
                 pass
             elif line.startswith("Binary files "):
                 # Add the following so that we know binary files were
                 # added/changed.
-                diff_data += "Cannot display: file marked as a binary type.\n"
-                diff_data += "svn:mime-type = application/octet-stream\n"
+                diff_data.write("Cannot display: file marked as a binary "
+                                "type.\n")
+                diff_data.write("svn:mime-type = "
+                                "application/octet-stream\n")
             else:
-                diff_data += line
+                diff_data.write(line)
 
         return diff_data
 
@@ -1,11 +1,215 @@
 import logging
 import os
 import re
+import struct
+import sys
 
 from rbtools.clients import SCMClient, RepositoryInfo
 from rbtools.clients.svn import SVNClient
-from rbtools.utils.checks import check_install
-from rbtools.utils.process import execute
+from rbtools.utils.checks import find_exe_in_path, is_exe_in_path
+from rbtools.utils.diffs import DiffBuffer
+from rbtools.utils.process import die, execute, execute_stream, \
+                                  open_process
+
+
+class MercurialCommandServer(object):
+    """
+    Runs hg commands through a Mercurial command server.
+
+    Every hg command starts a Python interpreter and loads the repository,
+    which takes a good part of the time of most commands. A command server
+    (hg serve --cmdserver pipe) does that once, and then runs the commands
+    written to its stdin, sending back their output and exit status over
+    its stdout with the channel protocol.
+
+    The command server is started with the first command. If it isn't
+    available (it needs Mercurial 1.9 or newer) or stops responding,
+    commands are run with execute() instead.
+    """
+    def __init__(self, env):
+        self.env = env
+        self._process = None
+        self._available = True
+
+    def execute(self, args, split_lines=False, ignore_errors=False,
+                extra_ignore_errors=(), translate_newlines=True,
+                with_errors=True, none_on_ignored_error=False):
+        """
+        Runs hg with the given arguments, taking the same options as
+        rbtools.utils.process.execute.
+        """
+        if not self._available:
+            return execute(['hg'] + args, env=self.env,
+                           split_lines=split_lines,
+                           ignore_errors=ignore_errors,
+                           extra_ignore_errors=extra_ignore_errors,
+                           translate_newlines=translate_newlines,
+                           with_errors=with_errors,
+                           none_on_ignored_error=none_on_ignored_error)
+
+        logging.debug('Running in command server: hg %s' % ' '.join(args))
+
+        output = []
+
+        try:
+            rc = self._run(args, with_errors, output.append)
+        except (IOError, OSError, ValueError, struct.error), e:
+            logging.debug('Unable to use the Mercurial command server: %s'
+                          % e)
+            self.close()
+            self._available = False
+
+            return self.execute(args, split_lines, ignore_errors,
+                                extra_ignore_errors, translate_newlines,
+                                with_errors, none_on_ignored_error)
+
+        output = ''.join(output)
+
+        if translate_newlines:
+            output = output.replace('\r\n', '\n').replace('\r', '\n')
+
+        if rc and not ignore_errors and rc not in extra_ignore_errors:
+            die('Failed to execute command: %s\n%s' % (['hg'] + args, output))
+        elif rc:
+            logging.debug('Command exited with rc %s: %s\n%s---'
+                          % (rc, ['hg'] + args, output))
+
+        if rc and none_on_ignored_error:
+            return None
+
+        if split_lines:
+            return output.splitlines(True)
+
+        return output
+
+    def execute_diff(self, args):
+        """
+        Runs an hg command that prints a diff, returning the output in a
+        DiffBuffer. The output is written to the DiffBuffer as it arrives,
+        rather than being held in memory as a whole.
+        """
+        if self._available:
+            logging.debug('Running in command server: hg %s'
+                          % ' '.join(args))
+
+            diff = DiffBuffer()
+            pending_cr = ['']
+
+            def write(data):
+                # A \r\n may be split between two blocks of output.
+                data = pending_cr[0] + data
+                pending_cr[0] = ''
+
+                if data.endswith('\r'):
+                    data = data[:-1]
+                    pending_cr[0] = '\r'
+
+                diff.write(data.replace('\r\n', '\n').replace('\r', '\n'))
+
+            try:
+                rc = self._run(args, True, write)
+            except (IOError, OSError, ValueError, struct.error), e:
+                logging.debug('Unable to use the Mercurial command server: '
+                              '%s' % e)
+                diff.close()
+                self.close()
+                self._available = False
+            else:
+                if rc:
+                    die('Failed to execute command: %s' % (['hg'] + args,))
+
+                if pending_cr[0]:
+                    diff.write('\n')
+
+                return diff
+
+        diff = DiffBuffer()
+        diff.writelines(execute_stream(['hg'] + args, env=self.env))
+        return diff
+
+    def close(self):
+        """Stops the command server, if it's running."""
+        if self._process:
+            try:
+                self._process.stdin.close()
+                self._process.wait()
+            except (IOError, OSError):
+                pass
+
+            self._process = None
+
+    def _start(self):
+        if self._process:
+            return
+
+        # Errors from commands come over the 'e' channel, so nothing of
+        # use is written to stderr, and a pipe that's never read could
+        # fill up and leave the server blocked.
+        devnull = open(os.devnull, 'w')
+
+        try:
+            self._process = open_process(
+                ['hg', 'serve', '--cmdserver', 'pipe'], env=dict(self.env),
+                with_errors=False, translate_newlines=False,
+                errors_output=devnull)
+        finally:
+            devnull.close()
+
+        # The server starts by saying hello, listing what it can do.
+        channel, hello = self._read_channel()
+        capabilities = []
+
+        for line in hello.splitlines():
+            if line.startswith('capabilities:'):
+                capabilities = line.split()[1:]
+
+        if channel != 'o' or 'runcommand' not in capabilities:
+            raise ValueError('Unexpected hello: %r' % hello)
+
+    def _run(self, args, with_errors, write):
+        """
+        Runs a command, passing each block of its output to write, and
+        returns its exit status.
+        """
+        self._start()
+
+        data = '\0'.join(args)
+        self._process.stdin.write('runcommand\n' +
+                                  struct.pack('>I', len(data)) + data)
+        self._process.stdin.flush()
+
+        while True:
+            channel, data = self._read_channel()
+
+            if channel == 'o' or (channel == 'e' and with_errors):
+                write(data)
+            elif channel == 'r':
+                return struct.unpack('>i', data)[0]
+            elif channel in ('I', 'L'):
+                # Nothing should prompt us for input. Tell it there is none.
+                self._process.stdin.write(struct.pack('>I', 0))
+                self._process.stdin.flush()
+            elif channel.isupper():
+                raise ValueError('Unexpected required channel %r' % channel)
+
+    def _read_channel(self):
+        header = self._process.stdout.read(5)
+
+        if len(header) < 5:
+            raise IOError('The command server exited')
+
+        channel, length = struct.unpack('>cI', header)
+
+        if channel in ('I', 'L'):
+            # The length is the most input wanted, and there's no data.
+            return channel, ''
+
+        data = self._process.stdout.read(length)
+
+        if len(data) < length:
+            raise IOError('The command server exited')
+
+        return channel, data
 
 
 class MercurialClient(SCMClient):
@@ -26,6 +230,10 @@ class MercurialClient(SCMClient):
             'HGPLAIN': '1',
         }
 
+        # Commands run with self._hg_env go through a command server, so
+        # hg only starts once.
+        self._cmdserver = MercurialCommandServer(self._hg_env)
+
         # `self._remote_path_candidates` is an ordered set of hgrc
         # paths that are checked if `parent_branch` option is not given
         # explicitly.  The first candidate found to exist will be used,
@@ -33,22 +241,34 @@ class MercurialClient(SCMClient):
         self._remote_path_candidates = ['reviewboard', 'origin', 'parent',
                                         'default']
 
-    def get_repository_info(self):
-        if not check_install('hg --help'):
-            return None
+    # Matches the lines of an hgrc, the same way Mercurial does.
+    HGRC_SECTION_RE = re.compile(r'\[([^\[]+)\]')
+    HGRC_ITEM_RE = re.compile(r'([^=\s][^=]*?)\s*=\s*(.*\S|)')
+    HGRC_CONTINUATION_RE = re.compile(r'\s+(\S|\S.*\S)\s*$')
+    HGRC_EMPTY_RE = re.compile(r'(;|#|\s*$)')
+    HGRC_UNSET_RE = re.compile(r'%unset\s+(\S+)')
+    HGRC_INCLUDE_RE = re.compile(r'%include\s+(\S|\S.*\S)\s*$')
 
-        self._load_hgrc()
+    def close(self):
+        self._cmdserver.close()
 
+    def get_repository_info(self):
         if not self.hg_root:
-            # hg aborted => no mercurial repository here.
+            # No .hg directory => no mercurial repository here.
+            return None
+
+        if not is_exe_in_path('hg'):
             return None
 
-        svn_info = execute(["hg", "svn", "info"], ignore_errors=True)
+        self._load_hgrc()
+
+        if self._uses_hgsubversion():
+            svn_info = execute(["hg", "svn", "info"], ignore_errors=True)
 
-        if (not svn_info.startswith('abort:') and
-            not svn_info.startswith("hg: unknown command") and
-            not svn_info.lower().startswith('not a child of')):
-            return self._calculate_hgsubversion_repository_info(svn_info)
+            if (not svn_info.startswith('abort:') and
+                not svn_info.startswith("hg: unknown command") and
+                not svn_info.lower().startswith('not a child of')):
+                return self._calculate_hgsubversion_repository_info(svn_info)
 
         self._type = 'hg'
 
@@ -99,45 +319,246 @@ class MercurialClient(SCMClient):
         return RepositoryInfo(path=path, base_path=base_path,
                               supports_parent_diffs=True)
 
+    def _uses_hgsubversion(self):
+        """
+        Returns whether the repository looks like an hgsubversion clone,
+        going by the metadata hgsubversion keeps in it and its paths.
+        """
+        hg_dir = os.path.join(self.hg_root, '.hg')
+
+        if os.path.isdir(os.path.join(hg_dir, 'svn')):
+            return True
+
+        try:
+            fp = open(os.path.join(hg_dir, 'requires'), 'r')
+
+            try:
+                if 'subversion' in fp.read().split():
+                    return True
+            finally:
+                fp.close()
+        except IOError:
+            pass
+
+        for key, value in self.hgrc.iteritems():
+            if key.startswith('paths.') and value.startswith('svn'):
+                return True
+
+        return False
+
     @property
     def hg_root(self):
         if not self._hg_root:
-            root = execute(['hg', 'root'], env=self._hg_env,
-                           ignore_errors=True)
+            # Find the repository the same way hg does, by looking for a
+            # .hg directory in the current directory and its parents.
+            path = os.getcwd()
 
-            if not root.startswith('abort:'):
-                self._hg_root = root.strip()
-            else:
-                return None
+            while not os.path.isdir(os.path.join(path, '.hg')):
+                parent = os.path.dirname(path)
+
+                if parent == path:
+                    return None
+
+                path = parent
+
+            self._hg_root = path
 
         return self._hg_root
 
     def _load_hgrc(self):
-        for line in execute(['hg', 'showconfig'], split_lines=True):
-            key, value = line.split('=', 1)
-            self.hgrc[key] = value.strip()
+        """
+        Loads the configuration hg would use in this repository, reading
+        the hgrc files directly rather than running hg showconfig.
+
+        If any of the files can't be read or parsed, hg showconfig is run
+        after all, so nothing hg would have found is lost.
+        """
+        for filename in self._get_hgrc_paths():
+            if not self._read_hgrc(filename):
+                logging.debug('Unable to read %s; running hg showconfig'
+                              % filename)
+                self._load_showconfig()
+                return
+
+    def _load_showconfig(self):
+        """
+        Loads the configuration by running hg showconfig, keeping what was
+        read from the hgrc files if that fails.
+        """
+        lines = execute(['hg', 'showconfig'], split_lines=True,
+                        ignore_errors=True, with_errors=False,
+                        none_on_ignored_error=True)
+
+        if lines is None:
+            return
+
+        self.hgrc = {}
+        key = None
+
+        for line in lines:
+            if '=' in line:
+                key, value = line.split('=', 1)
+                self.hgrc[key] = value.strip()
+            elif key:
+                # The rest of a value spanning several lines.
+                self.hgrc[key] += '\n' + line.strip()
+
+    def _get_hgrc_paths(self):
+        """
+        Returns the hgrc files hg reads, in the order it reads them.
+        """
+        filenames = []
+
+        if 'HGRCPATH' in os.environ:
+            rcpaths = [path for path in
+                       os.environ['HGRCPATH'].split(os.pathsep) if path]
+        elif sys.platform.startswith('win'):
+            # hg reads the system-wide configuration from the directory
+            # hg.exe is installed in.
+            hg_exe = find_exe_in_path('hg')
+            home = os.path.expanduser('~')
+            rcpaths = []
+
+            if hg_exe:
+                install_dir = os.path.dirname(hg_exe)
+                rcpaths += [
+                    os.path.join(install_dir, 'mercurial.ini'),
+                    os.path.join(install_dir, 'hgrc.d'),
+                ]
+
+            rcpaths += [
+                os.path.join(home, 'mercurial.ini'),
+                os.path.join(home, '.hgrc'),
+            ]
+        else:
+            # Like on Windows, hg first reads the configuration in the
+            # prefix it's installed under, such as /usr/local.
+            hg_exe = find_exe_in_path('hg')
+            rcpaths = []
+
+            if hg_exe:
+                prefix = os.path.dirname(os.path.dirname(hg_exe))
+
+                if prefix != '/':
+                    rcpaths += [
+                        os.path.join(prefix, 'etc', 'mercurial', 'hgrc'),
+                        os.path.join(prefix, 'etc', 'mercurial', 'hgrc.d'),
+                    ]
+
+            rcpaths += [
+                '/etc/mercurial/hgrc',
+                '/etc/mercurial/hgrc.d',
+                os.path.expanduser('~/.hgrc'),
+            ]
+
+        for path in rcpaths:
+            path = os.path.expanduser(path)
+
+            if os.path.isdir(path):
+                filenames += [os.path.join(path, name)
+                              for name in sorted(os.listdir(path))
+                              if name.endswith('.rc')]
+            else:
+                filenames.append(path)
+
+        if self.hg_root:
+            filenames.append(os.path.join(self.hg_root, '.hg', 'hgrc'))
+
+        return filenames
+
+    def _read_hgrc(self, filename):
+        """
+        Reads an hgrc file into self.hgrc, keyed by "section.name" like the
+        output of hg showconfig. Returns False if the file, or a file it
+        includes, exists but can't be read or parsed.
+        """
+        if not os.path.exists(filename):
+            return True
+
+        try:
+            fp = open(filename, 'r')
+
+            try:
+                lines = fp.readlines()
+            finally:
+                fp.close()
+        except IOError:
+            return False
+
+        section = ''
+        key = None
+
+        for line in lines:
+            line = line.rstrip('\r\n')
+
+            m = self.HGRC_CONTINUATION_RE.match(line)
+
+            if key and m:
+                self.hgrc[key] += '\n' + m.group(1)
+                continue
+
+            key = None
+
+            if self.HGRC_EMPTY_RE.match(line):
+                continue
+
+            m = self.HGRC_INCLUDE_RE.match(line)
+
+            if m:
+                include = os.path.expandvars(os.path.expanduser(m.group(1)))
+
+                if not self._read_hgrc(os.path.join(os.path.dirname(filename),
+                                                    include)):
+                    return False
+
+                continue
+
+            m = self.HGRC_SECTION_RE.match(line)
+
+            if m:
+                section = m.group(1)
+                continue
+
+            m = self.HGRC_ITEM_RE.match(line)
+
+            if m:
+                key = '%s.%s' % (section, m.group(1))
+                self.hgrc[key] = m.group(2)
+                continue
+
+            m = self.HGRC_UNSET_RE.match(line)
+
+            if m:
+                self.hgrc.pop('%s.%s' % (section, m.group(1)), None)
+                continue
+
+            logging.debug('Unable to parse line in %s: %r'
+                          % (filename, line))
+            return False
+
+        return True
 
     def extract_summary(self, revision):
         """
         Extracts the first line from the description of the given changeset.
         """
-        return execute(['hg', 'log', '-r%s' % revision, '--template',
-                        r'{desc|firstline}'], env=self._hg_env)
+        return self._cmdserver.execute(['log', '-r%s' % revision,
+                                        '--template', r'{desc|firstline}'])
 
     def extract_description(self, rev1, rev2):
         """
         Extracts all descriptions in the given revision range and concatenates
         them, most recent ones going first.
         """
-        numrevs = len(execute([
-            'hg', 'log', '-r%s:%s' % (rev2, rev1),
-            '--follow', '--template', r'{rev}\n'], env=self._hg_env
+        numrevs = len(self._cmdserver.execute([
+            'log', '-r%s:%s' % (rev2, rev1),
+            '--follow', '--template', r'{rev}\n']
         ).strip().split('\n'))
 
-        return execute(['hg', 'log', '-r%s:%s' % (rev2, rev1),
-                        '--follow', '--template',
-                        r'{desc}\n\n', '--limit',
-                        str(numrevs - 1)], env=self._hg_env).strip()
+        return self._cmdserver.execute(['log', '-r%s:%s' % (rev2, rev1),
+                                        '--follow', '--template',
+                                        r'{desc}\n\n', '--limit',
+                                        str(numrevs - 1)]).strip()
 
     def diff(self, files):
         """
@@ -163,7 +584,10 @@ class MercurialClient(SCMClient):
         if self.options.guess_description and not self.options.description:
             self.options.description = self.extract_description(parent, ".")
 
-        return (execute(["hg", "diff", "--svn", '-r%s:.' % parent]), None)
+        diff = DiffBuffer()
+        diff.writelines(execute_stream(["hg", "diff", "--svn",
+                                        '-r%s:.' % parent]))
+        return (diff, None)
 
     def _get_outgoing_diff(self, files):
         """
@@ -184,6 +608,11 @@ class MercurialClient(SCMClient):
             - get the name of the current branch
             - get a list of outgoing changesets, specifying a custom format
             - filter outgoing changesets by the current branch name
+
+        Unless --hg-remote-outgoing, --parent or a "reviewboard" path is
+        given, the outgoing changesets are the draft changesets on the
+        current branch, which are found without contacting the remote (see
+        _get_draft_changesets).
             - get the "top" and "bottom" outgoing changesets
             - use these changesets as arguments to `hg diff -r <rev> -r <rev>`
 
@@ -199,33 +628,88 @@ class MercurialClient(SCMClient):
         if not remote and self.options.parent_branch:
             remote = self.options.parent_branch
 
-        current_branch = execute(['hg', 'branch'], env=self._hg_env).strip()
+        current_branch = self._cmdserver.execute(['branch']).strip()
 
-        outgoing_changesets = \
-            self._get_outgoing_changesets(current_branch, remote)
+        outgoing_changesets = None
 
+        # Draft changesets can't tell us what's missing from a particular
+        # remote, so an explicitly chosen one is always compared with.
+        if (not self.options.hg_remote_outgoing and
+            not self.options.parent_branch and
+            remote != 'reviewboard'):
+            outgoing_changesets = self._get_draft_changesets(current_branch)
+
+        if outgoing_changesets is None:
+            outgoing_changesets = \
+                self._get_outgoing_changesets(current_branch, remote)
 
         if outgoing_changesets:
+            outgoing_info = self._get_changesets_info(outgoing_changesets)
             top_rev, bottom_rev = \
-                self._get_top_and_bottom_outgoing_revs(outgoing_changesets)
+                self._get_top_and_bottom_outgoing_revs(outgoing_changesets,
+                                                       outgoing_info)
         else:
+            outgoing_info = {}
             top_rev = None
             bottom_rev = None
 
         if self.options.guess_summary and not self.options.summary:
-            self.options.summary = self.extract_summary(top_rev)
+            if top_rev in outgoing_info:
+                desc = outgoing_info[top_rev]['desc']
+                self.options.summary = (desc.splitlines() or [''])[0]
+            else:
+                self.options.summary = self.extract_summary(top_rev)
 
         if self.options.guess_description and not self.options.description:
-            self.options.description = self.extract_description(bottom_rev,
-                                                                 top_rev)
+            if outgoing_info:
+                # Like extract_description, most recent ones going first.
+                descs = [outgoing_info[rev]['desc']
+                         for rev in sorted(outgoing_info, reverse=True)
+                         if rev > bottom_rev]
+                self.options.description = \
+                    ''.join(['%s\n\n' % d for d in descs]).strip()
+            else:
+                self.options.description = \
+                    self.extract_description(bottom_rev, top_rev)
 
         if bottom_rev is not None and top_rev is not None:
-            full_command = ['hg', 'diff', '-r', str(bottom_rev), '-r',
+            full_command = ['diff', '-r', str(bottom_rev), '-r',
                             str(top_rev)] + files
 
-            return (execute(full_command, env=self._hg_env), None)
+            return (self._cmdserver.execute_diff(full_command), None)
         else:
-            return ("", None)
+            return (DiffBuffer(), None)
+
+    def _get_draft_changesets(self, current_branch):
+        """
+        Given the current branch name, return a list of the draft changeset
+        numbers on it, or None if this version of Mercurial has no phases.
+
+        Changesets stay draft until they're pushed to (or pulled from) a
+        publishing repository, so these are the outgoing changesets, found
+        without a round trip to the remote. This isn't true for clones of
+        non-publishing repositories, where pushed changesets stay draft,
+        which is what --hg-remote-outgoing is for.
+        """
+        branch = current_branch.replace('\\', '\\\\').replace("'", "\\'")
+        raw_drafts = self._cmdserver.execute(['log', '-r',
+                                              "draft() and branch('%s')"
+                                              % branch,
+                                              '--template', r'{rev}\n'],
+                                             ignore_errors=True,
+                                             with_errors=False,
+                                             none_on_ignored_error=True)
+
+        if raw_drafts is None:
+            logging.debug('Unable to find draft changesets. Falling back '
+                          'to hg outgoing.')
+            return None
+
+        draft_changesets = sorted([int(rev) for rev in raw_drafts.split()])
+        logging.debug('Found draft changesets %r for branch %r'
+                      % (draft_changesets, current_branch))
+
+        return draft_changesets
 
     def _get_outgoing_changesets(self, current_branch, remote):
         """
@@ -236,10 +720,11 @@ class MercurialClient(SCMClient):
         # We must handle the special case where there are no outgoing commits
         # as mercurial has a non-zero return value in this case.
         outgoing_changesets = []
-        raw_outgoing = execute(['hg', '-q', 'outgoing', '--template',
-                                'b:{branches}\nr:{rev}\n\n', remote],
-                               env=self._hg_env,
-                               extra_ignore_errors=(1,))
+        raw_outgoing = self._cmdserver.execute(['-q', 'outgoing',
+                                                '--template',
+                                                'b:{branches}\nr:{rev}\n\n',
+                                                remote],
+                                               extra_ignore_errors=(1,))
 
         for pair in raw_outgoing.split('\n\n'):
             if not pair.strip():
@@ -261,20 +746,48 @@ class MercurialClient(SCMClient):
 
         return outgoing_changesets
 
-    def _get_top_and_bottom_outgoing_revs(self, outgoing_changesets):
+    def _get_changesets_info(self, revs):
+        """
+        Given a list of changeset numbers, return a dict mapping each of
+        them to its explicit parents and description, fetched with a single
+        `hg log`.
+
+        The changesets are asked for as one range of revision numbers, so
+        the command line stays short however many there are. Changesets in
+        the range that weren't asked for are left out.
+        """
+        revs = set(revs)
+        command = ['log', '--template', r'{rev}\0{parents}\0{desc}\0',
+                   '-r', '%d:%d' % (min(revs), max(revs))]
+
+        fields = self._cmdserver.execute(command).split('\0')
+        info = {}
+
+        for i in range(0, len(fields) - 2, 3):
+            rev = int(fields[i])
+
+            if rev not in revs:
+                continue
+
+            parents = re.split(':[^\s]+\s*', fields[i + 1])
+
+            info[rev] = {
+                'parents': [int(p) for p in parents if p != ''],
+                'desc': fields[i + 2],
+            }
+
+        return info
+
+    def _get_top_and_bottom_outgoing_revs(self, outgoing_changesets,
+                                          outgoing_info):
         # This is a classmethod rather than a func mostly just to keep the
         # module namespace clean.  Pylint told me to do it.
         top_rev = max(outgoing_changesets)
         bottom_rev = min(outgoing_changesets)
 
         for rev in reversed(outgoing_changesets):
-            parents = execute(["hg", "log", "-r", str(rev),
-                               "--template", "{parents}"],
-                               env=self._hg_env)
-            parents = re.split(':[^\s]+\s*', parents)
-            parents = [int(p) for p in parents if p != '']
-
-            parents = [p for p in parents if p not in outgoing_changesets]
+            parents = [p for p in outgoing_info[rev]['parents']
+                       if p not in outgoing_changesets]
 
             if len(parents) > 0:
                 bottom_rev = parents[0]
@@ -311,8 +824,8 @@ class MercurialClient(SCMClient):
         if self.options.guess_description and not self.options.description:
             self.options.description = self.extract_description(r1, r2)
 
-        return (execute(["hg", "diff", "-r", r1, "-r", r2],
-                        env=self._hg_env), None)
+        return (self._cmdserver.execute_diff(["diff", "-r", r1, "-r", r2]),
+                None)
 
     def scan_for_server(self, repository_info):
         # Scan first for dot files, since it's faster and will cover the
@@ -2,15 +2,30 @@ import logging
 import marshal
 import os
 import re
-import socket
-import stat
 import subprocess
 import sys
+import time
 
 from rbtools.clients import SCMClient, RepositoryInfo
+from rbtools.utils import resolver
+from rbtools.utils.cache import FileCache
 from rbtools.utils.checks import check_gnu_diff, check_install
-from rbtools.utils.filesystem import make_tempfile
-from rbtools.utils.process import die, execute
+from rbtools.utils.concurrency import imap_ordered
+from rbtools.utils.diffs import DiffBuffer
+from rbtools.utils.filesystem import get_cache_path, make_tempfile
+from rbtools.utils.process import die, execute, execute_stream
+
+
+class P4ChangeFile(object):
+    """
+    A file in a changelist, as listed by 'p4 describe' or 'p4 opened'.
+    """
+    __slots__ = ('depot_path', 'revision', 'action')
+
+    def __init__(self, depot_path, revision, action):
+        self.depot_path = depot_path
+        self.revision = revision
+        self.action = action
 
 
 class PerforceClient(SCMClient):
@@ -21,8 +36,30 @@ class PerforceClient(SCMClient):
     DATE_RE = re.compile(r'(\w+)\s+(\w+)\s+(\d+)\s+(\d\d:\d\d:\d\d)\s+'
                           '(\d\d\d\d)')
 
+    # The maximum number of file revisions fetched by a single 'p4 print'.
+    P4_BATCH_SIZE = 100
+
+    # The headers of each file's diff in 'p4 describe -du' and
+    # 'p4 diff2 -du'.
+    DESCRIBE_DIFF_HEADER_RE = re.compile(r'^==== (//[^#]+)#(\d+) \([^)]*\) '
+                                         r'====\s*$')
+    DIFF2_HEADER_RE = re.compile(r'^==== (//[^#]+)#(\d+) \([^)]*\) - '
+                                 r'(//[^#]+)#(\d+) \([^)]*\) ==== \w+')
+
+    # The error 'p4 describe' gives for a changelist that doesn't exist.
+    CHANGE_UNKNOWN_RE = re.compile(r'^Change \S+ unknown\.')
+
+    # Only specific revisions of submitted files are cached.
+    CACHEABLE_REVISION_RE = re.compile(r'^//[^@#]+#\d+$')
+
+    # Printed files larger than this aren't cached, so that a whole file
+    # never has to be held in memory.
+    P4_CACHE_MAX_FILE_SIZE = 4 * 1024 * 1024
+
     def __init__(self, **kwargs):
         super(PerforceClient, self).__init__(**kwargs)
+        self.p4_server_address = None
+        self._file_cache = None
 
     def get_repository_info(self):
         if not check_install('p4 help'):
@@ -35,21 +72,24 @@ class PerforceClient(SCMClient):
             return None
 
         repository_path = m.group(1).strip()
+        self.p4_server_address = repository_path
 
         try:
             hostname, port = repository_path.split(":")
-            info = socket.gethostbyaddr(hostname)
+        except ValueError:
+            hostname = None
+
+        if hostname:
+            info = resolver.gethostbyaddr(hostname)
 
             # If aliases exist for hostname, create a list of alias:port
             # strings for repository_path.
-            if info[1]:
+            if info and info[1]:
                 servers = [info[0]] + info[1]
                 repository_path = ["%s:%s" % (server, port)
                                    for server in servers]
-            else:
+            elif info:
                 repository_path = "%s:%s" % (info[0], port)
-        except (socket.gaierror, socket.herror):
-            pass
 
         m = re.search(r'^Server version: [^ ]*/([0-9]+)\.([0-9]+)/[0-9]+ .*$',
                       data, re.M)
@@ -176,11 +216,8 @@ class PerforceClient(SCMClient):
                                       r'(?P<revision1>[#@][^,]+)?' +
                                       r'(?P<revision2>,[#@][^,]+)?$')
 
-        empty_filename = make_tempfile()
-        tmp_diff_from_filename = make_tempfile()
-        tmp_diff_to_filename = make_tempfile()
-
-        diff_lines = []
+        entries = []
+        server_diffs = {}
 
         for path in args:
             m = r_revision_range.match(path)
@@ -216,6 +253,11 @@ class PerforceClient(SCMClient):
             if revision2:
                 # [1:] to skip the comma.
                 second_rev_path = m.group('path') + revision2[1:]
+
+                if self.options.p4_server_diff:
+                    server_diffs.update(self._get_server_diffs(
+                        ['diff2', '-du', first_rev_path, second_rev_path]))
+
                 records = self._run_p4(['files', second_rev_path])
                 for record in records:
                     if record['action'] not in ('delete', 'move/delete'):
@@ -225,79 +267,141 @@ class PerforceClient(SCMClient):
                         except KeyError:
                             files[record['depotFile']] = [None, record]
 
-            old_file = new_file = empty_filename
-            changetype_short = None
-
             for depot_path, (first_record, second_record) in files.items():
-                old_file = new_file = empty_filename
                 if first_record is None:
-                    self._write_file(depot_path + '#' + second_record['rev'],
-                                     tmp_diff_to_filename)
-                    new_file = tmp_diff_to_filename
-                    changetype_short = 'A'
-                    base_revision = 0
+                    entries.append((depot_path, 0, 'A', None,
+                                    depot_path + '#' + second_record['rev'],
+                                    False))
                 elif second_record is None:
-                    self._write_file(depot_path + '#' + first_record['rev'],
-                                     tmp_diff_from_filename)
-                    old_file = tmp_diff_from_filename
-                    changetype_short = 'D'
-                    base_revision = int(first_record['rev'])
+                    entries.append((depot_path, int(first_record['rev']), 'D',
+                                    depot_path + '#' + first_record['rev'],
+                                    None, False))
                 elif first_record['rev'] == second_record['rev']:
                     # We when we know the revisions are the same, we don't need
                     # to do any diffing. This speeds up large revision-range
                     # diffs quite a bit.
                     continue
                 else:
-                    self._write_file(depot_path + '#' + first_record['rev'],
-                                     tmp_diff_from_filename)
-                    self._write_file(depot_path + '#' + second_record['rev'],
-                                     tmp_diff_to_filename)
-                    new_file = tmp_diff_to_filename
-                    old_file = tmp_diff_from_filename
-                    changetype_short = 'M'
-                    base_revision = int(first_record['rev'])
-
-                dl = self._do_diff(old_file, new_file, depot_path,
-                                   base_revision, changetype_short,
-                                   ignore_unmodified=True)
-                diff_lines += dl
+                    entries.append((depot_path, int(first_record['rev']), 'M',
+                                    depot_path + '#' + first_record['rev'],
+                                    depot_path + '#' + second_record['rev'],
+                                    False))
 
-        os.unlink(empty_filename)
-        os.unlink(tmp_diff_from_filename)
-        os.unlink(tmp_diff_to_filename)
-        return (''.join(diff_lines), None)
+        entries = self._skip_unmodified_entries(entries)
+        diff = self._diff_entries(entries, ignore_unmodified=True,
+                                  server_diffs=server_diffs)
+        return (diff, None)
 
-    def _run_p4(self, command):
+    def _skip_unmodified_entries(self, entries):
+        """
+        Returns the diff entries without the modified files whose old and
+        new revisions have the same content.
+
+        Revisions with different numbers often have the same content, after
+        integrations for instance. Comparing the digests from a single
+        'p4 fstat -Ol' is far cheaper than fetching and diffing both
+        revisions of each of them.
+        """
+        depot_paths = []
+
+        for entry in entries:
+            if entry[2] == 'M':
+                depot_paths += entry[3:5]
+
+        if not depot_paths:
+            return entries
+
+        digests = self._get_digests(depot_paths)
+        result = []
+
+        for entry in entries:
+            old_depot_path, new_depot_path = entry[3:5]
+
+            if (entry[2] == 'M' and old_depot_path in digests and
+                digests[old_depot_path] == digests.get(new_depot_path)):
+                logging.debug('Skipping %s, which has the same content as %s'
+                              % (new_depot_path, old_depot_path))
+                continue
+
+            result.append(entry)
+
+        return result
+
+    def _run_p4(self, command, input_lines=None, ignore_errors=False):
         """Execute a perforce command using the python marshal API.
 
         - command: A list of strings of the command to execute.
+        - input_lines: Extra arguments to pass to the command through
+          'p4 -x', for commands with too many to fit on a command line.
+        - ignore_errors: If True, error records are returned like any other
+          record instead of causing post-review to exit.
 
         The return type depends on the command being run.
         """
-        command = ['p4', '-G'] + command
-        p = subprocess.Popen(command, stdout=subprocess.PIPE)
-        result = []
-        has_error = False
+        return list(self._iter_p4(command, input_lines, ignore_errors))
 
-        while 1:
-            try:
-                data = marshal.load(p.stdout)
-            except EOFError:
-                break
-            else:
-                result.append(data)
-                if data.get('code', None) == 'error':
-                    has_error = True
+    def _iter_p4(self, command, input_lines=None, ignore_errors=False):
+        """
+        Executes a perforce command using the python marshal API, like
+        _run_p4, but yields each record in turn rather than building a list.
 
-        rc = p.wait()
+        If the command fails, this dies after the last record.
+        """
+        p4_command = ['p4', '-G']
+        input_file = None
 
-        if rc or has_error:
-            for record in result:
-                if 'data' in record:
-                    print record['data']
-            die('Failed to execute command: %s\n' % (command,))
+        if self.options.p4_passwd:
+            p4_command += ['-P', self.options.p4_passwd]
 
-        return result
+        if input_lines is not None:
+            input_file = make_tempfile(''.join(['%s\n' % line
+                                                for line in input_lines]))
+            p4_command += ['-x', input_file]
+
+        command = p4_command + command
+
+        # The output goes to a temp file instead of a pipe. marshal.load
+        # holds on to the interpreter lock while it waits on a pipe, which
+        # would stop any other threads running p4 at the same time.
+        output_file = make_tempfile()
+        fp = open(output_file, 'w+b')
+
+        try:
+            # Closing the other file descriptors keeps this p4 from holding
+            # on to files belonging to others started by other threads.
+            p = subprocess.Popen(command, stdout=fp,
+                                 close_fds=(os.name != 'nt'))
+            rc = p.wait()
+            fp.seek(0)
+
+            messages = []
+            has_error = False
+
+            while 1:
+                try:
+                    data = marshal.load(fp)
+                except EOFError:
+                    break
+                else:
+                    if data.get('code', None) == 'error':
+                        has_error = True
+
+                    if ('data' in data and
+                        data.get('code', None) not in ('text', 'binary')):
+                        messages.append(data['data'])
+
+                    yield data
+        finally:
+            fp.close()
+            os.unlink(output_file)
+
+            if input_file:
+                os.unlink(input_file)
+
+        if (rc or has_error) and not ignore_errors:
+            for message in messages:
+                print message
+            die('Failed to execute command: %s\n' % (command,))
 
     def sanitize_changenum(self, changenum):
         """
@@ -317,17 +421,9 @@ class PerforceClient(SCMClient):
             v = self.p4d_version
 
             if v[0] < 2002 or (v[0] == "2002" and v[1] < 2):
-                describeCmd = ["p4"]
-
-                if self.options.p4_passwd:
-                    describeCmd.append("-P")
-                    describeCmd.append(self.options.p4_passwd)
-
-                describeCmd = describeCmd + ["describe", "-s", changenum]
-
-                description = execute(describeCmd, split_lines=True)
+                change = self._describe_change(changenum)
 
-                if '*pending*' in description[0]:
+                if change is not None and change.get('status') == 'pending':
                     return None
 
         return changenum
@@ -347,26 +443,17 @@ class PerforceClient(SCMClient):
 
         logging.info("Generating diff for changenum %s" % changenum)
 
-        description = []
+        change = None
 
         if changenum == "default":
             cl_is_pending = True
         else:
-            describeCmd = ["p4"]
-
-            if self.options.p4_passwd:
-                describeCmd.append("-P")
-                describeCmd.append(self.options.p4_passwd)
-
-            describeCmd = describeCmd + ["describe", "-s", changenum]
-
-            description = execute(describeCmd, split_lines=True)
+            change = self._describe_change(changenum)
 
-            if re.search("no such changelist", description[0]):
+            if change is None:
                 die("CLN %s does not exist." % changenum)
 
-            # Some P4 wrappers are addding an extra line before the description
-            if '*pending*' in description[0] or '*pending*' in description[1]:
+            if change.get('status') == 'pending':
                 cl_is_pending = True
 
         v = self.p4d_version
@@ -376,111 +463,310 @@ class PerforceClient(SCMClient):
             # Pre-2002.2 doesn't give file list in pending changelists,
             # or we don't have a description for a default changeset,
             # so we have to get it a different way.
-            info = execute(["p4", "opened", "-c", str(changenum)],
-                           split_lines=True)
-
-            if (len(info) == 1 and
-                info[0].startswith("File(s) not opened on this client.")):
-                die("Couldn't find any affected files for this change.")
-
-            for line in info:
-                data = line.split(" ")
-                description.append("... %s %s" % (data[0], data[2]))
-
+            change_files = self._iter_opened_files(changenum)
         else:
-            # Get the file list
-            for line_num, line in enumerate(description):
-                if 'Affected files ...' in line:
-                    break
-            else:
-                # Got to the end of all the description lines and didn't find
-                # what we were looking for.
-                die("Couldn't find any affected files for this change.")
-
-            description = description[line_num + 2:]
+            change_files = self._iter_described_files(change)
 
-        diff_lines = []
+        entries = []
 
-        empty_filename = make_tempfile()
-        tmp_diff_from_filename = make_tempfile()
-        tmp_diff_to_filename = make_tempfile()
-
-        for line in description:
-            line = line.strip()
-            if not line:
-                continue
-
-            m = re.search(r'\.\.\. ([^#]+)#(\d+) '
-                          r'(add|edit|delete|integrate|branch|move/add'
-                          r'|move/delete)',
-                          line)
-            if not m:
-                die("Unsupported line from p4 opened: %s" % line)
-
-            depot_path = m.group(1)
-            base_revision = int(m.group(2))
+        for change_file in change_files:
+            depot_path = change_file.depot_path
+            base_revision = change_file.revision
             if not cl_is_pending:
                 # If the changelist is pending our base revision is the one
                 # that's currently in the depot. If we're not pending the base
                 # revision is actually the revision prior to this one.
                 base_revision -= 1
 
-            changetype = m.group(3)
-
-            logging.debug('Processing %s of %s' % (changetype, depot_path))
-
-            old_file = new_file = empty_filename
-            old_depot_path = new_depot_path = None
-            changetype_short = None
+            changetype = change_file.action
 
             if changetype in ['edit', 'integrate']:
                 # A big assumption
                 new_revision = base_revision + 1
 
-                # We have an old file, get p4 to take this old version from the
-                # depot and put it into a plain old temp file for us
-                old_depot_path = "%s#%s" % (depot_path, base_revision)
-                self._write_file(old_depot_path, tmp_diff_from_filename)
-                old_file = tmp_diff_from_filename
-
-                # Also print out the new file into a tmpfile
-                if cl_is_pending:
-                    new_file = self._depot_to_local(depot_path)
-                else:
-                    new_depot_path = "%s#%s" % (depot_path, new_revision)
-                    self._write_file(new_depot_path, tmp_diff_to_filename)
-                    new_file = tmp_diff_to_filename
-
-                changetype_short = "M"
+                # We have an old file, which we get p4 to take from the
+                # depot. The new file is the one in the workspace for
+                # pending changes.
+                entries.append((depot_path, base_revision, 'M',
+                                '%s#%s' % (depot_path, base_revision),
+                                '%s#%s' % (depot_path, new_revision),
+                                cl_is_pending))
             elif changetype in ['add', 'branch', 'move/add']:
-                # We have a new file, get p4 to put this new file into a pretty
-                # temp file for us. No old file to worry about here.
-                if cl_is_pending:
-                    new_file = self._depot_to_local(depot_path)
-                else:
-                    new_depot_path = "%s#%s" % (depot_path, 1)
-                    self._write_file(new_depot_path, tmp_diff_to_filename)
-                    new_file = tmp_diff_to_filename
-                changetype_short = "A"
+                # We have a new file. No old file to worry about here.
+                entries.append((depot_path, base_revision, 'A', None,
+                                '%s#%s' % (depot_path, 1),
+                                cl_is_pending))
             elif changetype in ['delete', 'move/delete']:
-                # We've deleted a file, get p4 to put the deleted file into a
-                # temp file for us. The new file remains the empty file.
-                old_depot_path = "%s#%s" % (depot_path, base_revision)
-                self._write_file(old_depot_path, tmp_diff_from_filename)
-                old_file = tmp_diff_from_filename
-                changetype_short = "D"
+                # We've deleted a file, get p4 to give us the deleted file.
+                # The new file remains the empty file.
+                entries.append((depot_path, base_revision, 'D',
+                                '%s#%s' % (depot_path, base_revision),
+                                None, False))
             else:
                 die("Unknown change type '%s' for %s" % (changetype,
                                                          depot_path))
 
-            dl = self._do_diff(old_file, new_file, depot_path, base_revision,
-                               changetype_short)
-            diff_lines += dl
+        if not entries:
+            die("Couldn't find any affected files for this change.")
+
+        local_paths = None
+
+        if cl_is_pending:
+            # Find where all the files in the workspace are at once.
+            local_paths = self._depot_to_local([entry[0] for entry in entries
+                                                if entry[5]])
+
+        server_diffs = None
+
+        if self.options.p4_server_diff and not cl_is_pending:
+            server_diffs = self._get_server_diffs(['describe', '-du',
+                                                   changenum])
+
+        diff = self._diff_entries(entries, server_diffs=server_diffs,
+                                  local_paths=local_paths)
+        return (diff, None)
+
+    def _describe_change(self, changenum):
+        """
+        Returns the record from 'p4 -G describe -s' for a changelist, or
+        None if there's no such changelist. Any other error (such as a
+        failed login) is fatal.
+
+        The files in the changelist are listed in numbered fields of the
+        record (depotFile0, rev0, action0, depotFile1, ...).
+        """
+        errors = []
+
+        for record in self._iter_p4(['describe', '-s', str(changenum)],
+                                    ignore_errors=True):
+            code = record.get('code', None)
+
+            if code == 'stat':
+                return record
+            elif code == 'error':
+                errors.append(record.get('data', '').strip())
+
+        for error in errors:
+            if self.CHANGE_UNKNOWN_RE.match(error):
+                return None
+
+        if errors:
+            die('Unable to describe changelist %s:\n%s'
+                % (changenum, '\n'.join(errors)))
+
+        return None
+
+    def _iter_described_files(self, change):
+        """
+        Yields a P4ChangeFile for each file in a changelist described by
+        _describe_change.
+        """
+        i = 0
+
+        while 'depotFile%d' % i in change:
+            yield P4ChangeFile(change['depotFile%d' % i],
+                               int(change['rev%d' % i]),
+                               change['action%d' % i])
+            i += 1
+
+    def _iter_opened_files(self, changenum):
+        """
+        Yields a P4ChangeFile for each file opened in a pending changelist
+        on this client, as they're read from 'p4 -G opened -c'.
+        """
+        for record in self._iter_p4(['opened', '-c', str(changenum)],
+                                    ignore_errors=True):
+            # "File(s) not opened on this client." comes back as an error,
+            # leaving us with no files.
+            if record.get('code', None) == 'stat':
+                yield P4ChangeFile(record['depotFile'], int(record['rev']),
+                                   record['action'])
+
+    def _diff_entries(self, entries, ignore_unmodified=False,
+                      server_diffs=None, local_paths=None):
+        """
+        Generates the diffs for a list of files, returning a DiffBuffer.
+
+        Each entry is a tuple of the depot path, base revision, short change
+        type, the depot paths (with revisions) of the old and new versions to
+        fetch, or None for the empty file, and whether the new version is the
+        file in the workspace instead.
+
+        The files are fetched from the depot in batches, several batches at
+        a time, and diffed in order as they arrive.
+
+        server_diffs may map pairs of old and new depot paths to diff hunks
+        generated by the server (see _get_server_diffs). Those files are
+        not fetched at all.
+
+        local_paths maps the depot paths of the entries whose new versions
+        are in the workspace to their paths on the local filesystem (see
+        _depot_to_local).
+        """
+        diff = DiffBuffer()
+        empty_filename = make_tempfile()
+        server_diffs = server_diffs or {}
+
+        jobs = max(1, self.options.jobs)
+        batch_size = min(self.P4_BATCH_SIZE,
+                         max(1, (len(entries) + jobs - 1) / jobs))
+        batches = [entries[i:i + batch_size]
+                   for i in range(0, len(entries), batch_size)]
+
+        def fetch_batch(batch):
+            return self._fetch_entries(batch, empty_filename, server_diffs,
+                                       local_paths)
+
+        for files in imap_ordered(fetch_batch, batches, jobs):
+            for (depot_path, base_revision, changetype_short, old_file,
+                 new_file, tmpfiles, hunks) in files:
+                logging.debug('Processing %s of %s'
+                              % (changetype_short, depot_path))
+
+                if hunks:
+                    dl = self._make_server_diff(depot_path, base_revision,
+                                                hunks)
+                else:
+                    dl = self._do_diff(old_file, new_file, depot_path,
+                                       base_revision, changetype_short,
+                                       ignore_unmodified=ignore_unmodified)
+
+                diff.writelines(dl)
+
+                for tmpfile in tmpfiles:
+                    os.unlink(tmpfile)
 
         os.unlink(empty_filename)
-        os.unlink(tmp_diff_from_filename)
-        os.unlink(tmp_diff_to_filename)
-        return (''.join(diff_lines), None)
+        return diff
+
+    def _fetch_entries(self, entries, empty_filename, server_diffs,
+                       local_paths):
+        """
+        Fetches the old and new versions of the files for a batch of diff
+        entries (see _diff_entries) with a single 'p4 print'.
+
+        Returns a list of tuples of the depot path, base revision, short
+        change type, old file, new file, the temp files to remove once
+        they've been diffed, and the hunks of the server's diff if there
+        was one instead of the files.
+        """
+        depot_paths = []
+
+        for entry in entries:
+            old_depot_path, new_depot_path, new_is_local = entry[3:]
+
+            if (old_depot_path, new_depot_path) in server_diffs:
+                continue
+
+            if old_depot_path:
+                depot_paths.append(old_depot_path)
+
+            if new_depot_path and not new_is_local:
+                depot_paths.append(new_depot_path)
+
+        printed_files = iter(self._print_files(depot_paths))
+        results = []
+
+        for (depot_path, base_revision, changetype_short, old_depot_path,
+             new_depot_path, new_is_local) in entries:
+            old_file = new_file = empty_filename
+            tmpfiles = []
+            hunks = server_diffs.get((old_depot_path, new_depot_path))
+
+            if not hunks:
+                if old_depot_path:
+                    old_file = printed_files.next()
+                    tmpfiles.append(old_file)
+
+                if new_is_local:
+                    new_file = local_paths[depot_path]
+                elif new_depot_path:
+                    new_file = printed_files.next()
+                    tmpfiles.append(new_file)
+
+            results.append((depot_path, base_revision, changetype_short,
+                            old_file, new_file, tmpfiles, hunks))
+
+        return results
+
+    def _get_server_diffs(self, command):
+        """
+        Runs a p4 command that outputs unified diffs, like 'p4 describe -du'
+        or 'p4 diff2 -du', and returns the diffs of the text files that
+        changed (see _parse_server_diffs).
+        """
+        p4_command = ['p4']
+
+        if self.options.p4_passwd:
+            p4_command += ['-P', self.options.p4_passwd]
+
+        return self._parse_server_diffs(
+            execute_stream(p4_command + command, translate_newlines=False))
+
+    def _parse_server_diffs(self, lines):
+        """
+        Parses the unified diffs from 'p4 describe -du' or 'p4 diff2 -du'
+        into a map of (old depot path, new depot path) pairs, with
+        revisions, to the hunks of each file's diff.
+
+        p4 doesn't show content diffs for binary files, or for added and
+        deleted files, so these are left out.
+        """
+        server_diffs = {}
+        hunks = None
+
+        for line in lines:
+            if line.startswith('==== '):
+                hunks = None
+                m = self.DESCRIBE_DIFF_HEADER_RE.match(line)
+
+                if m:
+                    depot_path = m.group(1)
+                    revision = int(m.group(2))
+                    key = ('%s#%s' % (depot_path, revision - 1),
+                           '%s#%s' % (depot_path, revision))
+                else:
+                    m = self.DIFF2_HEADER_RE.match(line)
+
+                    if not m:
+                        continue
+
+                    key = ('%s#%s' % (m.group(1), m.group(2)),
+                           '%s#%s' % (m.group(3), m.group(4)))
+
+                hunks = server_diffs.setdefault(key, [])
+            elif hunks is not None and line[:1] in ('@', ' ', '+', '-', '\\'):
+                # If the input file has ^M characters at end of line, lets
+                # ignore them.
+                hunks.append(line.replace('\r\r\n', '\r\n'))
+
+        for key, hunks in server_diffs.items():
+            if not hunks:
+                del server_diffs[key]
+            elif hunks[-1][-1] != '\n':
+                # Not everybody has files that end in a newline (ugh). This
+                # ensures that the resulting diff file isn't broken.
+                hunks.append('\n')
+
+        return server_diffs
+
+    def _make_server_diff(self, depot_path, base_revision, hunks):
+        """
+        Returns the diff lines for a file diffed by the server, with the
+        same headers _do_diff would use.
+        """
+        local_path = self._get_local_path(depot_path)
+        timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
+
+        return ["--- %s\t%s#%s\n" % (local_path, depot_path, base_revision),
+                "+++ %s\t%s\n" % (local_path, timestamp)] + hunks
+
+    def _get_local_path(self, depot_path):
+        cwd = os.getcwd()
+        if depot_path.startswith(cwd):
+            return depot_path[len(cwd) + 1:]
+        else:
+            return depot_path
 
     def _do_diff(self, old_file, new_file, depot_path, base_revision,
                  changetype_short, ignore_unmodified=False):
@@ -510,11 +796,7 @@ class PerforceClient(SCMClient):
         dl = dl.replace('\r\r\n', '\r\n')
         dl = dl.splitlines(True)
 
-        cwd = os.getcwd()
-        if depot_path.startswith(cwd):
-            local_path = depot_path[len(cwd) + 1:]
-        else:
-            local_path = depot_path
+        local_path = self._get_local_path(depot_path)
 
         # Special handling for the output of the diff tool on binary files:
         #     diff outputs "Files a and b differ"
@@ -579,26 +861,219 @@ class PerforceClient(SCMClient):
 
         return dl
 
-    def _write_file(self, depot_path, tmpfile):
+    def _print_files(self, depot_paths):
         """
-        Grabs a file from Perforce and writes it to a temp file. p4 print sets
-        the file readonly and that causes a later call to unlink fail. So we
-        make the file read/write.
+        Grabs many file revisions from Perforce with a single 'p4 print',
+        writing each to its own temp file. Returns the temp files, in the
+        same order as depot_paths.
+
+        p4 sends a stat record for each file, followed by records with
+        chunks of its content.
+
+        Submitted revisions never change, so they're kept in a cache shared
+        by all post-review processes, and only the ones that aren't already
+        cached are printed. With --p4-verify-cache, cached revisions are
+        only used if their digests still match the ones 'p4 fstat' reports.
         """
-        logging.debug('Writing "%s" to "%s"' % (depot_path, tmpfile))
-        execute(["p4", "print", "-o", tmpfile, "-q", depot_path])
-        os.chmod(tmpfile, stat.S_IREAD | stat.S_IWRITE)
+        tmpfiles = [None] * len(depot_paths)
+        cache = self._get_file_cache()
+        to_print = range(len(depot_paths))
+        digests = {}
+
+        if cache:
+            cacheable_paths = [depot_path for depot_path in depot_paths
+                               if self.CACHEABLE_REVISION_RE.search(
+                                   depot_path)]
+
+            if self.options.p4_verify_cache and cacheable_paths:
+                digests = self._get_digests(cacheable_paths)
+
+            to_print = []
+
+            for i, depot_path in enumerate(depot_paths):
+                tmpfiles[i] = self._get_cached_file(cache, depot_path,
+                                                    digests)
+
+                if tmpfiles[i] is None:
+                    to_print.append(i)
 
-    def _depot_to_local(self, depot_path):
+        if not to_print:
+            return tmpfiles
+
+        # The index, content type and open temp file of the file being read.
+        # Its chunks are also kept for the cache, until it's too large.
+        current = {}
+
+        def write_chunk(code, data):
+            if current['fp'] is None:
+                current['code'] = code
+                current['fp'] = self._open_printed_file(
+                    tmpfiles[current['i']], code)
+
+            current['fp'].write(data)
+
+            if current['chunks'] is not None:
+                current['size'] += len(data)
+
+                if current['size'] > self.P4_CACHE_MAX_FILE_SIZE:
+                    current['chunks'] = None
+                else:
+                    current['chunks'].append(data)
+
+        def finish_file():
+            i = current['i']
+
+            if current['fp'] is not None:
+                current['fp'].close()
+
+            if (cache and current['chunks'] is not None and
+                self.CACHEABLE_REVISION_RE.search(depot_paths[i])):
+                cache.set(self._get_file_cache_key(depot_paths[i]),
+                          '%s %s\n%s' % (current['code'],
+                                         digests.get(depot_paths[i], '-'),
+                                         ''.join(current['chunks'])))
+
+        printed = 0
+
+        for record in self._iter_p4(['print'],
+                                    [depot_paths[i] for i in to_print]):
+            code = record.get('code', None)
+
+            if code == 'stat':
+                if current:
+                    finish_file()
+
+                if printed == len(to_print):
+                    die('Got more files than expected from p4 print')
+
+                i = to_print[printed]
+                printed += 1
+                tmpfiles[i] = make_tempfile()
+                current.update({
+                    'i': i,
+                    'code': 'text',
+                    'fp': None,
+                    'chunks': [],
+                    'size': 0,
+                })
+                logging.debug('Writing "%s#%s" to "%s"'
+                              % (record['depotFile'], record['rev'],
+                                 tmpfiles[i]))
+            elif code in ('text', 'binary'):
+                write_chunk(code, record['data'])
+
+        if current:
+            finish_file()
+
+        if printed != len(to_print):
+            die('Expected %d files from p4 print, but got %d'
+                % (len(to_print), printed))
+
+        return tmpfiles
+
+    def _open_printed_file(self, tmpfile, code):
         """
-        Given a path in the depot return the path on the local filesystem to
-        the same file.  If there are multiple results, take only the last
-        result from the where command.
+        Opens a temp file for the content of a file from 'p4 print'. Text is
+        written with the platform's line endings, the way 'p4 print -o'
+        would.
         """
-        where_output = self._run_p4(['where', depot_path])
+        if code == 'text':
+            return open(tmpfile, 'w')
+        else:
+            return open(tmpfile, 'wb')
+
+    def _write_printed_file(self, tmpfile, code, data):
+        """
+        Writes the content of a file from 'p4 print' to a temp file.
+        """
+        fp = self._open_printed_file(tmpfile, code)
 
         try:
-            return where_output[-1]['path']
-        except:
-            # XXX: This breaks on filenames with spaces.
-            return where_output[-1]['data'].split(' ')[2].strip()
+            fp.write(data)
+        finally:
+            fp.close()
+
+    def _get_file_cache(self):
+        """
+        Returns the cache of depot file revisions, or None if caching is
+        disabled.
+        """
+        if not self.options.diff_cache:
+            return None
+
+        if self._file_cache is None:
+            self._file_cache = FileCache(get_cache_path('p4-files'))
+
+        return self._file_cache
+
+    def _get_file_cache_key(self, depot_path):
+        path, rev = depot_path.rsplit('#', 1)
+        return ('p4', self._get_p4_port(), path, rev)
+
+    def _get_p4_port(self):
+        """
+        Returns the P4PORT of the server files are fetched from, which
+        keeps cached files from different servers apart.
+        """
+        return (self.options.p4_port or os.environ.get('P4PORT') or
+                self.p4_server_address or '')
+
+    def _get_cached_file(self, cache, depot_path, digests):
+        """
+        Writes a cached file revision to a temp file, returning the temp
+        file, or None if the revision isn't cached.
+        """
+        if not self.CACHEABLE_REVISION_RE.search(depot_path):
+            return None
+
+        value = cache.get(self._get_file_cache_key(depot_path))
+
+        if value is None:
+            return None
+
+        header, data = value.split('\n', 1)
+        code, digest = header.split(' ', 1)
+
+        if self.options.p4_verify_cache and digests.get(depot_path) != digest:
+            logging.debug('Cached copy of %s is out of date' % depot_path)
+            return None
+
+        tmpfile = make_tempfile()
+        logging.debug('Writing cached "%s" to "%s"' % (depot_path, tmpfile))
+        self._write_printed_file(tmpfile, code, data)
+
+        return tmpfile
+
+    def _get_digests(self, depot_paths):
+        """
+        Returns a map of file revisions to the digests of their content,
+        using a single 'p4 fstat -Ol'. Revisions without a digest (such as
+        deleted ones) are left out.
+        """
+        digests = {}
+
+        for record in self._iter_p4(['fstat', '-Ol'], depot_paths):
+            if 'digest' in record and 'headRev' in record:
+                digests['%s#%s' % (record['depotFile'],
+                                   record['headRev'])] = record['digest']
+
+        return digests
+
+    def _depot_to_local(self, depot_paths):
+        """
+        Given paths in the depot, returns a map of them to the paths on the
+        local filesystem of the same files, using a single 'p4 where'. If
+        there are multiple results for a path, take only the last one.
+        """
+        local_paths = {}
+
+        if depot_paths:
+            for record in self._iter_p4(['where'], depot_paths):
+                if 'depotFile' in record and 'path' in record:
+                    local_paths[record['depotFile']] = record['path']
+
+        for depot_path in depot_paths:
+            if depot_path not in local_paths:
+                die('Unable to find %s in the client view.' % depot_path)
+
+        return local_paths
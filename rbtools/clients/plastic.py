@@ -3,8 +3,11 @@ import os
 import re
 
 from rbtools.clients import SCMClient, RepositoryInfo
+from rbtools.utils.cache import FileCache
 from rbtools.utils.checks import check_install
-from rbtools.utils.filesystem import make_tempfile
+from rbtools.utils.concurrency import imap_ordered
+from rbtools.utils.diffs import DiffBuffer
+from rbtools.utils.filesystem import get_cache_path, make_tempfile
 from rbtools.utils.process import die, execute
 
 
@@ -13,8 +16,14 @@ class PlasticClient(SCMClient):
     A wrapper around the cm Plastic tool that fetches repository
     information and generates compatible diffs
     """
+    # Revisions larger than this aren't cached, so that a whole file
+    # never has to be held in memory.
+    PLASTIC_CACHE_MAX_FILE_SIZE = 4 * 1024 * 1024
+
     def __init__(self, **kwargs):
         super(PlasticClient, self).__init__(**kwargs)
+        self.repository_path = None
+        self._revision_cache = None
 
     def get_repository_info(self):
         if not check_install('cm version'):
@@ -40,6 +49,7 @@ class PlasticClient(SCMClient):
             return None
 
         path = m.group(1)
+        self.repository_path = path
 
         return RepositoryInfo(path,
                               supports_changesets=True,
@@ -116,11 +126,15 @@ class PlasticClient(SCMClient):
 
     def process_diffs(self, my_diff_entries):
         # Diff generation based on perforce client
-        diff_lines = []
+        diff = DiffBuffer()
 
         empty_filename = make_tempfile()
-        tmp_diff_from_filename = make_tempfile()
-        tmp_diff_to_filename = make_tempfile()
+
+        # Each file to diff, as a tuple of the revision specs of the old and
+        # new files to fetch (or None for an empty file), and the filename,
+        # new revision spec, parent revision spec and change type for the
+        # diff.
+        diffs = []
 
         for f in my_diff_entries:
             f = f.strip()
@@ -148,18 +162,10 @@ class PlasticClient(SCMClient):
                 newfilename = m.group("dstpath")
                 newspec = m.group("revspec")
 
-                self.write_file(oldfilename, oldspec, tmp_diff_from_filename)
-                dl = self.diff_files(tmp_diff_from_filename, empty_filename,
-                                    oldfilename, "rev:revid:-1", oldspec,
-                                    changetype)
-                diff_lines += dl
-
-                self.write_file(newfilename, newspec, tmp_diff_to_filename)
-                dl = self.diff_files(empty_filename, tmp_diff_to_filename,
-                                    newfilename, newspec, "rev:revid:-1",
-                                    changetype)
-                diff_lines += dl
-
+                diffs.append((oldspec, None, oldfilename, "rev:revid:-1",
+                              oldspec, changetype))
+                diffs.append((None, newspec, newfilename, newspec,
+                              "rev:revid:-1", changetype))
             else:
                 newrevspec = m.group("revspec")
                 parentrevspec = m.group("parentrevspec")
@@ -169,37 +175,67 @@ class PlasticClient(SCMClient):
                                                          parentrevspec,
                                                          newrevspec))
 
-                old_file = new_file = empty_filename
-
                 if (changetype in ['A'] or
                     (changetype in ['C'] and
                     parentrevspec == "rev:revid:-1")):
                     # There's only one content to show
-                    self.write_file(filename, newrevspec, tmp_diff_to_filename)
-                    new_file = tmp_diff_to_filename
+                    diffs.append((None, newrevspec, filename, newrevspec,
+                                  parentrevspec, changetype))
                 elif changetype in ['C']:
-                    self.write_file(filename, parentrevspec,
-                                tmp_diff_from_filename)
-                    old_file = tmp_diff_from_filename
-                    self.write_file(filename, newrevspec, tmp_diff_to_filename)
-                    new_file = tmp_diff_to_filename
+                    diffs.append((parentrevspec, newrevspec, filename,
+                                  newrevspec, parentrevspec, changetype))
                 elif changetype in ['D']:
-                    self.write_file(filename, parentrevspec,
-                                tmp_diff_from_filename)
-                    old_file = tmp_diff_from_filename
+                    diffs.append((parentrevspec, None, filename, newrevspec,
+                                  parentrevspec, changetype))
                 else:
                     die("Don't know how to handle change type '%s' for %s" %
                         (changetype, filename))
 
-                dl = self.diff_files(old_file, new_file, filename,
+        def fetch_files(diff):
+            return self._fetch_files(diff, empty_filename)
+
+        # The files are fetched in parallel, and diffed in order as they
+        # arrive.
+        for (filename, newrevspec, parentrevspec, changetype, old_file,
+             new_file, tmpfiles) in imap_ordered(fetch_files, diffs,
+                                                 self.options.jobs):
+            dl = self.diff_files(old_file, new_file, filename,
                                  newrevspec, parentrevspec, changetype)
-                diff_lines += dl
+            diff.writelines(dl)
+
+            for tmpfile in tmpfiles:
+                os.unlink(tmpfile)
 
         os.unlink(empty_filename)
-        os.unlink(tmp_diff_from_filename)
-        os.unlink(tmp_diff_to_filename)
 
-        return ''.join(diff_lines)
+        return diff
+
+    def _fetch_files(self, diff, empty_filename):
+        """
+        Writes the old and new files for a diff (see process_diffs) to
+        their own temp files.
+
+        Returns a tuple of the filename, new revision spec, parent revision
+        spec, change type, old file, new file and the temp files to remove
+        once they've been diffed.
+        """
+        (old_spec, new_spec, filename, newrevspec, parentrevspec,
+         changetype) = diff
+        old_file = new_file = empty_filename
+        tmpfiles = []
+
+        if old_spec:
+            old_file = make_tempfile()
+            tmpfiles.append(old_file)
+            self.write_file(filename, old_spec, old_file)
+
+        if new_spec:
+            new_file = make_tempfile()
+            tmpfiles.append(new_file)
+            self.write_file(filename, new_spec, new_file)
+
+        return (filename, newrevspec, parentrevspec, changetype, old_file,
+                new_file, tmpfiles)
 
     def diff_files(self, old_file, new_file, filename, newrevspec,
                    parentrevspec, changetype):
@@ -254,7 +290,46 @@ class PlasticClient(SCMClient):
         return dl
 
     def write_file(self, filename, filespec, tmpfile):
-        """ Grabs a file from Plastic and writes it to a temp file """
+        """
+        Grabs a file from Plastic and writes it to a temp file.
+
+        A revid always refers to the same content, so revisions up to
+        PLASTIC_CACHE_MAX_FILE_SIZE are kept in a cache shared by all
+        post-review processes.
+        """
+        cache = self._get_revision_cache()
+        key = ('plastic', self.repository_path or '', filespec)
+
+        if cache:
+            data = cache.get(key)
+
+            if data is not None:
+                logging.debug("Writing cached '%s' (rev %s) to '%s'"
+                              % (filename, filespec, tmpfile))
+                fp = open(tmpfile, 'wb')
+                fp.write(data)
+                fp.close()
+                return
+
         logging.debug("Writing '%s' (rev %s) to '%s'" % (filename, filespec, tmpfile))
         execute(["cm", "cat", filespec, "--file=" + tmpfile])
 
+        if (cache and
+            os.path.getsize(tmpfile) <= self.PLASTIC_CACHE_MAX_FILE_SIZE):
+            fp = open(tmpfile, 'rb')
+            cache.set(key, fp.read())
+            fp.close()
+
+    def _get_revision_cache(self):
+        """
+        Returns the cache of file revisions, or None if caching is disabled.
+        """
+        if not self.options.diff_cache:
+            return None
+
+        if self._revision_cache is None:
+            self._revision_cache = FileCache(
+                get_cache_path('plastic-revisions'))
+
+        return self._revision_cache
+
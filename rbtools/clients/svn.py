@@ -1,13 +1,24 @@
+import logging
 import os
 import re
 import sys
 import urllib
+from xml.etree import ElementTree
+from xml.parsers.expat import ExpatError
+
+try:
+    import sqlite3
+except ImportError:
+    # sqlite3 is only available on Python 2.5+. Without it, we always ask
+    # the svn command line client.
+    sqlite3 = None
 
 from rbtools.api.errors import APIError
 from rbtools.clients import SCMClient, RepositoryInfo
 from rbtools.utils.checks import check_gnu_diff, check_install
+from rbtools.utils.diffs import DiffBuffer
 from rbtools.utils.filesystem import walk_parents
-from rbtools.utils.process import execute
+from rbtools.utils.process import execute, execute_stream
 
 
 class SVNClient(SCMClient):
@@ -15,6 +26,10 @@ class SVNClient(SCMClient):
     DIFF_ORIG_FILE_LINE_RE = re.compile(r'^---\s+.*\s+\(.*\)')
     DIFF_NEW_FILE_LINE_RE = re.compile(r'^\+\+\+\s+.*\s+\(.*\)')
 
+    # The maximum number of paths passed to a single 'svn info' call, to
+    # stay well within command line length limits.
+    SVN_INFO_BATCH_SIZE = 100
+
     """
     A wrapper around the svn Subversion tool that fetches repository
     information and generates compatible diffs.
@@ -22,42 +37,57 @@ class SVNClient(SCMClient):
 
     def __init__(self, **kwargs):
         super(SVNClient, self).__init__(**kwargs)
+        self._wcdb = None
 
     def get_repository_info(self):
         if not check_install('svn help'):
             return None
 
-        # Get the SVN repository path (either via a working copy or
-        # a supplied URI)
-        svn_info_params = ["svn", "info"]
+        info = None
 
-        if self.options.repository_url:
-            svn_info_params.append(self.options.repository_url)
+        if not self.options.repository_url:
+            wcdb = self.get_working_copy_db()
 
-        data = execute(svn_info_params,
-                       ignore_errors=True)
+            if wcdb:
+                info = wcdb.get_info('.')
 
-        m = re.search(r'^Repository Root: (.+)$', data, re.M)
-        if not m:
-            return None
+        if info is None:
+            # Get the SVN repository path (either via a working copy or
+            # a supplied URI)
+            svn_info_params = ["svn", "info"]
 
-        path = m.group(1)
+            if self.options.repository_url:
+                svn_info_params.append(self.options.repository_url)
 
-        m = re.search(r'^URL: (.+)$', data, re.M)
-        if not m:
-            return None
+            data = execute(svn_info_params,
+                           ignore_errors=True)
+            info = {}
 
-        base_path = m.group(1)[len(path):] or "/"
+            for key in ('Repository Root', 'URL', 'Repository UUID'):
+                m = re.search(r'^%s: (.+)$' % key, data, re.M)
+                if not m:
+                    return None
 
-        m = re.search(r'^Repository UUID: (.+)$', data, re.M)
-        if not m:
-            return None
+                info[key] = m.group(1)
+
+        path = info['Repository Root']
+        base_path = info['URL'][len(path):] or "/"
 
         # Now that we know it's SVN, make sure we have GNU diff installed,
         # and error out if we don't.
         check_gnu_diff()
 
-        return SVNRepositoryInfo(path, base_path, m.group(1))
+        return SVNRepositoryInfo(path, base_path, info['Repository UUID'])
+
+    def get_working_copy_db(self):
+        """
+        Returns an SVNWorkingCopyDB for the current working copy, or None if
+        its metadata can't be read directly.
+        """
+        if self._wcdb is None:
+            self._wcdb = find_working_copy_db(os.getcwd()) or False
+
+        return self._wcdb or None
 
     def check_options(self):
         if (self.options.repository_url and
@@ -157,20 +187,73 @@ class SVNClient(SCMClient):
         """
         Performs the actual diff operation, handling renames and converting
         paths to absolute.
+
+        Diffs may be very large (between two tags, for instance), and never
+        need to be held in memory as a whole. Diffs between repository URLs
+        are streamed from svn through the path conversion and into the
+        DiffBuffer. Working copy diffs are first streamed into a DiffBuffer
+        of their own, since all the files in them are looked up before the
+        diff can be converted.
+        """
+        if self.options.repository_url:
+            diff = DiffBuffer()
+            diff.writelines(self._iter_absolute_paths(execute_stream(cmd),
+                                                      repository_info))
+            return diff
+
+        svn_diff = DiffBuffer()
+        svn_diff.writelines(execute_stream(cmd))
+
+        # Look up all the files in the diff at once, rather than running
+        # 'svn info' for every header line.
+        svn_info_map = self._get_diff_svn_info(svn_diff.iter_lines())
+        lines = self._iter_renames(svn_diff.iter_lines(), svn_info_map)
+
+        diff = DiffBuffer()
+        diff.writelines(self._iter_absolute_paths(lines, repository_info,
+                                                  svn_info_map))
+        svn_diff.close()
+
+        return diff
+
+    def _get_diff_svn_info(self, diff_content):
         """
-        diff = execute(cmd, split_lines=True)
-        diff = self.handle_renames(diff)
-        diff = self.convert_to_absolute_paths(diff, repository_info)
+        Returns a map of 'svn info' results for all the relative paths
+        found in the headers of a diff.
+        """
+        if self.options.repository_url:
+            # Paths are already relative to the repository, so they're never
+            # looked up.
+            return {}
+
+        paths = []
+        seen = set()
+
+        for line in diff_content:
+            if (self.DIFF_NEW_FILE_LINE_RE.match(line)
+                or self.DIFF_ORIG_FILE_LINE_RE.match(line)
+                or line.startswith('Index: ')):
+                line = line.split(" ", 1)[1]
+
+                if not line.startswith('/'):
+                    path = self.parse_filename_header(line)[0]
+
+                    if path not in seen:
+                        seen.add(path)
+                        paths.append(path)
 
-        return ''.join(diff)
+        return self.batch_svn_info(paths)
 
-    def handle_renames(self, diff_content):
+    def handle_renames(self, diff_content, svn_info_map=None):
         """
         The output of svn diff is incorrect when the file in question came
         into being via svn mv/cp. Although the patch for these files are
         relative to its parent, the diff header doesn't reflect this.
         This function fixes the relevant section headers of the patch to
         portray this relationship.
+
+        If svn_info_map is provided, file information is looked up there
+        instead of by running 'svn info'.
         """
 
         # svn diff against a repository URL on two revisions appears to
@@ -179,8 +262,13 @@ class SVNClient(SCMClient):
         if self.options.repository_url:
             return diff_content
 
-        result = []
+        return list(self._iter_renames(diff_content, svn_info_map))
 
+    def _iter_renames(self, diff_content, svn_info_map=None):
+        """
+        Yields the lines of a diff with the headers of copied files fixed
+        (see handle_renames), without holding on to the diff.
+        """
         from_line = ""
         for line in diff_content:
             if self.DIFF_ORIG_FILE_LINE_RE.match(line):
@@ -190,30 +278,38 @@ class SVNClient(SCMClient):
             # This is where we decide how mangle the previous '--- '
             if self.DIFF_NEW_FILE_LINE_RE.match(line):
                 to_file, _ = self.parse_filename_header(line[4:])
-                info       = self.svn_info(to_file, True)
+                info       = self._lookup_svn_info(to_file, svn_info_map)
                 if info is not None and info.has_key("Copied From URL"):
                     url       = info["Copied From URL"]
                     root      = info["Repository Root"]
                     from_file = urllib.unquote(url[len(root):])
-                    result.append(from_line.replace(to_file, from_file))
+                    yield from_line.replace(to_file, from_file)
                 else:
-                    result.append(from_line) #as is, no copy performed
+                    yield from_line #as is, no copy performed
 
             # We only mangle '---' lines. All others get added straight to
             # the output.
-            result.append(line)
+            yield line
 
-        return result
-
-    def convert_to_absolute_paths(self, diff_content, repository_info):
+    def convert_to_absolute_paths(self, diff_content, repository_info,
+                                  svn_info_map=None):
         """
         Converts relative paths in a diff output to absolute paths.
         This handles paths that have been svn switched to other parts of the
         repository.
-        """
 
-        result = []
+        If svn_info_map is provided, file information is looked up there
+        instead of by running 'svn info'.
+        """
+        return list(self._iter_absolute_paths(diff_content, repository_info,
+                                              svn_info_map))
 
+    def _iter_absolute_paths(self, diff_content, repository_info,
+                             svn_info_map=None):
+        """
+        Yields the lines of a diff with relative paths converted to absolute
+        paths, without holding on to the diff.
+        """
         for line in diff_content:
             front = None
             orig_line = line
@@ -237,9 +333,9 @@ class SVNClient(SCMClient):
                         path = urllib.unquote(
                             "%s/%s" % (repository_info.base_path, file))
                     else:
-                        info = self.svn_info(file, True)
+                        info = self._lookup_svn_info(file, svn_info_map)
                         if info is None:
-                            result.append(orig_line)
+                            yield orig_line
                             continue
                         url  = info["URL"]
                         root = info["Repository Root"]
@@ -247,12 +343,19 @@ class SVNClient(SCMClient):
 
                     line = front + " " + path + rest
 
-            result.append(line)
-
-        return result
+            yield line
 
     def svn_info(self, path, ignore_errors=False):
         """Return a dict which is the result of 'svn info' at a given path."""
+        if not self.options.repository_url:
+            wcdb = self.get_working_copy_db()
+
+            if wcdb:
+                svninfo = wcdb.get_info(path)
+
+                if svninfo is not None:
+                    return svninfo
+
         svninfo = {}
         result = execute(["svn", "info", path],
                          split_lines=True,
@@ -269,6 +372,96 @@ class SVNClient(SCMClient):
 
         return svninfo
 
+    def batch_svn_info(self, paths):
+        """
+        Returns a map of paths to the result of 'svn info' on each path,
+        in the same form as svn_info().
+
+        This runs 'svn info --xml' on many paths at once instead of once per
+        path. Paths that can't be looked up are left out of the map.
+        """
+        svn_info_map = {}
+
+        if not self.options.repository_url:
+            wcdb = self.get_working_copy_db()
+
+            if wcdb:
+                # Only ask svn about the paths the working copy database
+                # couldn't tell us about.
+                remaining_paths = []
+
+                for path in paths:
+                    svninfo = wcdb.get_info(path)
+
+                    if svninfo is None:
+                        remaining_paths.append(path)
+                    else:
+                        svn_info_map[path] = svninfo
+
+                paths = remaining_paths
+
+        for i in range(0, len(paths), self.SVN_INFO_BATCH_SIZE):
+            batch = paths[i:i + self.SVN_INFO_BATCH_SIZE]
+
+            # Paths that aren't under version control cause a warning and
+            # a non-zero return code, but don't stop the others from being
+            # looked up.
+            data = execute(["svn", "info", "--xml"] + batch,
+                           ignore_errors=True,
+                           with_errors=False)
+
+            try:
+                svn_info_map.update(self._parse_svn_info_xml(data))
+            except (ExpatError, SyntaxError):
+                # Older versions of svn may have given up part way through,
+                # leaving us with broken XML. Look these up one by one.
+                logging.debug("Unable to parse 'svn info --xml' output. "
+                              "Falling back to 'svn info' for each file.")
+
+                for path in batch:
+                    info = self.svn_info(path, True)
+
+                    if info is not None:
+                        svn_info_map[path] = info
+
+        return svn_info_map
+
+    def _parse_svn_info_xml(self, data):
+        """
+        Parses the output of 'svn info --xml' into a map of paths to
+        'svn info' results.
+        """
+        svn_info_map = {}
+
+        for entry in ElementTree.fromstring(data).findall('entry'):
+            svninfo = {}
+            url = entry.findtext('url')
+            root = entry.findtext('repository/root')
+            copied_from = entry.findtext('wc-info/copy-from-url')
+
+            if url:
+                svninfo['URL'] = url
+
+            if root:
+                svninfo['Repository Root'] = root
+
+            if copied_from:
+                svninfo['Copied From URL'] = copied_from
+
+            svn_info_map[entry.get('path')] = svninfo
+
+        return svn_info_map
+
+    def _lookup_svn_info(self, path, svn_info_map):
+        """
+        Returns the 'svn info' result for a path, from svn_info_map if it
+        was provided.
+        """
+        if svn_info_map is None:
+            return self.svn_info(path, True)
+
+        return svn_info_map.get(path)
+
     # Adapted from server code parser.py
     def parse_filename_header(self, s):
         parts = None
@@ -294,6 +487,248 @@ class SVNClient(SCMClient):
         return [s.split('\n')[0], '\n']
 
 
+def find_working_copy_db(path):
+    """
+    Returns an SVNWorkingCopyDB for the working copy containing path, or
+    None if there isn't one we can read.
+    """
+    if sqlite3 is None:
+        return None
+
+    for wcroot in walk_parents(os.path.abspath(path)):
+        db_path = os.path.join(wcroot, '.svn', 'wc.db')
+
+        if os.path.exists(db_path):
+            break
+    else:
+        return None
+
+    try:
+        wcdb = SVNWorkingCopyDB(wcroot, db_path)
+    except sqlite3.Error, e:
+        logging.debug('Unable to read %s: %s' % (db_path, e))
+        return None
+
+    if wcdb.format not in SVNWorkingCopyDB.SUPPORTED_FORMATS:
+        logging.debug('Unsupported working copy format %s in %s. Using '
+                      'svn info instead.' % (wcdb.format, db_path))
+        wcdb.close()
+        return None
+
+    return wcdb
+
+
+class SVNWorkingCopyDB(object):
+    """
+    A reader for the .svn/wc.db metadata database of a Subversion 1.7+
+    working copy.
+
+    This answers the questions we'd otherwise ask 'svn info' (the URL,
+    Repository Root, Repository UUID and Copied From URL of a file) using
+    read-only queries, without starting svn at all. The nodes for the
+    current directory and everything under it are loaded with a single
+    query the first time they're needed, so looking up a file after that is
+    just a dictionary lookup.
+    """
+    # The wc.db formats (stored as the database's user_version) that we know
+    # how to read. 29 is Subversion 1.7, and 31 is 1.8 and newer.
+    SUPPORTED_FORMATS = (29, 30, 31)
+
+    # Presences for nodes that don't really exist in the working copy.
+    ABSENT_PRESENCES = ('not-present', 'excluded', 'server-excluded')
+
+    # Characters that svn doesn't escape in URLs.
+    URL_SAFE_CHARS = "/!$&'()*+,;=:@~"
+
+    NODES_QUERY = (
+        'SELECT n.local_relpath, n.op_depth, n.presence, n.repos_path, '
+        '       r.root, r.uuid '
+        '  FROM nodes n LEFT OUTER JOIN repository r ON n.repos_id = r.id '
+        ' WHERE n.wc_id = ? ')
+
+    def __init__(self, wcroot, db_path):
+        self.wcroot = wcroot
+        self.db_path = db_path
+        self._db = sqlite3.connect(db_path)
+        self._nodes = {}
+        self._loaded = False
+
+        cursor = self._db.execute('PRAGMA user_version')
+        self.format = cursor.fetchone()[0]
+
+        if self.format in self.SUPPORTED_FORMATS:
+            cursor = self._db.execute(
+                'SELECT id FROM wcroot WHERE local_abspath IS NULL')
+            self._wc_id = cursor.fetchone()[0]
+
+    def close(self):
+        self._db.close()
+
+    def get_info(self, path):
+        """
+        Returns a dict like the result of 'svn info' for path, or None if
+        the path isn't in the working copy or can't be looked up.
+        """
+        relpath = self._get_relpath(path)
+
+        if relpath is None:
+            return None
+
+        try:
+            if not self._loaded:
+                self._loaded = True
+                self._load_subtree(self._get_relpath(os.getcwd()) or '')
+
+            node = self._get_node(relpath)
+
+            if node is None:
+                return None
+
+            root, uuid = self._get_repository(relpath)
+            url = self._get_url(relpath)
+        except sqlite3.Error, e:
+            logging.debug('Unable to look up %s in %s: %s'
+                          % (path, self.db_path, e))
+            return None
+
+        if not root or not url:
+            return None
+
+        info = {
+            'URL': url,
+            'Repository Root': root,
+            'Repository UUID': uuid,
+        }
+
+        op_depth, presence, repos_path, node_root, node_uuid = node
+
+        # Copies and moves store their source in the working node at the
+        # root of the copy. svn info only reports it for that node.
+        if (op_depth > 0 and op_depth == self._get_depth(relpath) and
+            repos_path is not None):
+            info['Copied From URL'] = self._make_url(node_root, repos_path)
+
+        return info
+
+    def _get_relpath(self, path):
+        path = os.path.abspath(path)
+
+        if path == self.wcroot:
+            return ''
+
+        prefix = os.path.join(self.wcroot, '')
+
+        if not path.startswith(prefix):
+            return None
+
+        return path[len(prefix):].replace(os.sep, '/')
+
+    def _get_depth(self, relpath):
+        if relpath:
+            return relpath.count('/') + 1
+
+        return 0
+
+    def _load_subtree(self, relpath):
+        """Loads the nodes for relpath and everything under it."""
+        if relpath:
+            # Children sort between "relpath/" and "relpath0", since '0'
+            # comes right after '/'.
+            cursor = self._db.execute(
+                self.NODES_QUERY +
+                '   AND (n.local_relpath = ? OR '
+                '        (n.local_relpath > ? AND n.local_relpath < ?))',
+                (self._wc_id, relpath, relpath + '/', relpath + '0'))
+        else:
+            cursor = self._db.execute(self.NODES_QUERY, (self._wc_id,))
+
+        self._add_nodes(cursor)
+
+    def _add_nodes(self, rows):
+        for local_relpath, op_depth, presence, repos_path, root, uuid in rows:
+            if presence == 'base-deleted':
+                # This only marks the node below it as deleted, and svn info
+                # reports on the node below.
+                continue
+
+            # Only the top-most layer of each node is the one in the working
+            # copy.
+            node = self._nodes.get(local_relpath)
+
+            if node is None or op_depth > node[0]:
+                self._nodes[local_relpath] = (op_depth, presence, repos_path,
+                                              root, uuid)
+
+    def _get_node(self, relpath):
+        if relpath not in self._nodes:
+            # This is outside of what we've loaded so far.
+            self._add_nodes(self._db.execute(
+                self.NODES_QUERY + '   AND n.local_relpath = ?',
+                (self._wc_id, relpath)))
+
+            if relpath not in self._nodes:
+                self._nodes[relpath] = None
+
+        node = self._nodes[relpath]
+
+        if node is None or node[1] in self.ABSENT_PRESENCES:
+            return None
+
+        return node
+
+    def _get_repository(self, relpath):
+        """
+        Returns the repository root and UUID for a node. Added nodes don't
+        store them, so these come from the closest parent that does.
+        """
+        while True:
+            node = self._get_node(relpath)
+
+            if node is None:
+                return None, None
+
+            if node[3]:
+                return node[3], node[4]
+
+            if not relpath:
+                return None, None
+
+            relpath = relpath.rpartition('/')[0]
+
+    def _get_url(self, relpath):
+        """
+        Returns the URL of a node. Only nodes that are unchanged in the
+        working copy store it. For added, copied or moved nodes, it's the
+        URL of the parent followed by the node's name.
+        """
+        node = self._get_node(relpath)
+
+        if node is None:
+            return None
+
+        op_depth, presence, repos_path, root, uuid = node
+
+        if op_depth == 0:
+            return self._make_url(root, repos_path)
+
+        if not relpath:
+            return None
+
+        parent_relpath, name = relpath.rpartition('/')[::2]
+        parent_url = self._get_url(parent_relpath)
+
+        if parent_url is None:
+            return None
+
+        return '%s/%s' % (parent_url, urllib.quote(name, self.URL_SAFE_CHARS))
+
+    def _make_url(self, root, repos_path):
+        if not repos_path:
+            return root
+
+        return '%s/%s' % (root, urllib.quote(repos_path, self.URL_SAFE_CHARS))
+
+
 class SVNRepositoryInfo(RepositoryInfo):
     """
     A representation of a SVN source code repository. This version knows how to
@@ -5,13 +5,17 @@ import time
 from nose import SkipTest
 from nose.tools import raises
 from random import randint
+from tempfile import mkdtemp
 from textwrap import dedent
 
 from rbtools.clients import RepositoryInfo
+from rbtools.clients.clearcase import ClearCaseClient, ClearToolSession
+from rbtools.clients.cvs import CVSClient
 from rbtools.clients.git import GitClient
 from rbtools.clients.mercurial import MercurialClient
 from rbtools.clients.perforce import PerforceClient
-from rbtools.clients.svn import SVNRepositoryInfo
+from rbtools.clients.plastic import PlasticClient
+from rbtools.clients.svn import SVNClient, SVNRepositoryInfo
 from rbtools.tests import OptionsStub
 from rbtools.utils.filesystem import load_config_files
 from rbtools.utils.process import execute
@@ -21,6 +25,39 @@ from rbtools.utils.testbase import RBTestBase
 class SCMClientTests(RBTestBase):
     def setUp(self):
         self.options = OptionsStub()
+        self._saved_path = None
+
+    def tearDown(self):
+        if self._saved_path is not None:
+            os.environ['PATH'] = self._saved_path
+            self._saved_path = None
+
+    def install_fake_tool(self, name, script, bin_dir=None):
+        """Installs a Python script as the named tool.
+
+        The script goes in bin_dir, or a new temporary directory, which is
+        put at the front of PATH. PATH is restored in tearDown. Clients
+        are also set to run two jobs at a time, so their parallel paths
+        are exercised. Returns the directory.
+        """
+        if self._saved_path is None:
+            self._saved_path = os.environ['PATH']
+
+        if bin_dir is None:
+            bin_dir = mkdtemp()
+        elif not os.path.isdir(bin_dir):
+            os.makedirs(bin_dir)
+
+        tool_path = os.path.join(bin_dir, name)
+        fp = open(tool_path, 'w')
+        fp.write('#!%s\n%s' % (sys.executable, script))
+        fp.close()
+        os.chmod(tool_path, 0755)
+
+        os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+        self.options.jobs = 2
+
+        return bin_dir
 
 
 class GitClientTests(SCMClientTests):
@@ -320,6 +357,49 @@ class GitClientTests(SCMClientTests):
         self.client.get_repository_info()
         self.assertEqual(self.client.diff(None), (diff, None))
 
+    def test_diff_series(self):
+        """Test GitClient diff_series with multiple commits"""
+        self.client.get_repository_info()
+        base = self._gitcmd(['rev-parse', 'HEAD']).strip()
+
+        self._git_add_file_commit('foo.txt', FOO1, 'commit 1')
+        commit1 = self._gitcmd(['rev-parse', 'HEAD']).strip()
+        self._git_add_file_commit('foo.txt', FOO2, 'commit 2')
+        commit2 = self._gitcmd(['rev-parse', 'HEAD']).strip()
+
+        series = list(self.client.diff_series())
+
+        self.assertEqual(len(series), 2)
+        self.assertEqual(series[0],
+                         (commit1, self.client.make_diff(base, commit1),
+                          None))
+        self.assertEqual(series[1],
+                         (commit2, self.client.make_diff(commit1, commit2),
+                          self.client.make_diff(base, commit1)))
+        self.assertEqual(self.client.rev_range_for_diff, (commit1, commit2))
+
+        series = list(self.client.diff_series(parent_diffs=False))
+        self.assertEqual(series[1],
+                         (commit2, self.client.make_diff(commit1, commit2),
+                          None))
+
+    def test_diff_cache(self):
+        """Test GitClient reusing cached diffs of the same commits"""
+        self.set_user_home_tmp()
+        self.options.diff_cache = True
+        self.client.get_repository_info()
+        self._git_add_file_commit('foo.txt', FOO1, 'delete and modify stuff')
+
+        diff = self.client.diff(None)
+        cache_key = self.client._get_diff_cache_key(
+            self.client.merge_base, 'HEAD', self.client.GIT_DIFF_ARGS)
+        self.assertEqual(self.client._get_diff_cache().get(cache_key),
+                         diff[0])
+
+        # A cache hit must be used in place of running git diff.
+        self.client._get_diff_cache().set(cache_key, 'cached diff')
+        self.assertEqual(self.client.diff(None), ('cached diff', None))
+
 
 class MercurialTestBase(SCMClientTests):
 
@@ -430,6 +510,84 @@ class MercurialClientTests(MercurialTestBase):
         self.assertTrue(ri.supports_parent_diffs)
         self.assertFalse(ri.supports_changesets)
 
+    def testLoadHgrc(self):
+        """Test MercurialClient reading the hgrc without running hg"""
+        hgrc = open(self.clone_hgrc_path, 'a')
+        hgrc.write(dedent("""
+        ; comment
+        %include extra.rc
+
+        [paths]
+        %unset cloned
+        """))
+        hgrc.close()
+
+        extra = open(os.path.join(self.clone_dir, '.hg', 'extra.rc'), 'w')
+        extra.write(dedent("""
+        [ui]
+        username = Someone
+          Else
+        """))
+        extra.close()
+
+        # Keep the system and user hgrc files out of the result.
+        old_hgrcpath = os.environ.get('HGRCPATH')
+        os.environ['HGRCPATH'] = os.devnull
+
+        try:
+            self.client.hgrc = {}
+            self.client._load_hgrc()
+        finally:
+            if old_hgrcpath is None:
+                del os.environ['HGRCPATH']
+            else:
+                os.environ['HGRCPATH'] = old_hgrcpath
+
+        self.assertEqual(self.client.hgrc, {
+            'paths.default': self.hg_dir,
+            'reviewboard.url': self.TESTSERVER,
+            'diff.git': 'true',
+            'ui.username': 'Someone\nElse',
+        })
+
+    def testLoadHgrcUnparseable(self):
+        """Test MercurialClient running hg showconfig for a bad hgrc"""
+        hgrc = open(self.clone_hgrc_path, 'a')
+        hgrc.write('\nnot an item\n')
+        hgrc.close()
+
+        showconfigs = []
+        self.client._load_showconfig = lambda: showconfigs.append(True)
+        self.client.hgrc = {}
+        self.client._load_hgrc()
+
+        self.assertEqual(showconfigs, [True])
+
+    def testHgrcPathsInstallPrefix(self):
+        """Test MercurialClient reading the hgrc under hg's prefix"""
+        if sys.platform.startswith('win'):
+            raise SkipTest('Windows uses the install directory')
+
+        prefix = mkdtemp()
+        self.install_fake_tool('hg', '', os.path.join(prefix, 'bin'))
+        old_hgrcpath = os.environ.pop('HGRCPATH', None)
+
+        try:
+            paths = self.client._get_hgrc_paths()
+        finally:
+            if old_hgrcpath is not None:
+                os.environ['HGRCPATH'] = old_hgrcpath
+
+        self.assertEqual(paths[0],
+                         os.path.join(prefix, 'etc', 'mercurial', 'hgrc'))
+
+    def testUsesHgsubversion(self):
+        """Test MercurialClient detecting hgsubversion metadata"""
+        self.assertFalse(self.client._uses_hgsubversion())
+
+        os.mkdir(os.path.join(self.clone_dir, '.hg', 'svn'))
+        self.assertTrue(self.client._uses_hgsubversion())
+
     def testScanForServerSimple(self):
         """Test MercurialClient scan_for_server, simple case"""
         os.rename(self.clone_hgrc_path,
@@ -480,6 +638,86 @@ class MercurialClientTests(MercurialTestBase):
 
         self.assertEqual((EXPECTED_HG_DIFF_1, None), diff_result)
 
+    def testDiffCommandServer(self):
+        """Test MercurialClient diff through the command server"""
+        self.client.get_repository_info()
+        self._hg_add_file_commit('foo.txt', FOO1, 'delete and modify stuff')
+
+        self.assertEqual((EXPECTED_HG_DIFF_0, None), self.client.diff(None))
+        self.assertTrue(self.client._cmdserver._process is not None)
+
+        # Closing the client stops the command server, and it's started
+        # again for the next command.
+        process = self.client._cmdserver._process
+        self.client.close()
+        self.assertTrue(self.client._cmdserver._process is None)
+        self.assertEqual(process.returncode, 0)
+        self.assertEqual((EXPECTED_HG_DIFF_0, None), self.client.diff(None))
+        self.assertTrue(self.client._cmdserver._process is not None)
+
+        # Commands fall back to running hg if the command server goes away.
+        self.client._cmdserver._process.kill()
+        self.client._cmdserver._process.wait()
+        self.assertEqual((EXPECTED_HG_DIFF_0, None), self.client.diff(None))
+        self.assertFalse(self.client._cmdserver._available)
+
+    def testDiffRemoteOutgoing(self):
+        """Test MercurialClient diff comparing with the remote"""
+        self.client.get_repository_info()
+        self._hg_add_file_commit('foo.txt', FOO1, 'delete and modify stuff')
+
+        self.options.hg_remote_outgoing = True
+        self.assertEqual((EXPECTED_HG_DIFF_0, None), self.client.diff(None))
+
+    def testDiffPushed(self):
+        """Test MercurialClient diff after pushing to the remote"""
+        self.client.get_repository_info()
+        self._hg_add_file_commit('foo.txt', FOO1, 'delete and modify stuff')
+        self._hgcmd(['push'])
+
+        self.assertEqual(('', None), self.client.diff(None))
+
+    def testDiffExplicitParent(self):
+        """Test MercurialClient diff comparing with the remote for --parent"""
+        self.client.get_repository_info()
+        self._hg_add_file_commit('foo.txt', FOO1, 'delete and modify stuff')
+
+        # The changeset is public without having been pushed, so it's
+        # only found by comparing with the remote.
+        self._hgcmd(['phase', '--public', '.'])
+        self.assertEqual(('', None), self.client.diff(None))
+
+        self.options.parent_branch = 'default'
+        self.assertEqual((EXPECTED_HG_DIFF_0, None), self.client.diff(None))
+
+    def testDiffGuessSummaryDescription(self):
+        """Test MercurialClient diff guessing summary and description"""
+        self.client.get_repository_info()
+
+        self._hg_add_file_commit('foo.txt', FOO1, 'commit 1\n\nmore')
+        self._hg_add_file_commit('foo.txt', FOO2, 'commit 2')
+        self._hg_add_file_commit('foo.txt', FOO3, 'commit 3')
+
+        self.options.guess_summary = True
+        self.options.guess_description = True
+        self.assertEqual((EXPECTED_HG_DIFF_1, None), self.client.diff(None))
+        self.assertEqual('commit 3', self.options.summary)
+        self.assertEqual('commit 3\n\ncommit 2\n\ncommit 1\n\nmore',
+                         self.options.description)
+
+    def testGetChangesetsInfo(self):
+        """Test MercurialClient describing changesets with one revset"""
+        self.client.get_repository_info()
+        self._hg_add_file_commit('foo.txt', FOO1, 'commit 1')
+        self._hg_add_file_commit('foo.txt', FOO2, 'commit 2')
+        self._hg_add_file_commit('foo.txt', FOO3, 'commit 3')
+
+        # Only the changesets asked for are described.
+        self.assertEqual(self.client._get_changesets_info([3, 1]), {
+            1: {'parents': [], 'desc': 'commit 1'},
+            3: {'parents': [], 'desc': 'commit 3'},
+        })
+
     def testDiffBranchDiverge(self):
         """Test MercurialClient diff with diverged branch"""
         self._hg_add_file_commit('foo.txt', FOO1, 'commit 1')
@@ -699,10 +937,150 @@ class SVNClientTests(SCMClientTests):
             '/')
 
 
+    def test_parse_svn_info_xml(self):
+        """Testing SVNClient._parse_svn_info_xml"""
+        client = SVNClient(options=self.options)
+        svn_info_map = client._parse_svn_info_xml(SVN_INFO_XML)
+
+        self.assertEqual(svn_info_map, {
+            'foo.txt': {
+                'URL': 'http://svn.example.com/svn/trunk/foo.txt',
+                'Repository Root': 'http://svn.example.com/svn',
+            },
+            'dir/bar.txt': {
+                'URL': 'http://svn.example.com/svn/branches/x/bar.txt',
+                'Repository Root': 'http://svn.example.com/svn',
+                'Copied From URL':
+                    'http://svn.example.com/svn/trunk/old%20bar.txt',
+            },
+        })
+
+    def test_diff_paths_with_svn_info_map(self):
+        """Testing SVNClient diff path handling with looked up svn info"""
+        client = SVNClient(options=self.options)
+        svn_info_map = client._parse_svn_info_xml(SVN_INFO_XML)
+        diff = [
+            'Index: dir/bar.txt\n',
+            '=' * 67 + '\n',
+            '--- dir/bar.txt\t(revision 3)\n',
+            '+++ dir/bar.txt\t(working copy)\n',
+            '@@ -1 +1 @@\n',
+        ]
+
+        diff = client.handle_renames(diff, svn_info_map)
+        diff = client.convert_to_absolute_paths(diff, None, svn_info_map)
+
+        self.assertEqual(diff, [
+            'Index: /branches/x/bar.txt\n',
+            '=' * 67 + '\n',
+            '--- /trunk/old bar.txt\t(revision 3)\n',
+            '+++ /branches/x/bar.txt\t(working copy)\n',
+            '@@ -1 +1 @@\n',
+        ])
+
+    def test_do_diff_working_copy(self):
+        """Testing SVNClient streaming a working copy diff"""
+        client = SVNClient(options=self.options)
+        svn_info_map = client._parse_svn_info_xml(SVN_INFO_XML)
+        client.batch_svn_info = lambda paths: svn_info_map
+        diff = ''.join([
+            'Index: dir/bar.txt\n',
+            '=' * 67 + '\n',
+            '--- dir/bar.txt\t(revision 3)\n',
+            '+++ dir/bar.txt\t(working copy)\n',
+            '@@ -1 +1 @@\n',
+        ])
+
+        diff = client.do_diff([sys.executable, '-c',
+                               'import sys; sys.stdout.write(%r)' % diff])
+
+        self.assertEqual(diff, ''.join([
+            'Index: /branches/x/bar.txt\n',
+            '=' * 67 + '\n',
+            '--- /trunk/old bar.txt\t(revision 3)\n',
+            '+++ /branches/x/bar.txt\t(working copy)\n',
+            '@@ -1 +1 @@\n',
+        ]))
+
+    def test_working_copy_db(self):
+        """Testing SVNClient reading svn info from the working copy database"""
+        try:
+            import sqlite3
+        except ImportError:
+            raise SkipTest('sqlite3 is not available')
+
+        wcroot = os.path.realpath(self.chdir_tmp())
+        os.mkdir('.svn')
+        os.mkdir('dir')
+
+        db = sqlite3.connect(os.path.join('.svn', 'wc.db'))
+        db.executescript("""
+            PRAGMA user_version = 31;
+            CREATE TABLE repository (id INTEGER PRIMARY KEY, root TEXT,
+                                     uuid TEXT);
+            CREATE TABLE wcroot (id INTEGER PRIMARY KEY, local_abspath TEXT);
+            CREATE TABLE nodes (wc_id INTEGER, local_relpath TEXT,
+                                op_depth INTEGER, repos_id INTEGER,
+                                repos_path TEXT, presence TEXT);
+            INSERT INTO repository VALUES (1, 'http://svn.example.com/svn',
+                                           'a0a7c05d');
+            INSERT INTO wcroot VALUES (1, NULL);
+            INSERT INTO nodes VALUES (1, '', 0, 1, 'trunk', 'normal');
+            INSERT INTO nodes VALUES (1, 'dir', 0, 1, 'trunk/dir', 'normal');
+            INSERT INTO nodes VALUES (1, 'dir/foo.txt', 0, 1,
+                                      'trunk/dir/foo.txt', 'normal');
+            INSERT INTO nodes VALUES (1, 'dir/new bar.txt', 2, 1,
+                                      'trunk/old bar.txt', 'normal');
+            INSERT INTO nodes VALUES (1, 'dir/added.txt', 2, NULL, NULL,
+                                      'normal');
+            INSERT INTO nodes VALUES (1, 'dir/gone.txt', 0, 1,
+                                      'trunk/dir/gone.txt', 'not-present');
+        """)
+        db.commit()
+        db.close()
+
+        client = SVNClient(options=self.options)
+        self.assertEqual(client.get_working_copy_db().get_info('.'), {
+            'URL': 'http://svn.example.com/svn/trunk',
+            'Repository Root': 'http://svn.example.com/svn',
+            'Repository UUID': 'a0a7c05d',
+        })
+
+        os.chdir('dir')
+        client = SVNClient(options=self.options)
+        self.assertEqual(client.get_working_copy_db().wcroot, wcroot)
+        self.assertEqual(client.svn_info('foo.txt'), {
+            'URL': 'http://svn.example.com/svn/trunk/dir/foo.txt',
+            'Repository Root': 'http://svn.example.com/svn',
+            'Repository UUID': 'a0a7c05d',
+        })
+        self.assertEqual(client.batch_svn_info(['new bar.txt', 'added.txt']), {
+            'new bar.txt': {
+                'URL': 'http://svn.example.com/svn/trunk/dir/new%20bar.txt',
+                'Repository Root': 'http://svn.example.com/svn',
+                'Repository UUID': 'a0a7c05d',
+                'Copied From URL':
+                    'http://svn.example.com/svn/trunk/old%20bar.txt',
+            },
+            'added.txt': {
+                'URL': 'http://svn.example.com/svn/trunk/dir/added.txt',
+                'Repository Root': 'http://svn.example.com/svn',
+                'Repository UUID': 'a0a7c05d',
+            },
+        })
+        self.assertEqual(
+            client.get_working_copy_db().get_info('gone.txt'), None)
+
+
 class PerforceClientTests(SCMClientTests):
     def setUp(self):
         super(PerforceClientTests, self).setUp()
 
+        self.chdir_tmp()
+
+        # A stand-in for p4, serving the depot described in FAKE_P4.
+        self.install_fake_tool('p4', FAKE_P4)
+
     @raises(SystemExit)
     def test_error_on_revision_range(self):
         """Testing that passing a revision_range causes the client to exit."""
@@ -710,6 +1088,611 @@ class PerforceClientTests(SCMClientTests):
         client = PerforceClient(options=self.options)
         client.check_options()
 
+    def test_print_files(self):
+        """Testing PerforceClient fetching many files with one p4 print"""
+        client = PerforceClient(options=self.options)
+        depot_paths = ['//depot/foo.txt#1', '//depot/foo.txt#2',
+                       '//depot/empty.txt#1']
+        tmpfiles = client._print_files(depot_paths)
+
+        self.assertEqual(len(tmpfiles), 3)
+        self.assertEqual([open(tmpfile).read() for tmpfile in tmpfiles],
+                         ['foo 1\ncommon\n', 'foo 2\ncommon\n', ''])
+
+    def test_print_files_cached(self):
+        """Testing PerforceClient caching file revisions from the depot"""
+        self.set_user_home_tmp()
+        self.options.diff_cache = True
+        log_file = os.path.join(self.create_tmp_dir(), 'p4.log')
+        os.environ['FAKE_P4_LOG'] = log_file
+
+        try:
+            client = PerforceClient(options=self.options)
+            client.p4_server_address = 'perforce:1666'
+            depot_paths = ['//depot/foo.txt#1', '//depot/foo.txt#2']
+
+            tmpfiles = client._print_files(depot_paths)
+            self.assertEqual(open(tmpfiles[1]).read(), 'foo 2\ncommon\n')
+            self.assertEqual(len(open(log_file).readlines()), 1)
+
+            # Everything comes from the cache the second time.
+            tmpfiles = client._print_files(depot_paths + ['//depot/bar.txt#3'])
+            self.assertEqual([open(tmpfile).read() for tmpfile in tmpfiles],
+                             ['foo 1\ncommon\n', 'foo 2\ncommon\n',
+                              'bar 3\ncommon\n'])
+            log = open(log_file).readlines()
+            self.assertEqual(len(log), 2)
+
+            # The entries stored without digests aren't trusted when
+            # verifying them.
+            self.options.p4_verify_cache = True
+            client._print_files(depot_paths)
+            log = open(log_file).readlines()
+            self.assertEqual(len(log), 4)
+            self.assertTrue(' fstat -Ol' in log[2])
+            self.assertTrue(log[3].endswith(' print\n'))
+
+            client._print_files(depot_paths)
+            log = open(log_file).readlines()
+            self.assertEqual(len(log), 5)
+            self.assertTrue(' fstat -Ol' in log[4])
+        finally:
+            del os.environ['FAKE_P4_LOG']
+
+    def test_print_files_too_large_to_cache(self):
+        """Testing PerforceClient not caching large file revisions"""
+        self.set_user_home_tmp()
+        self.options.diff_cache = True
+        log_file = os.path.join(self.create_tmp_dir(), 'p4.log')
+        os.environ['FAKE_P4_LOG'] = log_file
+
+        try:
+            client = PerforceClient(options=self.options)
+            client.p4_server_address = 'perforce:1666'
+            client.P4_CACHE_MAX_FILE_SIZE = 8
+
+            for i in range(2):
+                tmpfiles = client._print_files(['//depot/foo.txt#1'])
+                self.assertEqual(open(tmpfiles[0]).read(),
+                                 'foo 1\ncommon\n')
+
+            self.assertEqual(len(open(log_file).readlines()), 2)
+        finally:
+            del os.environ['FAKE_P4_LOG']
+
+    def test_diff_entries(self):
+        """Testing PerforceClient diffing files fetched in batches"""
+        client = PerforceClient(options=self.options)
+        entries = [
+            ('//depot/file%d.txt' % i, 1, 'M', '//depot/file%d.txt#1' % i,
+             '//depot/file%d.txt#2' % i, False)
+            for i in range(5)
+        ]
+        entries.append(('//depot/new.txt', 0, 'A', None, '//depot/new.txt#1',
+                        False))
+
+        diff_lines = client._diff_entries(entries).getvalue().splitlines(True)
+        headers = [line for line in diff_lines if line.startswith('--- ')]
+
+        self.assertEqual(headers, [
+            '--- //depot/file0.txt\t//depot/file0.txt#1\n',
+            '--- //depot/file1.txt\t//depot/file1.txt#1\n',
+            '--- //depot/file2.txt\t//depot/file2.txt#1\n',
+            '--- //depot/file3.txt\t//depot/file3.txt#1\n',
+            '--- //depot/file4.txt\t//depot/file4.txt#1\n',
+            '--- //depot/new.txt\t//depot/new.txt#0\n',
+        ])
+        self.assertTrue('-file0 1\n' in diff_lines)
+        self.assertTrue('+file0 2\n' in diff_lines)
+        self.assertTrue('+new 1\n' in diff_lines)
+
+    def test_changenum_diff_submitted(self):
+        """Testing PerforceClient diffing a submitted changelist"""
+        client = PerforceClient(options=self.options)
+        client.p4d_version = (2010, 1)
+        diff, parent_diff = client._changenum_diff('42')
+        diff = diff.getvalue()
+
+        self.assertEqual(
+            [line for line in diff.splitlines(True)
+             if line.startswith('--- ')],
+            ['--- //depot/foo.txt\t//depot/foo.txt#1\n',
+             '--- //depot/new.txt\t//depot/new.txt#0\n',
+             '--- //depot/old.txt\t//depot/old.txt#2\n'])
+        self.assertTrue('-foo 1\n+foo 2\n' in diff)
+        self.assertTrue('+new 1\n' in diff)
+        self.assertTrue('-old 2\n' in diff)
+
+    def test_changenum_diff_pending(self):
+        """Testing PerforceClient diffing a pending changelist"""
+        root = self.create_tmp_dir()
+        os.environ['FAKE_P4_ROOT'] = root
+
+        try:
+            fp = open(os.path.join(root, 'foo.txt'), 'w')
+            fp.write('foo local\ncommon\n')
+            fp.close()
+
+            client = PerforceClient(options=self.options)
+            client.p4d_version = (2010, 1)
+            diff, parent_diff = client._changenum_diff('default')
+        finally:
+            del os.environ['FAKE_P4_ROOT']
+
+        diff = diff.getvalue()
+
+        self.assertTrue(diff.startswith(
+            '--- //depot/foo.txt\t//depot/foo.txt#2\n'))
+        self.assertTrue('-foo 2\n+foo local\n' in diff)
+
+    @raises(SystemExit)
+    def test_changenum_diff_unknown(self):
+        """Testing PerforceClient diffing a changelist that doesn't exist"""
+        client = PerforceClient(options=self.options)
+        client.p4d_version = (2010, 1)
+        client._changenum_diff('1000')
+
+    def test_describe_change_errors(self):
+        """Testing PerforceClient telling p4 errors from unknown changes"""
+        client = PerforceClient(options=self.options)
+
+        self.assertEqual(client._describe_change('1000'), None)
+        self.assertRaises(SystemExit, client._describe_change, 'locked')
+
+    def test_opened_files(self):
+        """Testing PerforceClient listing the files opened in a changelist"""
+        client = PerforceClient(options=self.options)
+
+        self.assertEqual(
+            [(f.depot_path, f.revision, f.action)
+             for f in client._iter_opened_files('default')],
+            [('//depot/foo.txt', 2, 'edit')])
+
+    def test_path_diff_skips_same_digests(self):
+        """Testing PerforceClient skipping revisions with the same digests"""
+        client = PerforceClient(options=self.options)
+        entries = [
+            ('//depot/foo.txt', 1, 'M', '//depot/foo.txt#1',
+             '//depot/foo.txt#3', False),
+            ('//depot/same.txt', 2, 'M', '//depot/same.txt#2',
+             '//depot/same.txt#5', False),
+            ('//depot/bar.txt', 0, 'A', None, '//depot/bar.txt#1', False),
+        ]
+
+        self.assertEqual(client._skip_unmodified_entries(entries),
+                         [entries[0], entries[2]])
+
+    def test_server_diffs(self):
+        """Testing PerforceClient using diffs generated by the p4 server"""
+        client = PerforceClient(options=self.options)
+        server_diffs = client._parse_server_diffs([
+            'Change 42 by user@client on 2012/01/01 12:00:00\n',
+            '\n',
+            '\tA description.\n',
+            '\n',
+            'Affected files ...\n',
+            '\n',
+            '... //depot/file0.txt#2 edit\n',
+            '... //depot/image.png#2 edit\n',
+            '... //depot/new.txt#1 add\n',
+            '\n',
+            'Differences ...\n',
+            '\n',
+            '==== //depot/file0.txt#2 (text) ====\n',
+            '\n',
+            '@@ -1,2 +1,2 @@\n',
+            '-server 1\n',
+            '+server 2\n',
+            ' common\n',
+            '==== //depot/image.png#2 (binary) ====\n',
+            '\n',
+            '==== //depot/new.txt#1 (text) ====\n',
+            '\n',
+        ])
+
+        self.assertEqual(server_diffs, {
+            ('//depot/file0.txt#1', '//depot/file0.txt#2'): [
+                '@@ -1,2 +1,2 @@\n',
+                '-server 1\n',
+                '+server 2\n',
+                ' common\n',
+            ],
+        })
+
+        entries = [
+            ('//depot/file0.txt', 1, 'M', '//depot/file0.txt#1',
+             '//depot/file0.txt#2', False),
+            ('//depot/new.txt', 0, 'A', None, '//depot/new.txt#1', False),
+        ]
+        diff_lines = client._diff_entries(
+            entries, server_diffs=server_diffs).getvalue().splitlines(True)
+
+        self.assertEqual(diff_lines[0],
+                         '--- //depot/file0.txt\t//depot/file0.txt#1\n')
+        self.assertTrue(diff_lines[1].startswith('+++ //depot/file0.txt\t'))
+        self.assertEqual(diff_lines[2:6], server_diffs[entries[0][3:5]])
+        self.assertEqual(diff_lines[6],
+                         '--- //depot/new.txt\t//depot/new.txt#0\n')
+        self.assertTrue('+new 1\n' in diff_lines)
+
+        # Ranges of depot paths are diffed with 'p4 diff2'.
+        self.assertEqual(client._parse_server_diffs([
+            '==== //depot/a.txt#1 (text) - //depot/a.txt#3 (text) '
+            '==== content\n',
+            '@@ -1 +1 @@\n',
+            '-a\n',
+            '+b\n',
+            '==== //depot/b.txt#2 (text) - //depot/b.txt#2 (text) '
+            '==== identical\n',
+            '==== <none> - //depot/c.txt#1 ====\n',
+        ]), {
+            ('//depot/a.txt#1', '//depot/a.txt#3'): [
+                '@@ -1 +1 @@\n', '-a\n', '+b\n',
+            ],
+        })
+
+
+class PlasticClientTests(SCMClientTests):
+    def setUp(self):
+        super(PlasticClientTests, self).setUp()
+
+        # A stand-in for cm, which can only cat file revisions.
+        self.install_fake_tool('cm', FAKE_CM)
+
+    def test_process_diffs(self):
+        """Testing PlasticClient fetching revisions in parallel"""
+        client = PlasticClient(options=self.options)
+        client.workspacedir = '/ws'
+        diff = client.process_diffs([
+            'C /ws/a.txt rev:revid:2 rev:revid:1 src: dst:\n',
+            'A /ws/b.txt rev:revid:3 rev:revid:-1 src: dst:\n',
+            'D /ws/c.txt rev:revid:4 rev:revid:5 src: dst:\n',
+        ])
+
+        self.assertEqual(diff, ''.join([
+            '--- /a.txt\trev:revid:1\n',
+            '+++ /a.txt\trev:revid:2\n',
+            '@@ -1,2 +1,2 @@\n',
+            '-revision 1\n',
+            '+revision 2\n',
+            ' common\n',
+            '--- /b.txt\trev:revid:-1\n',
+            '+++ /b.txt\trev:revid:3\n',
+            '@@ -0,0 +1,2 @@\n',
+            '+revision 3\n',
+            '+common\n',
+            '--- /c.txt\trev:revid:5\n',
+            '+++ /c.txt\trev:revid:4\n',
+            '@@ -1,2 +0,0 @@\n',
+            '-revision 5\n',
+            '-common\n',
+        ]))
+
+
+    def test_write_file_cached(self):
+        """Testing PlasticClient caching only small file revisions"""
+        self.set_user_home_tmp()
+        self.options.diff_cache = True
+        client = PlasticClient(options=self.options)
+        tmpfile = os.path.join(mkdtemp(), 'file')
+
+        client.write_file('/ws/a.txt', 'rev:revid:1', tmpfile)
+        self.assertEqual(
+            client._get_revision_cache().get(('plastic', '', 'rev:revid:1')),
+            'revision 1\ncommon\n')
+
+        client.PLASTIC_CACHE_MAX_FILE_SIZE = 4
+        client.write_file('/ws/a.txt', 'rev:revid:2', tmpfile)
+        self.assertEqual(open(tmpfile).read(), 'revision 2\ncommon\n')
+        self.assertEqual(
+            client._get_revision_cache().get(('plastic', '', 'rev:revid:2')),
+            None)
+
+
+class ClearCaseClientTests(SCMClientTests):
+    def setUp(self):
+        super(ClearCaseClientTests, self).setUp()
+        self.chdir_tmp()
+
+        # A stand-in for cleartool, describing any file that exists.
+        bin_dir = self.install_fake_tool('cleartool', FAKE_CLEARTOOL)
+        self.log_file = os.path.join(bin_dir, 'cleartool.log')
+        os.environ['FAKE_CLEARTOOL_LOG'] = self.log_file
+
+    def tearDown(self):
+        super(ClearCaseClientTests, self).tearDown()
+        del os.environ['FAKE_CLEARTOOL_LOG']
+
+    def _write_files(self, contents):
+        tmp_dir = self.create_tmp_dir()
+        paths = []
+
+        for name, content in contents:
+            path = os.path.join(tmp_dir, name)
+            fp = open(path, 'w')
+            fp.write(content)
+            fp.close()
+            paths.append(path)
+
+        return paths
+
+    def test_do_diff(self):
+        """Testing ClearCaseClient diffing elements in parallel"""
+        old_a, new_a, old_b, new_b = self._write_files([
+            ('a.old', 'a\n'),
+            ('a.new', 'a\nb\n'),
+            ('b.old', 'b\n'),
+            ('b.new', 'c\n'),
+        ])
+        client = ClearCaseClient(options=self.options)
+        diff = client.do_diff([(old_a, new_a), (old_b, new_b),
+                               (old_a, new_a + '.missing')])[0].getvalue()
+
+        self.assertTrue('==== oid:a.old oid:a.new ====\n' in diff)
+        self.assertTrue('==== oid:b.old oid:b.new ====\n' in diff)
+        self.assertTrue(diff.index('+b\n') < diff.index('+c\n'))
+        self.assertEqual(len(open(self.log_file).readlines()), 1)
+
+    def test_get_branch_changeset(self):
+        """Testing ClearCaseClient describing branch versions in batches"""
+        os.environ['FAKE_CLEARTOOL_VERSIONS'] = ';'.join([
+            '/vob/a.c@@/main/br/0',
+            '/vob/a.c@@/main/br/1',
+            '/vob/a.c@@/main/br/2',
+            '/vob/b.c@@/main/br/1',
+        ])
+
+        try:
+            client = ClearCaseClient(options=self.options)
+            client.CLEARTOOL_BATCH_SIZE = 3
+            changeset = client.get_branch_changeset('br')
+        finally:
+            del os.environ['FAKE_CLEARTOOL_VERSIONS']
+
+        self.assertEqual(sorted(changeset), [
+            ('/vob/a.c@@/main/3', '/vob/a.c@@/main/br/2'),
+            ('/vob/b.c@@/main/br/0', '/vob/b.c@@/main/br/1'),
+        ])
+        log = open(self.log_file).readlines()
+        self.assertEqual(len(log), 3)
+        self.assertTrue(log[0].startswith('find '))
+
+    def test_session(self):
+        """Testing ClearToolSession running commands in one cleartool"""
+        path = self._write_files([('a b.c', 'a\n')])[0]
+        session = ClearToolSession()
+
+        self.assertEqual(session.execute(['describe', '-fmt', '%On', path]),
+                         'oid:a b.c')
+        self.assertEqual(
+            session.execute(['describe', '-fmt', r'%On\n', path, 'missing'],
+                            ignore_errors=True, with_errors=False),
+            'oid:a b.c\n')
+
+        # Errors are reported after the output of the command that
+        # caused them, and not with the next command.
+        self.assertEqual(
+            session.execute(['describe', '-fmt', r'%On\n', 'missing', path],
+                            ignore_errors=True),
+            'oid:a b.c\ncleartool: Error: Unable to access "missing".\n')
+        self.assertEqual(session.execute(['describe', '-fmt', '%On', path]),
+                         'oid:a b.c')
+        self.assertRaises(SystemExit, session.execute, ['bogus'])
+
+        # A new cleartool is started if the old one goes away.
+        session._process.kill()
+        session._process.wait()
+        self.assertEqual(session.execute(['describe', '-fmt', '%On', path]),
+                         'oid:a b.c')
+        session.close()
+
+        log = open(self.log_file).readlines()
+        self.assertEqual(len(log), 6)
+
+    def test_load_oids_with_errors(self):
+        """Testing ClearCaseClient describing oids cleartool can't batch"""
+        old_a, new_a = self._write_files([('a.old', 'a\n'),
+                                          ('a.new', 'b\n')])
+        client = ClearCaseClient(options=self.options)
+        client._load_oids([old_a, old_a + '.missing', new_a])
+
+        # The batch is split up until the path that fails is on its own.
+        self.assertEqual(client._oids, {
+            old_a: 'oid:a.old',
+            new_a: 'oid:a.new',
+        })
+        log = open(self.log_file).readlines()
+        self.assertEqual(len(log), 5)
+
+
+class CVSClientTests(SCMClientTests):
+    def setUp(self):
+        super(CVSClientTests, self).setUp()
+        self.chdir_tmp()
+
+        # A stand-in for cvs, which says what it was asked to diff.
+        self.install_fake_tool('cvs', FAKE_CVS)
+
+        # A checkout with files in ., a, a/b and c, plus an unversioned
+        # directory.
+        self.checkout_dir = self.chdir_tmp()
+
+        for directory in ['.', 'a', 'a/b', 'c']:
+            os.makedirs(os.path.join(directory, 'CVS'))
+            path = os.path.join(directory, 'file.txt')
+            fp = open(path, 'w')
+            fp.write('file\n')
+            fp.close()
+
+            fp = open(os.path.join(directory, 'CVS', 'Entries'), 'w')
+            fp.write('/file.txt/1.1/%s//\nD\n'
+                     % time.asctime(time.gmtime(os.stat(path).st_mtime)))
+            fp.close()
+
+        os.mkdir('unversioned')
+
+    def _touch(self, path):
+        mtime = os.stat(path).st_mtime - 60
+        os.utime(path, (mtime, mtime))
+
+    def test_diff_changed_directories(self):
+        """Testing CVSClient diffing only directories with local changes"""
+        self._touch(os.path.join('a', 'b', 'file.txt'))
+        self._touch(os.path.join('c', 'file.txt'))
+        client = CVSClient(options=self.options)
+
+        self.assertEqual(client.diff([]), (
+            'diff -uN -l a/b\n'
+            'diff -uN -l c\n',
+            None))
+
+    def test_diff_between_revisions(self):
+        """Testing CVSClient diffing between revisions with one cvs diff"""
+        client = CVSClient(options=self.options)
+        diff = client.diff_between_revisions('1.1:1.2', [], None)
+
+        self.assertEqual(diff, ('diff -uN -r 1.1 -r 1.2\n', None))
+
+    def test_diff_files(self):
+        """Testing CVSClient diffing the given files with one cvs diff"""
+        client = CVSClient(options=self.options)
+
+        self.assertEqual(client.diff(['a/file.txt', 'c']),
+                         ('diff -uN a/file.txt c\n', None))
+
+
+FAKE_P4 = r"""
+import marshal
+import os
+import sys
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+args = sys.argv[1:]
+depot_paths = []
+
+if 'FAKE_P4_LOG' in os.environ:
+    open(os.environ['FAKE_P4_LOG'], 'a').write(' '.join(args) + '\n')
+
+# Files in changelists, as (depot path, revision, action).
+CHANGES = {
+    '42': ('submitted', [('//depot/foo.txt', '2', 'edit'),
+                         ('//depot/new.txt', '1', 'add'),
+                         ('//depot/old.txt', '3', 'delete')]),
+    'default': ('pending', [('//depot/foo.txt', '2', 'edit')]),
+}
+
+# Global options.
+while args[0].startswith('-'):
+    if args[0] == '-x':
+        depot_paths = [line.rstrip('\n') for line in open(args[1])]
+        args = args[1:]
+    elif args[0] == '-P':
+        args = args[1:]
+
+    args = args[1:]
+
+command = args[0]
+flags = [arg for arg in args[1:] if arg.startswith('-')]
+args = [arg for arg in args[1:] if not arg.startswith('-')]
+
+if command in ('describe', 'opened'):
+    changenum = args[0]
+
+    if changenum == 'locked':
+        marshal.dump({'code': 'error', 'severity': 3,
+                      'data': 'You don\'t have permission for this '
+                              'operation.\n'},
+                     sys.stdout)
+        sys.exit(1)
+    elif changenum not in CHANGES:
+        marshal.dump({'code': 'error', 'severity': 3,
+                      'data': 'Change %s unknown.\n' % changenum},
+                     sys.stdout)
+        sys.exit(1)
+
+    status, files = CHANGES[changenum]
+
+    if command == 'describe':
+        record = {'code': 'stat', 'change': changenum, 'status': status}
+
+        for i, (path, rev, action) in enumerate(files):
+            record['depotFile%d' % i] = path
+            record['rev%d' % i] = rev
+            record['action%d' % i] = action
+
+        marshal.dump(record, sys.stdout)
+    else:
+        for path, rev, action in files:
+            marshal.dump({'code': 'stat', 'depotFile': path, 'rev': rev,
+                          'action': action, 'change': changenum},
+                         sys.stdout)
+elif command == 'where':
+    for path in depot_paths + args:
+        marshal.dump({'code': 'stat', 'depotFile': path,
+                      'path': os.path.join(os.environ['FAKE_P4_ROOT'],
+                                           path[len('//depot/'):])},
+                     sys.stdout)
+
+    depot_paths = []
+else:
+    depot_paths += args
+
+
+def get_content(path, rev):
+    name = path.split('/')[-1].split('.')[0]
+
+    if name == 'empty':
+        return ''
+    elif name.startswith('same'):
+        return 'same\ncommon\n'
+    else:
+        return '%s %s\ncommon\n' % (name, rev)
+
+
+for depot_path in depot_paths:
+    path, rev = depot_path.split('#')
+    content = get_content(path, rev)
+
+    if command == 'print':
+        marshal.dump({'code': 'stat', 'depotFile': path, 'rev': rev,
+                      'type': 'text'}, sys.stdout)
+
+        for line in content.splitlines(True):
+            marshal.dump({'code': 'text', 'data': line}, sys.stdout)
+    elif command == 'fstat':
+        marshal.dump({'code': 'stat', 'depotFile': path, 'headRev': rev,
+                      'digest': md5(content).hexdigest().upper(),
+                      'fileSize': str(len(content))}, sys.stdout)
+"""
+
+
+SVN_INFO_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<info>
+<entry kind="file" path="foo.txt" revision="3">
+<url>http://svn.example.com/svn/trunk/foo.txt</url>
+<repository>
+<root>http://svn.example.com/svn</root>
+<uuid>a0a7c05d-d3d4-4e96-b2a5-6a1fb0e49a35</uuid>
+</repository>
+</entry>
+<entry kind="file" path="dir/bar.txt" revision="3">
+<url>http://svn.example.com/svn/branches/x/bar.txt</url>
+<repository>
+<root>http://svn.example.com/svn</root>
+<uuid>a0a7c05d-d3d4-4e96-b2a5-6a1fb0e49a35</uuid>
+</repository>
+<wc-info>
+<schedule>add</schedule>
+<copy-from-url>http://svn.example.com/svn/trunk/old%20bar.txt</copy-from-url>
+<copy-from-rev>2</copy-from-rev>
+</wc-info>
+</entry>
+</info>
+"""
 
 FOO = """\
 ARMA virumque cano, Troiae qui primus ab oris
@@ -909,3 +1892,114 @@ Index: foo.txt
 +moenia Romae. Albanique patres, atque altae
 +moenia Romae. Musa, mihi causas memora, quo numine laeso,
  \n"""
+
+
+FAKE_CM = r"""
+import sys
+
+command, spec, dest = sys.argv[1:]
+assert command == 'cat' and dest.startswith('--file=')
+fp = open(dest[len('--file='):], 'w')
+fp.write('revision %s\ncommon\n' % spec.split(':')[-1])
+fp.close()
+"""
+
+
+FAKE_CLEARTOOL = r"""
+import os
+import shlex
+import sys
+
+log_file = os.environ.get('FAKE_CLEARTOOL_LOG')
+
+
+def log(command_line):
+    if log_file:
+        fp = open(log_file, 'a')
+        fp.write('%s\n' % command_line)
+        fp.close()
+
+
+def describe(path, fmt):
+    # Versions on a branch are always accessible, and their previous
+    # version is the one before on the branch, or /main/3 for version 0.
+    if '@@' in path:
+        element, version = path.split('@@')
+        branch, number = version.rsplit('/', 1)
+
+        if number == '0':
+            previous = '/main/3'
+        else:
+            previous = '%s/%d' % (branch, int(number) - 1)
+    elif os.path.exists(path):
+        element = path
+        version = previous = ''
+    else:
+        sys.stderr.write('cleartool: Error: Unable to access "%s".\n'
+                         % path)
+        return False
+
+    for key, value in [('%On', 'oid:%s' % os.path.basename(path)),
+                       ('%En', element),
+                       ('%PVn', previous),
+                       ('%Vn', version),
+                       ('\\n', '\n'),
+                       ('\\t', '\t')]:
+        fmt = fmt.replace(key, value)
+
+    sys.stdout.write(fmt)
+    return True
+
+
+def run(args):
+    log(' '.join(args))
+    command = args[0]
+    rc = 0
+
+    if command == 'describe':
+        assert args[1] == '-fmt'
+
+        for path in args[3:]:
+            if not describe(path, args[2]):
+                rc = 1
+    elif command == 'find':
+        assert args[-1] == '-print'
+
+        for path in os.environ['FAKE_CLEARTOOL_VERSIONS'].split(';'):
+            sys.stdout.write('%s\n' % path)
+    elif command == 'exit':
+        sys.exit(0)
+    else:
+        rc = 1
+
+    return rc
+
+
+if sys.argv[1:] == ['-status']:
+    # Interactive mode, prompting for each command and reporting its
+    # status.
+    count = 0
+
+    while True:
+        sys.stdout.write('cleartool> ')
+        sys.stdout.flush()
+        line = sys.stdin.readline()
+
+        if not line:
+            break
+
+        count += 1
+        rc = run(shlex.split(line))
+        sys.stdout.write('Command %d returned status %d\n' % (count, rc))
+        sys.stdout.flush()
+else:
+    sys.exit(run(sys.argv[1:]))
+"""
+
+
+FAKE_CVS = r"""
+import sys
+
+sys.stdout.write('%s\n' % ' '.join(sys.argv[1:]))
+sys.exit(1)
+"""
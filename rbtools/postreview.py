@@ -1,4 +1,5 @@
 #!/usr/bin/env python
+import atexit
 import base64
 import cookielib
 import getpass
@@ -24,7 +25,11 @@ from rbtools.api.errors import APIError
 from rbtools.clients import scan_usable_client
 from rbtools.clients.perforce import PerforceClient
 from rbtools.clients.plastic import PlasticClient
-from rbtools.utils.filesystem import get_config_value, load_config_files
+from rbtools.utils.cache import FileCache
+from rbtools.utils.concurrency import DEFAULT_JOBS
+from rbtools.utils.diffs import DiffBuffer
+from rbtools.utils.filesystem import get_cache_path, get_config_value, \
+                                     get_home_path, load_config_files
 from rbtools.utils.process import die
 
 try:
@@ -51,6 +56,77 @@ class HTTPRequest(urllib2.Request):
         return self.method
 
 
+class MultipartBody(object):
+    """
+    The body of a multipart/form-data request, made of strings and files.
+
+    Files are read from the start in blocks as the request is sent, rather
+    than being read into memory first. urllib2 sends any body with a read()
+    method this way.
+
+    A request may be sent more than once (when retrying after an
+    authentication challenge, for instance), so RewindBodyHandler resets
+    the body before each send.
+    """
+    BLOCK_SIZE = 64 * 1024
+
+    def __init__(self, parts):
+        self.parts = parts
+        self._index = 0
+        self._started = False
+
+    def __len__(self):
+        return sum([len(part) for part in self.parts])
+
+    def reset(self):
+        """Starts reading the body from the beginning again."""
+        self._index = 0
+        self._started = False
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.BLOCK_SIZE
+
+        while self._index < len(self.parts):
+            part = self.parts[self._index]
+
+            if isinstance(part, basestring):
+                self._index += 1
+                return part
+
+            if not self._started:
+                part.seek(0)
+                self._started = True
+
+            data = part.read(size)
+
+            if data:
+                return data
+
+            self._index += 1
+            self._started = False
+
+        return ''
+
+
+class RewindBodyHandler(urllib2.BaseHandler):
+    """urllib2 handler that rewinds a MultipartBody before it's sent.
+
+    Without this, a request sent again (such as the retry after an HTTP
+    401) would read the body from where the last send left off, sending
+    nothing but claiming the full Content-Length.
+    """
+    def http_request(self, request):
+        body = request.get_data()
+
+        if isinstance(body, MultipartBody):
+            body.reset()
+
+        return request
+
+    https_request = http_request
+
+
 class PresetHTTPAuthHandler(urllib2.BaseHandler):
     """urllib2 handler that conditionally presets the use of HTTP Basic Auth.
 
@@ -221,6 +297,7 @@ class ReviewBoardServer(object):
             ReviewBoardHTTPBasicAuthHandler(password_mgr),
             urllib2.HTTPDigestAuthHandler(password_mgr),
             self.preset_auth_handler,
+            RewindBodyHandler(),
             ReviewBoardHTTPErrorProcessor(),
         ]
 
@@ -538,12 +615,14 @@ class ReviewBoardServer(object):
 
     def upload_diff(self, review_request, diff_content, parent_diff_content):
         """
-        Uploads a diff to a Review Board server.
+        Uploads a diff to a Review Board server, returning the revision of
+        the new diff if it's known.
         """
         debug("Uploading diff, size: %d" % len(diff_content))
 
         if parent_diff_content:
-            debug("Uploading parent diff, size: %d" % len(parent_diff_content))
+            debug("Uploading parent diff, size: %d"
+                  % len(parent_diff_content))
 
         fields = {}
         files = {}
@@ -565,9 +644,42 @@ class ReviewBoardServer(object):
         if self.deprecated_api:
             self.api_post('api/json/reviewrequests/%s/diff/new/' %
                           review_request['id'], fields, files)
+
+            # The old API doesn't tell us which revision was created.
+            return None
         else:
-            self.api_post(review_request['links']['diffs']['href'],
-                          fields, files)
+            rsp = self.api_post(review_request['links']['diffs']['href'],
+                                fields, files)
+
+            return rsp['diff']['revision']
+
+    def get_diff_revision(self, review_request):
+        """
+        Returns the revision of the latest diff on a review request,
+        including a diff on its draft that hasn't been published yet, or
+        None if the server can't tell us.
+        """
+        if self.deprecated_api:
+            return None
+
+        # Diff revisions are numbered from 1, so the number of diffs is also
+        # the revision of the latest one.
+        rsp = self.api_get('%s?counts-only=1' %
+                           review_request['links']['diffs']['href'])
+        revision = rsp['count']
+
+        # The diffs list only has published diffs. An unpublished diff is
+        # listed on the draft, which doesn't exist if there's no draft (or
+        # on servers that don't list draft diffs).
+        try:
+            rsp = self.api_get('%sdiffs/?counts-only=1' %
+                               review_request['links']['draft']['href'])
+            revision += rsp['count']
+        except APIError, e:
+            if e.http_status != 404:
+                raise
+
+        return revision
 
     def reopen(self, review_request):
         """
@@ -811,8 +923,12 @@ class ReviewBoardServer(object):
     def _encode_multipart_formdata(self, fields, files):
         """
         Encodes data for use in an HTTP POST.
+
+        File contents may be strings or file objects. If any are files, the
+        body is returned as a MultipartBody that reads them as it's sent.
         """
         BOUNDARY = mimetools.choose_boundary()
+        parts = []
         content = ""
 
         fields = fields or {}
@@ -831,13 +947,23 @@ class ReviewBoardServer(object):
             content += "Content-Disposition: form-data; name=\"%s\"; " % key
             content += "filename=\"%s\"\r\n" % filename
             content += "\r\n"
-            content += value + "\r\n"
+
+            if isinstance(value, basestring):
+                content += value
+            else:
+                parts += [content, value]
+                content = ""
+
+            content += "\r\n"
 
         content += "--" + BOUNDARY + "--\r\n"
         content += "\r\n"
 
         content_type = "multipart/form-data; boundary=%s" % BOUNDARY
 
+        if parts:
+            return content_type, MultipartBody(parts + [content])
+
         return content_type, content
 
 
@@ -849,6 +975,98 @@ def debug(s):
         print ">>> %s" % s
 
 
+def get_diff_hash(diff_content, parent_diff_content):
+    """
+    Returns a hash identifying the content of a diff and its parent diff.
+
+    The hash of the diff is kept up to date as the diff is generated, so
+    only the parent diff, if there is one, needs to be read.
+    """
+    hasher = diff_content.get_hasher()
+    hasher.update('\0')
+
+    if parent_diff_content:
+        for block in parent_diff_content.iter_blocks():
+            hasher.update(block)
+
+    return hasher.hexdigest()
+
+
+def read_diff_file(fp):
+    """
+    Reads a diff from a file into a DiffBuffer, a block at a time.
+    """
+    diff = DiffBuffer()
+
+    for block in iter(lambda: fp.read(DiffBuffer.BLOCK_SIZE), ''):
+        diff.write(block)
+
+    return diff
+
+
+def write_diff(diff):
+    """
+    Writes a diff to stdout, a block at a time.
+    """
+    for block in diff.iter_blocks():
+        sys.stdout.write(block)
+
+
+def get_uploaded_diffs():
+    """
+    Returns the local record of the last diff uploaded to each review
+    request.
+    """
+    return FileCache(get_cache_path('uploaded-diffs'),
+                     max_size=1024 * 1024)
+
+
+def is_diff_unchanged(server, review_request, diff_hash):
+    """
+    Returns whether the diff is identical to the last one uploaded to the
+    review request from here.
+
+    The local record alone isn't enough, since the diff may have been
+    replaced on the server since, or uploaded to a draft that was then
+    discarded. The server is asked for the revision of its latest diff,
+    draft included, and the diff only counts as unchanged if that's still
+    the one we uploaded.
+    """
+    record = get_uploaded_diffs().get((server.url, str(review_request['id'])))
+
+    if not record:
+        return False
+
+    last_hash, last_revision = record.split(' ', 1)
+
+    if last_hash != diff_hash:
+        return False
+
+    # This is only an optimization, so if the server can't tell us, the
+    # diff is uploaded as usual.
+    try:
+        revision = server.get_diff_revision(review_request)
+    except APIError, e:
+        debug("Unable to get the diff revision from the server: %s" % e)
+        return False
+
+    if revision is None or str(revision) != last_revision:
+        debug("Diff revision %s on the server was not uploaded from here"
+              % revision)
+        return False
+
+    return True
+
+
+def record_uploaded_diff(server, review_request, diff_hash, revision):
+    """
+    Records the diff that was just uploaded to the review request, so that
+    uploading the same diff again can be skipped.
+    """
+    get_uploaded_diffs().set((server.url, str(review_request['id'])),
+                             '%s %s' % (diff_hash, revision))
+
+
 def tempt_fate(server, tool, changenum, diff_content=None,
                parent_diff_content=None, submit_as=None, retries=3):
     """
@@ -924,9 +1142,18 @@ def tempt_fate(server, tool, changenum, diff_content=None,
 
 
     if not server.info.supports_changesets or not options.change_only:
+        diff_hash = get_diff_hash(diff_content, parent_diff_content)
+
         try:
-            server.upload_diff(review_request, diff_content,
-                               parent_diff_content)
+            if (options.rid and options.skip_unchanged_diff and
+                is_diff_unchanged(server, review_request, diff_hash)):
+                print "The diff is unchanged since it was last uploaded. " \
+                      "Skipping the upload."
+            else:
+                revision = server.upload_diff(review_request, diff_content,
+                                              parent_diff_content)
+                record_uploaded_diff(server, review_request, diff_hash,
+                                     revision)
         except APIError, e:
             sys.stderr.write('\n')
             sys.stderr.write('Error uploading diff\n')
@@ -1070,6 +1297,31 @@ def parse_options(args):
                       dest="revision_range", default=None,
                       help="generate the diff for review based on given "
                            "revision range")
+    parser.add_option("--diff-series",
+                      dest="diff_series", action="store_true", default=False,
+                      help="post each commit in the branch (or in "
+                           "--revision-range) as its own review request "
+                           "(git only)")
+    parser.add_option("--disable-diff-cache",
+                      dest="diff_cache", action="store_false",
+                      default=get_config_value(configs, 'DIFF_CACHE', True),
+                      help="always regenerate diffs instead of reusing "
+                           "cached diffs of the same commits (git) or "
+                           "cached file revisions (Perforce and Plastic)")
+    parser.add_option("--always-upload-diff",
+                      dest="skip_unchanged_diff", action="store_false",
+                      default=get_config_value(configs, 'SKIP_UNCHANGED_DIFF',
+                                               True),
+                      help="upload the diff when updating a review request, "
+                           "even if it's identical to the last diff "
+                           "uploaded to it")
+    parser.add_option("-j", "--jobs",
+                      dest="jobs", type="int",
+                      default=get_config_value(configs, 'JOBS', DEFAULT_JOBS),
+                      metavar="N",
+                      help="run up to N source control commands at once "
+                           "when generating a diff (default %d)"
+                           % DEFAULT_JOBS)
     parser.add_option("--submit-as",
                       dest="submit_as",
                       default=get_config_value(configs, 'SUBMIT_AS'),
@@ -1106,6 +1358,16 @@ def parse_options(args):
                       metavar="TRACKING",
                       help="Tracking branch from which your branch is derived "
                            "(git only, defaults to origin/master)")
+    parser.add_option("--hg-remote-outgoing",
+                      dest="hg_remote_outgoing", action="store_true",
+                      default=get_config_value(configs, 'HG_REMOTE_OUTGOING',
+                                               False),
+                      help="find the outgoing Mercurial changesets by "
+                           "comparing with the remote repository, instead "
+                           "of using the draft changesets on the current "
+                           "branch. Use this with non-publishing remotes, "
+                           "where pushed changesets stay draft. This is "
+                           "implied by --parent")
     parser.add_option("--p4-client",
                       dest="p4_client",
                       default=get_config_value(configs, 'P4_CLIENT'),
@@ -1115,6 +1377,19 @@ def parse_options(args):
                       default=get_config_value(configs, 'P4_PORT'),
                       help="the Perforce servers IP address that the review "
                            "is on")
+    parser.add_option("--p4-server-diff",
+                      dest="p4_server_diff", action="store_true",
+                      default=get_config_value(configs, 'P4_SERVER_DIFF',
+                                               False),
+                      help="have the Perforce server diff the text files in "
+                           "submitted changelists and depot path ranges, "
+                           "instead of fetching both versions of each file")
+    parser.add_option("--p4-verify-cache",
+                      dest="p4_verify_cache", action="store_true",
+                      default=get_config_value(configs, 'P4_VERIFY_CACHE',
+                                               False),
+                      help="check cached Perforce file revisions against "
+                           "the digests on the server before using them")
     parser.add_option("--p4-passwd",
                       dest="p4_passwd",
                       default=get_config_value(configs, 'P4_PASSWD'),
@@ -1205,6 +1480,13 @@ def parse_options(args):
                          "when updating an existing review-request\n")
         sys.exit(1)
 
+    if options.diff_series and (options.rid or options.diff_filename or
+                                options.svn_changelist):
+        sys.stderr.write("The --diff-series option cannot be used with "
+                         "--review-request-id, --diff-filename or "
+                         "--svn-changelist.\n")
+        sys.exit(1)
+
     # If we're creating a new review (no -r) and publishing it, we
     # must have a reviewer specified.  No new review withour reviewer!
     if options.publish and not options.rid and not options.target_people:
@@ -1218,12 +1500,7 @@ def parse_options(args):
 def main():
     origcwd = os.path.abspath(os.getcwd())
 
-    if 'APPDATA' in os.environ:
-        homepath = os.environ['APPDATA']
-    elif 'HOME' in os.environ:
-        homepath = os.environ["HOME"]
-    else:
-        homepath = ''
+    homepath = get_home_path()
 
     # If we end up creating a cookie file, make sure it's only readable by the
     # user.
@@ -1239,6 +1516,11 @@ def main():
     debug('Home = %s' % homepath)
 
     repository_info, tool = scan_usable_client(options)
+
+    # post-review can exit from anywhere, so the client is closed on the
+    # way out rather than at the end of main().
+    atexit.register(tool.close)
+
     tool.user_config = user_config
     tool.configs = configs
 
@@ -1266,6 +1548,10 @@ def main():
     else:
         changenum = None
 
+    if options.diff_series:
+        post_diff_series(server, tool, repository_info)
+        return
+
     if options.revision_range:
         diff, parent_diff = tool.diff_between_revisions(options.revision_range, args,
                                                         repository_info)
@@ -1275,11 +1561,11 @@ def main():
         parent_diff = None
 
         if options.diff_filename == '-':
-            diff = sys.stdin.read()
+            diff = read_diff_file(sys.stdin)
         else:
             try:
                 fp = open(os.path.join(origcwd, options.diff_filename), 'r')
-                diff = fp.read()
+                diff = read_diff_file(fp)
                 fp.close()
             except IOError, e:
                 die("Unable to open diff filename: %s" % e)
@@ -1302,8 +1588,8 @@ def main():
             server.deprecated_api = True
 
     if options.output_diff_only:
-        # The comma here isn't a typo, but rather suppresses the extra newline
-        print diff,
+        write_diff(diff)
+
         sys.exit(0)
 
     # Let's begin.
@@ -1313,7 +1599,56 @@ def main():
                             parent_diff_content=parent_diff,
                             submit_as=options.submit_as)
 
-    # If possible, update the latest change to say it's being reviewed.
+    update_commits(tool, repository_info, review_url)
+    open_browser(review_url)
+
+
+def post_diff_series(server, tool, repository_info):
+    """
+    Posts every commit in the range as its own review request.
+
+    The diffs are generated lazily by the SCM client, so each review request
+    is posted as soon as its diff is ready. All of them share the same
+    server connection and login.
+    """
+    # Parent diffs are only needed when posting.
+    series = tool.diff_series(options.revision_range,
+                              parent_diffs=not options.output_diff_only)
+
+    if options.output_diff_only:
+        for commit, diff, parent_diff in series:
+            write_diff(diff)
+
+        sys.exit(0)
+
+    num_posted = 0
+
+    for commit, diff, parent_diff in series:
+        if len(diff) == 0:
+            print "Skipping commit %s, which has an empty diff." % commit
+            continue
+
+        if num_posted == 0:
+            # Let's begin.
+            server.login()
+
+        debug("Posting commit %s" % commit)
+        review_url = tempt_fate(server, tool, None, diff_content=diff,
+                                parent_diff_content=parent_diff,
+                                submit_as=options.submit_as)
+        num_posted += 1
+
+        update_commits(tool, repository_info, review_url)
+        open_browser(review_url)
+
+    if num_posted == 0:
+        die("There don't seem to be any diffs!")
+
+
+def update_commits(tool, repository_info, review_url):
+    """
+    If possible, updates the posted changes to say they're being reviewed.
+    """
     # TODO(csilvers): control whether this is done, with a flag.
     if repository_info.supports_updating_commits and review_url:
         num_updates = tool.update_commits_with_reviewer_info(options, review_url)
@@ -1322,7 +1657,11 @@ def main():
         else:
             print "NOTE: Unable to update any commits with reviewer info."
 
-    # Load the review up in the browser if requested to:
+
+def open_browser(review_url):
+    """
+    Loads the review up in the browser if requested to.
+    """
     if options.open_browser:
         try:
             import webbrowser
@@ -1,5 +1,7 @@
+import os
 import unittest
 import urllib2
+from tempfile import mkdtemp
 
 try:
     from cStringIO import StringIO
@@ -15,6 +17,7 @@ from rbtools import postreview
 from rbtools.api.errors import APIError
 from rbtools.clients import RepositoryInfo
 from rbtools.postreview import ReviewBoardServer
+from rbtools.utils.diffs import DiffBuffer
 
 
 class MockHttpUnitTest(unittest.TestCase):
@@ -56,11 +59,20 @@ class OptionsStub(object):
         self.debug = True
         self.guess_summary = False
         self.guess_description = False
+        self.summary = None
+        self.description = None
         self.tracking = None
         self.username = None
         self.password = None
         self.repository_url = None
         self.disable_proxy = False
+        self.diff_cache = False
+        self.jobs = 1
+        self.p4_port = None
+        self.p4_passwd = None
+        self.p4_verify_cache = False
+        self.p4_server_diff = False
+        self.hg_remote_outgoing = False
 
 
 class ApiTests(MockHttpUnitTest):
@@ -117,6 +129,176 @@ class ApiTests(MockHttpUnitTest):
         }
 
 
+class UploadedDiffTests(MockHttpUnitTest):
+    def setUp(self):
+        super(UploadedDiffTests, self).setUp()
+
+        self.saved_home = os.environ.get('HOME')
+        os.environ['HOME'] = mkdtemp()
+
+        self.review_request = {
+            'id': 42,
+            'links': {
+                'diffs': {
+                    'href': 'api/review-requests/42/diffs/',
+                },
+                'draft': {
+                    'href': 'api/review-requests/42/draft/',
+                },
+            },
+        }
+        self.set_diff_counts(2, None)
+
+    def tearDown(self):
+        super(UploadedDiffTests, self).tearDown()
+
+        if self.saved_home is None:
+            del os.environ['HOME']
+        else:
+            os.environ['HOME'] = self.saved_home
+
+    def set_diff_counts(self, public_count, draft_count):
+        """
+        Sets the number of diffs the server has, with None for a missing
+        draft.
+        """
+        if draft_count is None:
+            draft_rsp = APIError(404, 100)
+        else:
+            draft_rsp = json.dumps({
+                'stat': 'ok',
+                'count': draft_count,
+            })
+
+        self.http_response = {
+            'api/review-requests/42/diffs/?counts-only=1': json.dumps({
+                'stat': 'ok',
+                'count': public_count,
+            }),
+            'api/review-requests/42/draft/diffs/?counts-only=1': draft_rsp,
+        }
+
+    def test_unchanged_diff(self):
+        """Testing detecting a diff identical to the last uploaded one"""
+        diff_hash = postreview.get_diff_hash(DiffBuffer('diff'), None)
+
+        self.assertFalse(postreview.is_diff_unchanged(
+            self.server, self.review_request, diff_hash))
+
+        postreview.record_uploaded_diff(self.server, self.review_request,
+                                        diff_hash, 2)
+        self.assertTrue(postreview.is_diff_unchanged(
+            self.server, self.review_request, diff_hash))
+        self.assertFalse(postreview.is_diff_unchanged(
+            self.server, self.review_request,
+            postreview.get_diff_hash(DiffBuffer('diff'),
+                                     DiffBuffer('parent diff'))))
+
+    def test_unchanged_diff_verified(self):
+        """Testing verifying an unchanged diff against the server"""
+        diff_hash = postreview.get_diff_hash(DiffBuffer('diff'), None)
+        postreview.record_uploaded_diff(self.server, self.review_request,
+                                        diff_hash, 2)
+
+        # Somebody else uploaded a diff since.
+        self.set_diff_counts(3, None)
+        self.assertFalse(postreview.is_diff_unchanged(
+            self.server, self.review_request, diff_hash))
+
+        # The diff we uploaded is still on the unpublished draft.
+        self.set_diff_counts(1, 1)
+        self.assertTrue(postreview.is_diff_unchanged(
+            self.server, self.review_request, diff_hash))
+
+        # The draft with the diff we uploaded was discarded.
+        self.set_diff_counts(1, None)
+        self.assertFalse(postreview.is_diff_unchanged(
+            self.server, self.review_request, diff_hash))
+
+    def test_unchanged_diff_server_error(self):
+        """Testing uploading a diff the server fails to verify"""
+        diff_hash = postreview.get_diff_hash(DiffBuffer('diff'), None)
+        postreview.record_uploaded_diff(self.server, self.review_request,
+                                        diff_hash, 2)
+        self.http_response[
+            'api/review-requests/42/diffs/?counts-only=1'] = APIError(500, 0)
+
+        self.assertFalse(postreview.is_diff_unchanged(
+            self.server, self.review_request, diff_hash))
+
+        # The draft is only allowed to be missing, not inaccessible.
+        self.set_diff_counts(1, 1)
+        self.http_response[
+            'api/review-requests/42/draft/diffs/?counts-only=1'] = \
+            APIError(403, 101)
+        self.assertFalse(postreview.is_diff_unchanged(
+            self.server, self.review_request, diff_hash))
+
+    def test_unchanged_diff_deprecated_api(self):
+        """Testing never skipping a diff the server can't verify"""
+        diff_hash = postreview.get_diff_hash(DiffBuffer('diff'), None)
+        postreview.record_uploaded_diff(self.server, self.review_request,
+                                        diff_hash, 2)
+        self.server.deprecated_api = True
+
+        self.assertFalse(postreview.is_diff_unchanged(
+            self.server, self.review_request, diff_hash))
+
+
+class DiffFileTests(MockHttpUnitTest):
+    def test_diff_file_hash(self):
+        """Testing hashing a diff stored in a file"""
+        self.assertEqual(
+            postreview.get_diff_hash(DiffBuffer('diff', max_memory_size=2),
+                                     DiffBuffer('parent diff',
+                                                max_memory_size=2)),
+            postreview.get_diff_hash(DiffBuffer('diff'),
+                                     DiffBuffer('parent diff')))
+
+    def test_encode_multipart_formdata_with_file(self):
+        """Testing encoding a multipart body that streams a diff file"""
+        diff_file = DiffBuffer('diff content', max_memory_size=4)
+        diff_file.read()
+
+        content_type, body = self.server._encode_multipart_formdata(
+            {'basedir': '/trunk'},
+            {'path': {'filename': 'diff', 'content': diff_file}})
+        self.assertTrue(isinstance(body, postreview.MultipartBody))
+
+        data = ''.join(iter(lambda: body.read(4), ''))
+        self.assertEqual(len(body), len(data))
+
+        boundary = content_type.split('boundary=')[1]
+        self.assertEqual(data, (
+            '--%(b)s\r\n'
+            'Content-Disposition: form-data; name="basedir"\r\n'
+            '\r\n'
+            '/trunk\r\n'
+            '--%(b)s\r\n'
+            'Content-Disposition: form-data; name="path"; filename="diff"\r\n'
+            '\r\n'
+            'diff content\r\n'
+            '--%(b)s--\r\n'
+            '\r\n') % {'b': boundary})
+
+    def test_multipart_body_resent(self):
+        """Testing sending a multipart body again after it has been read"""
+        content_type, body = self.server._encode_multipart_formdata(
+            {}, {'path': {'filename': 'diff',
+                          'content': DiffBuffer('diff content')}})
+        request = urllib2.Request('http://localhost:8080/api/', body)
+        handler = postreview.RewindBodyHandler()
+
+        handler.http_request(request)
+        data = ''.join(iter(body.read, ''))
+        self.assertTrue('diff content' in data)
+        self.assertEqual(body.read(), '')
+
+        # A retry sends the same request, which is rewound first.
+        handler.http_request(request)
+        self.assertEqual(''.join(iter(body.read, '')), data)
+
+
 class DeprecatedApiTests(MockHttpUnitTest):
     deprecated_api = True
 
@@ -0,0 +1,206 @@
+import logging
+import os
+from cStringIO import StringIO
+import tempfile
+import threading
+import zlib
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+
+class FileCache(object):
+    """
+    A simple persistent, content-addressed cache stored as files on disk.
+
+    Keys are tuples of strings, which are hashed to get the filename of each
+    entry. Values are strings, and are stored compressed. Large values can
+    be written and read a block at a time with set_blocks() and
+    read_into(), so they're never held in memory whole.
+
+    Entries are written atomically (to a temporary file that's then renamed
+    into place), so several post-review processes can safely share a cache.
+    The total size of the cache is bounded by max_size bytes. When it grows
+    past that, the least recently used entries are evicted. Reading an entry
+    marks it as recently used.
+
+    The size of the cache is only measured once, by the first set(), and is
+    then kept up to date as entries are written, so the entries are only
+    scanned again when some need to be evicted.
+    """
+    BLOCK_SIZE = 64 * 1024
+
+    def __init__(self, path, max_size=256 * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        self._size = None
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the value stored for the key, or None if it's not cached.
+        """
+        output = StringIO()
+
+        if not self.read_into(key, output):
+            return None
+
+        return output.getvalue()
+
+    def read_into(self, key, output):
+        """
+        Writes the value stored for the key to output (anything with a
+        write() method), a block at a time, and returns whether it was
+        cached. If it wasn't, part of a corrupt entry may have been
+        written to output already.
+        """
+        filename = self._get_filename(key)
+        decompressor = zlib.decompressobj()
+
+        try:
+            fp = open(filename, 'rb')
+
+            try:
+                for block in iter(lambda: fp.read(self.BLOCK_SIZE), ''):
+                    output.write(decompressor.decompress(block))
+
+                output.write(decompressor.flush())
+            finally:
+                fp.close()
+        except (IOError, OSError, zlib.error):
+            return False
+
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+
+        logging.debug('Cache hit for %r in %s' % (key, self.path))
+        return True
+
+    def set(self, key, data):
+        """
+        Stores the value for the key, evicting old entries if the cache has
+        grown too large.
+
+        Failing to write to the cache is never fatal. It's logged and
+        otherwise ignored.
+        """
+        self.set_blocks(key, [data])
+
+    def set_blocks(self, key, blocks):
+        """
+        Stores the value for the key, given as an iterable of blocks that
+        are compressed and written one at a time. This works like set().
+        """
+        filename = self._get_filename(key)
+        compressor = zlib.compressobj()
+        size = 0
+        tmpfile = None
+
+        try:
+            try:
+                if not os.path.isdir(self.path):
+                    os.makedirs(self.path, 0700)
+
+                fd, tmpfile = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+                fp = os.fdopen(fd, 'wb')
+
+                try:
+                    for block in blocks:
+                        data = compressor.compress(block)
+                        fp.write(data)
+                        size += len(data)
+
+                    data = compressor.flush()
+                    fp.write(data)
+                    size += len(data)
+                finally:
+                    fp.close()
+
+                try:
+                    old_size = os.stat(filename).st_size
+                except OSError:
+                    old_size = 0
+
+                if os.name == 'nt' and old_size:
+                    # Windows can't rename over an existing file.
+                    os.unlink(filename)
+
+                os.rename(tmpfile, filename)
+                tmpfile = None
+            except (IOError, OSError), e:
+                logging.debug('Unable to write cache entry %s: %s'
+                              % (filename, e))
+                return
+        finally:
+            # Don't leave a partly written entry behind.
+            if tmpfile:
+                try:
+                    os.unlink(tmpfile)
+                except OSError:
+                    pass
+
+        self._lock.acquire()
+
+        try:
+            if self._size is not None:
+                self._size += size - old_size
+
+            needs_prune = self._size is None or self._size > self.max_size
+        finally:
+            self._lock.release()
+
+        if needs_prune:
+            self.prune()
+
+    def prune(self):
+        """
+        Removes the least recently used entries until the cache is no
+        larger than max_size.
+        """
+        entries = []
+        total_size = 0
+
+        try:
+            filenames = os.listdir(self.path)
+        except OSError:
+            return
+
+        for filename in filenames:
+            if filename.endswith('.tmp'):
+                continue
+
+            path = os.path.join(self.path, filename)
+
+            try:
+                st = os.stat(path)
+            except OSError:
+                # Another process may have evicted it already.
+                continue
+
+            entries.append((st.st_mtime, st.st_size, path))
+            total_size += st.st_size
+
+        if total_size > self.max_size:
+            entries.sort()
+
+            for mtime, size, path in entries:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+                total_size -= size
+
+                if total_size <= self.max_size:
+                    break
+
+        self._lock.acquire()
+        self._size = total_size
+        self._lock.release()
+
+    def _get_filename(self, key):
+        return os.path.join(self.path, sha1('\0'.join(key)).hexdigest())
@@ -25,6 +25,35 @@ def check_install(command):
         return False
 
 
+def is_exe_in_path(name):
+    """
+    Returns whether an executable with the given name is in the user's
+    search path, without running it. The name shouldn't include an
+    executable extension (such as ".exe"), as those are tried as needed.
+    """
+    return find_exe_in_path(name) is not None
+
+
+def find_exe_in_path(name):
+    """
+    Returns the path to the first executable with the given name in the
+    user's search path, or None if there isn't one.
+    """
+    if sys.platform.startswith('win'):
+        extensions = os.environ.get('PATHEXT', '.EXE').split(os.pathsep)
+    else:
+        extensions = ['']
+
+    for dir in os.environ.get('PATH', '').split(os.pathsep):
+        for extension in extensions:
+            path = os.path.join(dir, name + extension)
+
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                return path
+
+    return None
+
+
 def check_gnu_diff():
     """Checks if GNU diff is installed, and informs the user if it's not."""
     has_gnu_diff = False
@@ -0,0 +1,91 @@
+import sys
+import threading
+from Queue import Queue
+
+
+# The default number of operations (usually SCM commands) to run at once.
+DEFAULT_JOBS = 4
+
+# How long to wait for a single result before waiting again. Waiting with a
+# timeout keeps the main thread responsive to Ctrl-C.
+_WAIT_TIMEOUT = 60 * 60 * 24
+
+
+def imap_ordered(func, items, max_workers=DEFAULT_JOBS):
+    """
+    Yields func(item) for each item, in the same order as items, while
+    running up to max_workers calls at once in worker threads.
+
+    Items are handed out in order, and workers stop picking up new items
+    once they're more than a few results ahead of the caller, so the number
+    of results waiting to be consumed stays bounded.
+
+    If a call raises an exception (including the SystemExit raised by
+    die()), it's raised here when its result would have been yielded, and
+    no new calls are started.
+    """
+    items = list(items)
+
+    if max_workers <= 1 or len(items) <= 1:
+        for item in items:
+            yield func(item)
+
+        return
+
+    results = Queue()
+    lock = threading.Lock()
+    slots = threading.Semaphore(max_workers * 2)
+    state = {
+        'next': 0,
+        'stopped': False,
+    }
+
+    def worker():
+        while True:
+            slots.acquire()
+            lock.acquire()
+
+            try:
+                i = state['next']
+
+                if state['stopped'] or i >= len(items):
+                    # Let any other waiting worker see this too.
+                    slots.release()
+                    return
+
+                state['next'] = i + 1
+            finally:
+                lock.release()
+
+            try:
+                result = (True, func(items[i]))
+            except BaseException:
+                result = (False, sys.exc_info())
+
+            results.put((i, result))
+
+    threads = [threading.Thread(target=worker)
+               for i in range(min(max_workers, len(items)))]
+
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+
+    finished = {}
+
+    try:
+        for i in xrange(len(items)):
+            while i not in finished:
+                index, result = results.get(True, _WAIT_TIMEOUT)
+                finished[index] = result
+
+            succeeded, value = finished.pop(i)
+            slots.release()
+
+            if not succeeded:
+                raise value[0], value[1], value[2]
+
+            yield value
+    finally:
+        state['stopped'] = True
+        slots.release()
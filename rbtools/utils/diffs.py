@@ -0,0 +1,187 @@
+import tempfile
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+
+class DiffBuffer(object):
+    """
+    The content of a generated diff.
+
+    Diffs can be very large (diffs of generated code, for instance), so the
+    content is only kept in memory until it grows past max_memory_size.
+    After that, it's moved to a temporary file, and everything written
+    later goes straight to the file. The size and SHA1 hash of the content
+    are updated as it's written, so neither takes another pass over it.
+
+    Content is added with write() and writelines(), and read back in
+    blocks with iter_blocks() or in lines with iter_lines(). It can also be
+    read like a file, with seek() and read(), which is how it's streamed in
+    an upload. A DiffBuffer compares equal to a string or DiffBuffer with
+    the same content.
+    """
+    BLOCK_SIZE = 64 * 1024
+    MAX_MEMORY_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, content='', max_memory_size=MAX_MEMORY_SIZE):
+        self.max_memory_size = max_memory_size
+        self._chunks = []
+        self._file = None
+        self._size = 0
+        self._hasher = sha1()
+        self._read_pos = 0
+
+        self.write(content)
+
+    def __len__(self):
+        return self._size
+
+    def __eq__(self, other):
+        if isinstance(other, DiffBuffer):
+            return (len(self) == len(other) and
+                    self.hexdigest() == other.hexdigest())
+        elif isinstance(other, basestring):
+            return len(self) == len(other) and self.getvalue() == other
+        else:
+            return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+
+        if result is NotImplemented:
+            return result
+
+        return not result
+
+    def __repr__(self):
+        if self._file:
+            return '<DiffBuffer of %d bytes in a file>' % self._size
+        else:
+            return '<DiffBuffer %r>' % self.getvalue()
+
+    def write(self, data):
+        """
+        Appends data to the diff, moving it to a temporary file if it has
+        grown too large to keep in memory.
+        """
+        if not data:
+            return
+
+        self._size += len(data)
+        self._hasher.update(data)
+
+        if self._file:
+            self._file.seek(0, 2)
+            self._file.write(data)
+        else:
+            self._chunks.append(data)
+
+            if self._size > self.max_memory_size:
+                self._file = tempfile.TemporaryFile()
+                self._file.writelines(self._chunks)
+                self._chunks = []
+
+    def writelines(self, lines):
+        """Appends each of the lines (or other strings) to the diff."""
+        for line in lines:
+            self.write(line)
+
+    def hexdigest(self):
+        """Returns the SHA1 hash of the diff, in hex."""
+        return self._hasher.hexdigest()
+
+    def get_hasher(self):
+        """
+        Returns a SHA1 hash object that has been fed the diff, which can be
+        updated further without affecting this diff's hash.
+        """
+        return self._hasher.copy()
+
+    def getvalue(self):
+        """
+        Returns the whole diff as a string. This should be avoided for
+        diffs that may be large.
+        """
+        if self._file:
+            self._file.seek(0)
+            return self._file.read()
+
+        if len(self._chunks) > 1:
+            self._chunks = [''.join(self._chunks)]
+
+        return ''.join(self._chunks)
+
+    def iter_blocks(self, block_size=BLOCK_SIZE):
+        """Yields the diff from the start, in blocks of up to block_size."""
+        pos = 0
+
+        while pos < self._size:
+            block = self._read_at(pos, block_size)
+
+            if not block:
+                break
+
+            pos += len(block)
+            yield block
+
+    def iter_lines(self, block_size=BLOCK_SIZE):
+        """Yields the diff from the start, one line at a time."""
+        pending = ''
+
+        for block in self.iter_blocks(block_size):
+            data = pending + block
+            start = 0
+
+            while True:
+                end = data.find('\n', start)
+
+                if end == -1:
+                    break
+
+                yield data[start:end + 1]
+                start = end + 1
+
+            pending = data[start:]
+
+        if pending:
+            yield pending
+
+    def seek(self, offset, whence=0):
+        """Sets the position read() reads from, like file.seek."""
+        if whence == 1:
+            offset += self._read_pos
+        elif whence == 2:
+            offset += self._size
+
+        self._read_pos = max(0, offset)
+
+    def tell(self):
+        return self._read_pos
+
+    def read(self, size=-1):
+        """Reads up to size bytes, or the rest of the diff, like file.read."""
+        if size is None or size < 0:
+            size = self._size - self._read_pos
+
+        data = self._read_at(self._read_pos, size)
+        self._read_pos += len(data)
+
+        return data
+
+    def close(self):
+        """Removes the temporary file, if the diff was moved to one."""
+        if self._file:
+            self._file.close()
+            self._file = None
+
+        self._chunks = []
+        self._size = 0
+
+    def _read_at(self, pos, size):
+        if self._file:
+            self._file.seek(pos)
+            return self._file.read(size)
+
+        return self.getvalue()[pos:pos + size]
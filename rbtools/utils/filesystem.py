@@ -5,6 +5,7 @@ from rbtools.utils.process import die
 
 
 CONFIG_FILE = '.reviewboardrc'
+CACHE_DIR = '.post-review-cache'
 
 tempfiles = []
 
@@ -25,6 +26,21 @@ def get_config_value(configs, name, default=None):
     return default
 
 
+def get_home_path():
+    """Returns the user's home directory, where config files are kept."""
+    if 'APPDATA' in os.environ:
+        return os.environ['APPDATA']
+    elif 'HOME' in os.environ:
+        return os.environ['HOME']
+    else:
+        return ''
+
+
+def get_cache_path(name):
+    """Returns the path of the named cache in the user's cache directory."""
+    return os.path.join(get_home_path(), CACHE_DIR, name)
+
+
 def load_config_files(homepath):
     """Loads data from .reviewboardrc files."""
     def _load_config(path):
@@ -2,6 +2,7 @@ import logging
 import os
 import subprocess
 import sys
+import tempfile
 
 
 def die(msg=None):
@@ -19,16 +20,27 @@ def die(msg=None):
     sys.exit(1)
 
 
-def execute(command,
-            env=None,
-            split_lines=False,
-            ignore_errors=False,
-            extra_ignore_errors=(),
-            translate_newlines=True,
-            with_errors=True,
-            none_on_ignored_error=False):
+# The number of lines of output kept to show when a streamed command fails.
+_ERROR_CONTEXT_LINES = 20
+
+
+def open_process(command,
+                 env=None,
+                 stdin=None,
+                 with_errors=True,
+                 translate_newlines=True,
+                 errors_output=None):
     """
-    Utility function to execute a command and return the output.
+    Starts a command with the environment and pipes used by execute() and
+    execute_stream(), and returns its subprocess.Popen object. This is for
+    callers that talk to a command as it runs, such as a long-lived server
+    process, and are responsible for waiting on it.
+
+    The command's stdout is always a pipe. Its stdin is the given file
+    object, or a pipe if that isn't given. With with_errors, stderr is
+    merged into stdout. Otherwise, it goes to errors_output (a file
+    object), or to a pipe if that isn't given. A pipe has to be read as
+    the command runs, or it can fill up and leave the command blocked.
     """
     if isinstance(command, list):
         logging.debug('Running: ' + subprocess.list2cmdline(command))
@@ -45,12 +57,15 @@ def execute(command,
 
     if with_errors:
         errors_output = subprocess.STDOUT
-    else:
+    elif errors_output is None:
         errors_output = subprocess.PIPE
 
+    if stdin is None:
+        stdin = subprocess.PIPE
+
     if sys.platform.startswith('win'):
         p = subprocess.Popen(command,
-                             stdin=subprocess.PIPE,
+                             stdin=stdin,
                              stdout=subprocess.PIPE,
                              stderr=errors_output,
                              shell=False,
@@ -58,13 +73,30 @@ def execute(command,
                              env=env)
     else:
         p = subprocess.Popen(command,
-                             stdin=subprocess.PIPE,
+                             stdin=stdin,
                              stdout=subprocess.PIPE,
                              stderr=errors_output,
                              shell=False,
                              close_fds=True,
                              universal_newlines=translate_newlines,
                              env=env)
+
+    return p
+
+
+def execute(command,
+            env=None,
+            split_lines=False,
+            ignore_errors=False,
+            extra_ignore_errors=(),
+            translate_newlines=True,
+            with_errors=True,
+            none_on_ignored_error=False):
+    """
+    Utility function to execute a command and return the output.
+    """
+    p = open_process(command, env, None, with_errors, translate_newlines)
+
     if split_lines:
         data = p.stdout.readlines()
     else:
@@ -82,3 +114,58 @@ def execute(command,
         return None
 
     return data
+
+
+def execute_stream(command,
+                   env=None,
+                   stdin=None,
+                   ignore_errors=False,
+                   extra_ignore_errors=(),
+                   translate_newlines=True,
+                   with_errors=True):
+    """
+    Utility function to execute a command and iterate over its output, one
+    line at a time, as it's produced.
+
+    Unlike execute(), the output is never held in memory as a whole, so
+    callers can process very large outputs incrementally. If 'stdin' is
+    provided, it must be a file object the command will read its input
+    from. The return code is checked once all output has been consumed.
+    """
+    if with_errors:
+        errors_file = None
+    else:
+        # stderr is only read once the command has finished, so it goes to
+        # a file. A pipe could fill up and leave the command blocked.
+        errors_file = tempfile.TemporaryFile()
+
+    p = open_process(command, env, stdin, with_errors, translate_newlines,
+                     errors_file)
+
+    # The last lines of output, which have any errors in them when they're
+    # mixed in with the output.
+    last_lines = []
+
+    # We use readline() instead of iterating over the file, since file
+    # iteration reads ahead in large blocks and would delay the lines.
+    for line in iter(p.stdout.readline, ''):
+        if with_errors:
+            last_lines.append(line)
+            del last_lines[:-_ERROR_CONTEXT_LINES]
+
+        yield line
+
+    rc = p.wait()
+
+    if errors_file:
+        errors_file.seek(0)
+        errors = errors_file.read()
+        errors_file.close()
+    else:
+        errors = ''.join(last_lines)
+
+    if rc and not ignore_errors and rc not in extra_ignore_errors:
+        die('Failed to execute command: %s\n%s' % (command, errors))
+    elif rc:
+        logging.debug('Command exited with rc %s: %s\n%s---'
+                      % (rc, command, errors))
@@ -0,0 +1,148 @@
+import logging
+import socket
+import threading
+import time
+
+from rbtools.utils.cache import FileCache
+from rbtools.utils.filesystem import get_cache_path
+
+
+# How long a resolved host name is used before it's looked up again.
+CACHE_TTL = 24 * 60 * 60
+
+# How long a failed lookup is remembered before it's tried again.
+FAILED_CACHE_TTL = 60 * 60
+
+# How long to wait for a lookup that isn't cached before giving up on it.
+RESOLVE_TIMEOUT = 3
+
+
+_cache = None
+
+
+def gethostbyaddr(hostname, timeout=RESOLVE_TIMEOUT):
+    """
+    Returns the canonical name and aliases of a host, as a tuple like the
+    first two values from socket.gethostbyaddr, or None if the host can't
+    be resolved.
+
+    Slow or broken DNS can stall socket.gethostbyaddr for a long time, so
+    results are kept in a cache shared by all post-review processes:
+
+      * A cached result is returned right away. Once it's older than
+        CACHE_TTL, it's looked up again in a background thread, and the
+        cached result is used in the meantime.
+
+      * Otherwise, the lookup is given up to timeout seconds. If it takes
+        longer, None is returned, and the result is cached when it
+        eventually arrives, for the next run.
+    """
+    cache = _get_cache()
+    key = ('gethostbyaddr', hostname)
+    entry = _load_entry(cache.get(key))
+
+    if entry:
+        timestamp, info = entry
+
+        if info:
+            ttl = CACHE_TTL
+        else:
+            ttl = FAILED_CACHE_TTL
+
+        if time.time() - timestamp >= ttl:
+            logging.debug('Refreshing the cached host name for %s'
+                          % hostname)
+            _start_lookup(cache, key, hostname)
+
+        return info
+
+    thread = _start_lookup(cache, key, hostname)
+    thread.join(timeout)
+
+    if thread.isAlive():
+        logging.debug('Timed out looking up the host name for %s'
+                      % hostname)
+        return None
+
+    return thread.info
+
+
+def getfqdn(hostname, timeout=RESOLVE_TIMEOUT):
+    """
+    Returns the fully qualified domain name of a host, like
+    socket.getfqdn, using the cache and timeout of gethostbyaddr.
+
+    The hostname is returned unchanged if it can't be resolved.
+    """
+    info = gethostbyaddr(hostname, timeout)
+
+    if not info:
+        return hostname
+
+    for name in [info[0]] + info[1]:
+        if '.' in name:
+            return name
+
+    return info[0]
+
+
+def _get_cache():
+    global _cache
+
+    if _cache is None:
+        _cache = FileCache(get_cache_path('hostnames'))
+
+    return _cache
+
+
+def _start_lookup(cache, key, hostname):
+    """
+    Starts looking up a host in a background thread, which stores the
+    result in the cache. The thread's info attribute is set to the result.
+    """
+    def lookup():
+        try:
+            name, aliases, addresses = socket.gethostbyaddr(hostname)
+            thread.info = (name, aliases)
+        except socket.error, e:
+            logging.debug('Unable to look up the host name for %s: %s'
+                          % (hostname, e))
+
+        cache.set(key, _dump_entry(thread.info))
+
+    # The thread is a daemon, so a lookup that never returns doesn't keep
+    # post-review from exiting.
+    thread = threading.Thread(target=lookup)
+    thread.info = None
+    thread.setDaemon(True)
+    thread.start()
+
+    return thread
+
+
+def _dump_entry(info):
+    if info:
+        return '%f\n%s\n%s' % (time.time(), info[0], ' '.join(info[1]))
+    else:
+        return '%f\n\n' % time.time()
+
+
+def _load_entry(data):
+    """
+    Returns the timestamp and the (name, aliases) tuple, or None for a
+    failed lookup, of a cache entry. None is returned for a missing or
+    corrupt entry.
+    """
+    if data is None:
+        return None
+
+    try:
+        timestamp, name, aliases = data.split('\n', 2)
+        timestamp = float(timestamp)
+    except ValueError:
+        return None
+
+    if name:
+        return timestamp, (name, aliases.split())
+    else:
+        return timestamp, None
@@ -4,8 +4,14 @@ Any new modules created under rbtools/api should be tested here."""
 import os
 import re
 import sys
+import threading
+import time
+from StringIO import StringIO
 
-from rbtools.utils import checks, filesystem, process
+from rbtools.utils import checks, filesystem, process, resolver
+from rbtools.utils.cache import FileCache
+from rbtools.utils.concurrency import imap_ordered
+from rbtools.utils.diffs import DiffBuffer
 from rbtools.utils.testbase import RBTestBase
 
 
@@ -28,6 +34,210 @@ class UtilitiesTest(RBTestBase):
         self.assertTrue(re.match('.*?%d.%d.%d' % sys.version_info[:3],
                         process.execute([sys.executable, '-V'])))
 
+    def test_execute_stream(self):
+        """Test 'execute_stream' method."""
+        lines = process.execute_stream(
+            [sys.executable, '-c', 'print "a"; print "b"'])
+
+        self.assertEqual(list(lines), ['a\n', 'b\n'])
+
+        # Lots of errors don't block a command whose errors aren't read
+        # until it finishes.
+        lines = process.execute_stream(
+            [sys.executable, '-c',
+             'import sys; sys.stderr.write("e" * 1000000); print "a"'],
+            with_errors=False)
+        self.assertEqual(list(lines), ['a\n'])
+
+        # The errors are shown when the command fails.
+        saved_stdout = sys.stdout
+        sys.stdout = StringIO()
+
+        try:
+            lines = process.execute_stream(
+                [sys.executable, '-c',
+                 'import sys; sys.stderr.write("oops\\n"); sys.exit(2)'],
+                with_errors=False)
+            self.assertRaises(SystemExit, list, lines)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = saved_stdout
+
+        self.assertTrue('oops\n' in output)
+
+    def test_file_cache(self):
+        """Test 'FileCache' storing and evicting entries."""
+        cache = FileCache(os.path.join(self.create_tmp_dir(), 'cache'),
+                          max_size=1024)
+        key1 = ('a', 'b')
+        key2 = ('a', 'c')
+
+        self.assertEqual(cache.get(key1), None)
+        cache.set(key1, 'x' * 1000)
+        self.assertEqual(cache.get(key1), 'x' * 1000)
+
+        # Make the first entry older, so it's the one evicted.
+        os.utime(cache._get_filename(key1), (0, 0))
+        cache.set(key2, os.urandom(1000))
+        self.assertEqual(cache.get(key1), None)
+        self.assertEqual(len(cache.get(key2)), 1000)
+
+        # Values can be streamed in and out a block at a time.
+        diff = DiffBuffer(max_memory_size=100)
+        diff.writelines(['line %d\n' % i for i in range(100)])
+        cache.set_blocks(key1, diff.iter_blocks(64))
+        self.assertEqual(cache.get(key1), diff.getvalue())
+
+        cached = DiffBuffer(max_memory_size=100)
+        self.assertTrue(cache.read_into(key1, cached))
+        self.assertEqual(cached, diff)
+        self.assertFalse(cache.read_into(('missing',), cached))
+
+    def test_file_cache_size(self):
+        """Test 'FileCache' only scanning entries when evicting."""
+        cache = FileCache(os.path.join(self.create_tmp_dir(), 'cache'),
+                          max_size=1024)
+        prunes = []
+        prune = cache.prune
+
+        def counting_prune():
+            prunes.append(cache._size)
+            prune()
+
+        cache.prune = counting_prune
+
+        # The first set() measures the cache. After that, the size is
+        # tracked as entries are written and replaced.
+        for i in range(10):
+            cache.set(('a', str(i)), 'x')
+            cache.set(('a', str(i)), 'y')
+
+        self.assertEqual(prunes, [None])
+        self.assertEqual(cache._size, sum([
+            os.path.getsize(os.path.join(cache.path, filename))
+            for filename in os.listdir(cache.path)]))
+
+        cache.set(('b',), os.urandom(1000))
+        self.assertEqual(len(prunes), 2)
+        self.assertTrue(cache._size <= 1024)
+
+        # A failed write doesn't leave its temporary file behind.
+        os.mkdir(cache._get_filename(('c',)))
+        cache.set(('c',), 'z')
+        self.assertEqual([filename for filename in os.listdir(cache.path)
+                          if filename.endswith('.tmp')], [])
+
+    def test_diff_buffer(self):
+        """Test 'DiffBuffer' class."""
+        lines = ['line %d\n' % i for i in range(100)]
+        content = ''.join(lines)
+
+        small = DiffBuffer()
+        small.writelines(lines)
+        large = DiffBuffer(max_memory_size=64)
+        large.writelines(lines)
+
+        # Only the large diff is moved to a file.
+        self.assertEqual(small._file, None)
+        self.assertNotEqual(large._file, None)
+
+        for diff in (small, large):
+            self.assertEqual(len(diff), len(content))
+            self.assertEqual(diff, content)
+            self.assertEqual(''.join(diff.iter_blocks(10)), content)
+            self.assertEqual(list(diff.iter_lines()), lines)
+            self.assertEqual(list(diff.iter_lines(5)), lines)
+            self.assertEqual(diff.hexdigest(),
+                             DiffBuffer(content).hexdigest())
+
+            diff.seek(5)
+            self.assertEqual(diff.read(3), content[5:8])
+            self.assertEqual(diff.read(), content[8:])
+            self.assertEqual(diff.read(), '')
+
+        self.assertEqual(small, large)
+        self.assertNotEqual(small, DiffBuffer('other'))
+        self.assertEqual(list(DiffBuffer('a\n\nb').iter_lines()),
+                         ['a\n', '\n', 'b'])
+
+        large.close()
+        self.assertEqual(large._file, None)
+
+    def test_imap_ordered(self):
+        """Test 'imap_ordered' method."""
+        def square(i):
+            # Finish the earlier items last.
+            time.sleep((10 - i) * 0.005)
+            return i * i
+
+        self.assertEqual(list(imap_ordered(square, range(10), 4)),
+                         [i * i for i in range(10)])
+
+        def fail(i):
+            if i == 5:
+                process.die()
+
+            return i
+
+        results = imap_ordered(fail, range(10), 4)
+        self.assertEqual([results.next() for i in range(5)], range(5))
+        self.assertRaises(SystemExit, results.next)
+
+    def test_resolver(self):
+        """Test 'resolver' methods."""
+        lookups = []
+        threads = []
+        slow_lookup_done = threading.Event()
+
+        def gethostbyaddr(hostname):
+            lookups.append(hostname)
+
+            if hostname == 'slow':
+                slow_lookup_done.wait()
+
+            return ('%s.example.com' % hostname, ['alias'], ['10.0.0.1'])
+
+        def start_lookup(*args):
+            thread = saved_start_lookup(*args)
+            threads.append(thread)
+            return thread
+
+        saved_gethostbyaddr = resolver.socket.gethostbyaddr
+        saved_start_lookup = resolver._start_lookup
+        resolver.socket.gethostbyaddr = gethostbyaddr
+        resolver._start_lookup = start_lookup
+        resolver._cache = None
+
+        try:
+            self.assertEqual(resolver.gethostbyaddr('host'),
+                             ('host.example.com', ['alias']))
+            self.assertEqual(resolver.getfqdn('host'), 'host.example.com')
+            self.assertEqual(lookups, ['host'])
+
+            # Slow lookups are given up on, but cached for next time.
+            self.assertEqual(resolver.gethostbyaddr('slow', 0), None)
+            self.assertEqual(resolver.getfqdn('slow', 0), 'slow')
+            slow_lookup_done.set()
+
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(resolver.getfqdn('slow', 0), 'slow.example.com')
+
+            # Expired results are used while they're looked up again.
+            resolver._cache.set(('gethostbyaddr', 'host'),
+                                '0\nold.example.com\n')
+            self.assertEqual(resolver.gethostbyaddr('host'),
+                             ('old.example.com', []))
+            threads[-1].join()
+            self.assertEqual(resolver.gethostbyaddr('host'),
+                             ('host.example.com', ['alias']))
+        finally:
+            slow_lookup_done.set()
+            resolver.socket.gethostbyaddr = saved_gethostbyaddr
+            resolver._start_lookup = saved_start_lookup
+            resolver._cache = None
+
     def test_die(self):
         """Test 'die' method."""
         self.assertRaises(SystemExit, process.die)